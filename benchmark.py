@@ -0,0 +1,534 @@
+# Офлайн-бенчмарк бота: локальный сервер с фикстурами (страницы объявлений и картинки CDN),
+# заглушка Telegram Bot API и прогон handle_html от начала до конца без выхода в сеть.
+#
+#   python benchmark.py pipeline --requests 30 --concurrency 3
+#   python benchmark.py pipeline --mode html --json bench.json   # без Chromium
+#   python benchmark.py pipeline --mode hls --segments 20         # видео HLS: master-плейлист и сегменты
+#   python benchmark.py scan --size-mb 4                          # сканер URL против старых проходов regex
+#
+# Режим url отправляет боту ссылку на страницу (рендер в Playwright), режим html — сам HTML страницы,
+# режим hls — ссылку на master-плейлист .m3u8 (бот выбирает вариант под лимит размера и качает сегменты).
+# Отчёт: пропускная способность (запросов/мин), p50/p95 по этапам конвейера и пиковый RSS.
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import socket
+import statistics
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+from aiohttp import web
+
+BENCH_TOKEN = '123456:BENCHMARK'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+# Базовые JPEG-картинки для CDN-фикстур; к каждому ответу дописывается уникальный хвост после EOI,
+# чтобы кэш file_id по содержимому не подменял скачивание и конвертацию
+def make_base_images(count: int, width: int, height: int) -> list[bytes]:
+    from PIL import Image
+    rnd = random.Random(42)
+    images = []
+    for i in range(count):
+        img = Image.new('RGB', (width, height), (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)))
+        noise = Image.effect_noise((width, height), 40).convert('RGB')
+        img = Image.blend(img, noise, 0.35)
+        buf = BytesIO()
+        img.save(buf, format='JPEG', quality=85)
+        images.append(buf.getvalue())
+    return images
+
+
+# Страница объявления в духе easyhata: галерея <img>, ссылки в JSON состояния и пара URL без расширения
+def render_listing(base: str, listing_id: int, images: int) -> str:
+    gallery = []
+    state = []
+    for n in range(images):
+        if n % 4 == 3:
+            url = f"{base}/img/{listing_id}/{n}"
+        else:
+            url = f"{base}/media/realty/{listing_id}/{n}.jpg"
+        gallery.append(f'<div class="gallery__item"><img src="{url}" alt="Фото {n + 1}"></div>')
+        state.append(url.replace('/', '\\u002F'))
+    filler = '\n'.join(f'<p class="description">Описание объекта {listing_id}, строка {i}.</p>' for i in range(200))
+    return f"""<!DOCTYPE html>
+<html lang="uk"><head><meta charset="utf-8"><title>Квартира {listing_id}</title>
+<link rel="icon" href="{base}/favicon.ico"></head>
+<body>
+<header><img src="{base}/static/logo.svg" alt="logo"></header>
+<main>
+<h1>Квартира №{listing_id}</h1>
+<section class="gallery">
+{''.join(gallery)}
+</section>
+{filler}
+</main>
+<script>window.__NUXT__={json.dumps({'data': [{'flat': {'id': listing_id, 'photos': state}}]})}</script>
+</body></html>"""
+
+
+# Сегмент MPEG-TS для HLS-фикстур: пакеты по 188 байт с байтом синхронизации 0x47
+def make_ts_segment(size: int) -> bytes:
+    rnd = random.Random(7)
+    packets = max(1, size // 188)
+    return b''.join(b'\x47' + rnd.randbytes(187) for _ in range(packets))
+
+
+# Master-плейлист с двумя вариантами: high по оценке не влезает в лимит Telegram, low влезает
+HLS_SEGMENT_SECONDS = 4
+
+
+def render_hls_master(segment_bytes: int, segments: int, max_file_size: int) -> str:
+    low = segment_bytes * 8 // HLS_SEGMENT_SECONDS
+    high = max_file_size * 8 // (segments * HLS_SEGMENT_SECONDS) * 2
+    return (
+        "#EXTM3U\n"
+        f"#EXT-X-STREAM-INF:BANDWIDTH={low},RESOLUTION=640x360\nlow/index.m3u8\n"
+        f"#EXT-X-STREAM-INF:BANDWIDTH={high},RESOLUTION=1920x1080\nhigh/index.m3u8\n"
+    )
+
+
+def render_hls_media(segments: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{HLS_SEGMENT_SECONDS}", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for n in range(segments):
+        lines += [f"#EXTINF:{HLS_SEGMENT_SECONDS}.0,", f"{n}.ts"]
+    lines.append("#EXT-X-ENDLIST")
+    return '\n'.join(lines) + '\n'
+
+
+class FixtureServer:
+    def __init__(self, images_per_page: int, image_size: tuple, segments: int = 0, segment_kb: int = 0):
+        self.images_per_page = images_per_page
+        self.base_images = make_base_images(4, *image_size) if images_per_page else []
+        self.segments = segments
+        self.segment = make_ts_segment(segment_kb * 1024) if segments else b''
+        self.base = ''
+        self.image_requests = 0
+        self.segment_requests = 0
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/flats/{id}/', self.listing)
+        app.router.add_get('/media/realty/{id}/{name}', self.image)
+        app.router.add_get('/img/{id}/{name}', self.image)
+        app.router.add_get('/hls/{id}/master.m3u8', self.hls_master)
+        app.router.add_get('/hls/{id}/{variant}/index.m3u8', self.hls_media)
+        app.router.add_get('/hls/{id}/{variant}/{n}.ts', self.hls_segment)
+        port = free_port()
+        self.base = f"http://127.0.0.1:{port}"
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def page_url(self, listing_id: int) -> str:
+        return f"{self.base}/flats/{listing_id}/"
+
+    def page_html(self, listing_id: int) -> str:
+        return render_listing(self.base, listing_id, self.images_per_page)
+
+    def hls_url(self, listing_id: int) -> str:
+        return f"{self.base}/hls/{listing_id}/master.m3u8"
+
+    # Размер видео, которое должно дойти до Telegram (вариант low без перепаковки)
+    def hls_bytes(self) -> int:
+        return self.segments * len(self.segment)
+
+    async def listing(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.page_html(int(request.match_info['id'])), content_type='text/html')
+
+    async def image(self, request: web.Request) -> web.Response:
+        self.image_requests += 1
+        base = self.base_images[hash(request.path) % len(self.base_images)]
+        body = base + request.path.encode()
+        if request.method == 'HEAD':
+            return web.Response(headers={'Content-Type': 'image/jpeg', 'Content-Length': str(len(body))})
+        return web.Response(body=body, content_type='image/jpeg')
+
+    async def hls_master(self, request: web.Request) -> web.Response:
+        from bot import MAX_FILE_SIZE
+        return web.Response(text=render_hls_master(len(self.segment), self.segments, MAX_FILE_SIZE),
+                            content_type='application/vnd.apple.mpegurl')
+
+    async def hls_media(self, request: web.Request) -> web.Response:
+        return web.Response(text=render_hls_media(self.segments), content_type='application/vnd.apple.mpegurl')
+
+    async def hls_segment(self, request: web.Request) -> web.Response:
+        self.segment_requests += 1
+        # Сегменты high вдвое больше: если бот выберет не тот вариант, размер видео не сойдётся
+        body = self.segment * (2 if request.match_info['variant'] == 'high' else 1)
+        return web.Response(body=body, content_type='video/mp2t')
+
+
+# Заглушка Bot API: отвечает на методы, которые вызывает бот, и считает полученные фото по чатам
+class FakeTelegramAPI:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.base = ''
+        self.calls = {}
+        self.photos = {}  # {chat_id: число фото}
+        self.first_photo_at = {}  # {chat_id: время первой отправки фото}
+        self.upload_bytes = 0
+        self.videos = {}  # {chat_id: байт в полученном видео/документе}
+        self._ids = itertools.count(1000)
+        self._runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        port = free_port()
+        self.base = f"http://127.0.0.1:{port}"
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        return {
+            'message_id': next(self._ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **extra,
+        }
+
+    def _photo(self) -> list:
+        n = next(self._ids)
+        return [{'file_id': f'photo-{n}', 'file_unique_id': f'u{n}', 'width': 1280, 'height': 960}]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = await request.post()
+        uploaded = 0
+        for value in form.values():
+            if isinstance(value, web.FileField):
+                value.file.seek(0, os.SEEK_END)
+                uploaded += value.file.tell()
+        self.upload_bytes += uploaded
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = int(form.get('chat_id', 0) or 0)
+        if method in ('sendPhoto', 'sendMediaGroup'):
+            self.first_photo_at.setdefault(chat_id, time.perf_counter())
+        if method in ('sendVideo', 'sendDocument'):
+            self.videos[chat_id] = self.videos.get(chat_id, 0) + uploaded
+
+        if method == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif method in ('deleteMessage', 'answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            result = True
+        elif method == 'sendPhoto':
+            self.photos[chat_id] = self.photos.get(chat_id, 0) + 1
+            result = self._message(chat_id, photo=self._photo())
+        elif method == 'sendMediaGroup':
+            items = json.loads(form.get('media', '[]'))
+            self.photos[chat_id] = self.photos.get(chat_id, 0) + len(items)
+            result = [self._message(chat_id, photo=self._photo()) for _ in items]
+        elif method == 'sendVideo':
+            n = next(self._ids)
+            result = self._message(chat_id, video={'file_id': f'video-{n}', 'file_unique_id': f'u{n}',
+                                                   'width': 1280, 'height': 720, 'duration': 1})
+        elif method == 'sendDocument':
+            n = next(self._ids)
+            result = self._message(chat_id, document={'file_id': f'doc-{n}', 'file_unique_id': f'u{n}'})
+        else:
+            # sendMessage, editMessageText и прочие текстовые методы
+            result = self._message(chat_id, text=form.get('text', ''))
+        return web.json_response({'ok': True, 'result': result})
+
+
+# Пиковый RSS процесса вместе с дочерними (Chromium), замер раз в interval секунд
+async def sample_rss(bot_module, peak: list, interval: float = 0.1):
+    while True:
+        peak[0] = max(peak[0], bot_module.get_process_tree_rss_mb())
+        await asyncio.sleep(interval)
+
+
+async def run_pipeline(args) -> dict:
+    if args.mode == 'hls':
+        fixtures = FixtureServer(0, (0, 0), args.segments, args.segment_kb)
+    else:
+        fixtures = FixtureServer(args.images, (args.image_width, args.image_height))
+    api = FakeTelegramAPI(args.api_latency / 1000)
+    await fixtures.start()
+    await api.start()
+
+    # Окружение бота задаётся до импорта: заглушка API, без сервера метрик и без базы на диске
+    os.environ.setdefault('BOT_TOKEN', BENCH_TOKEN)
+    os.environ['TELEGRAM_API_URL'] = api.base
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['STATE_DB_PATH'] = ''
+    import bot as bot_module
+    from aiogram.types import Chat, Message, User
+
+    stage_samples = {}
+    observe = bot_module.metrics.observe
+
+    def record(name, value, **labels):
+        if name == 'bot_stage_duration_seconds':
+            stage_samples.setdefault(labels.get('stage'), []).append(value)
+        observe(name, value, **labels)
+
+    bot_module.metrics.observe = record
+
+    bot_module.get_http_session()
+    bot_module.page_cache.load()
+    bot_module.file_id_cache.load()
+    bot_module.activity_store.load()
+    if args.mode == 'url':
+        await bot_module.browser_manager.start()
+
+    def make_message(listing_id: int) -> Message:
+        if args.mode == 'hls':
+            text = fixtures.hls_url(listing_id)
+        else:
+            text = fixtures.page_url(listing_id) if args.mode == 'url' else fixtures.page_html(listing_id)
+        return Message(
+            message_id=listing_id,
+            date=datetime.now(),
+            chat=Chat(id=listing_id, type='private'),
+            from_user=User(id=listing_id, is_bot=False, first_name='Bench'),
+            text=text,
+        ).as_(bot_module.bot)
+
+    latencies = []
+    first_album = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(listing_id: int, measured: bool):
+        async with semaphore:
+            started = time.perf_counter()
+            await bot_module.handle_html(make_message(listing_id))
+            if measured:
+                latencies.append(time.perf_counter() - started)
+                if listing_id in api.first_photo_at:
+                    first_album.append(api.first_photo_at[listing_id] - started)
+
+    peak = [0.0]
+    sampler = asyncio.create_task(sample_rss(bot_module, peak))
+    try:
+        # Прогрев (запуск браузера, TLS, пулы) в замер не входит
+        await asyncio.gather(*(one(100000 + i, False) for i in range(args.warmup)))
+        stage_samples.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i + 1, True) for i in range(args.requests)))
+        wall = time.perf_counter() - started
+    finally:
+        sampler.cancel()
+        await bot_module.browser_manager.stop()
+        bot_module.image_converter.shutdown()
+        await bot_module.close_http_session()
+        await bot_module.bot.session.close()
+        await api.stop()
+        await fixtures.stop()
+
+    if args.mode == 'hls':
+        ok = sum(1 for i in range(args.requests) if api.videos.get(i + 1, 0) == fixtures.hls_bytes())
+    else:
+        ok = sum(1 for i in range(args.requests) if api.photos.get(i + 1, 0) == args.images)
+    stages = {'request': latencies, 'first_album': first_album, **stage_samples}
+    return {
+        'mode': args.mode,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'images_per_page': args.images,
+        'segments': args.segments if args.mode == 'hls' else 0,
+        'complete_albums': ok,
+        'wall_seconds': round(wall, 3),
+        'requests_per_min': round(args.requests / wall * 60, 1) if wall else 0.0,
+        'stages': {
+            name: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 1),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+                'mean_ms': round(statistics.fmean(values) * 1000, 1) if values else 0.0,
+            }
+            for name, values in stages.items()
+        },
+        'peak_rss_mb': round(max(peak[0], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024), 1),
+        'telegram_calls': api.calls,
+        'telegram_upload_mb': round(api.upload_bytes / (1024 * 1024), 2),
+        'image_requests': fixtures.image_requests,
+        'segment_requests': fixtures.segment_requests,
+    }
+
+
+# Прежнее извлечение URL (быстрый HTTP-проход и проходы по page.content()) — эталон для сравнения
+def legacy_extract(html: str, obj_id: str | None) -> tuple:
+    html_unesc = html.replace('\\u002F', '/')
+    candidates = []
+    patterns = [
+        r"https?://(?:api\.easybase\.com\.ua|easybase\.b-cdn\.net)[^\s'\"<>]*/realty/(\d+)[^\s'\"<>]*\.(?:webp|jpg|jpeg|png|bmp)",
+        r"https?://easybase\.b-cdn\.net/prod/media/realty/(\d+)[^\s'\"<>]*\.(?:webp|jpg|jpeg|png|bmp)"
+    ]
+    for pat in patterns:
+        for m in re.findall(pat, html_unesc, flags=re.IGNORECASE):
+            pass
+    for m in re.findall(r"https?://[^\s'\"<>]+\.(?:webp|jpg|jpeg|png|bmp)", html_unesc, flags=re.IGNORECASE):
+        lm = m.lower()
+        if any(x in lm for x in ['.svg', 'favicon.ico', '/avatar/']):
+            continue
+        if ('/realty/' in lm) and (('easybase.b-cdn.net' in lm) or ('api.easybase.com.ua' in lm)):
+            if (not obj_id) or (f"/{obj_id}/" in lm):
+                candidates.append(m)
+    candidates = list(dict.fromkeys(candidates))
+
+    images = []
+    for m in re.findall(r"https:\\u002F\\u002F[^\s'\"<>]+\\.(?:jpg|jpeg|png|webp|gif|bmp)", html, flags=re.IGNORECASE):
+        images.append(m.replace("\\u002F", "/"))
+    for m in re.findall(r"https?://[^\s'\"<>]+\.(?:jpg|jpeg|png|webp|gif|bmp)", html, flags=re.IGNORECASE):
+        images.append(m)
+    return candidates, list(dict.fromkeys(images))
+
+
+# Синтетическая страница заданного размера: галерея realty на CDN, состояние Nuxt с \u002F,
+# посторонние картинки, видео и много текста между ними
+def make_scan_page(size_mb: float, obj_id: str) -> str:
+    rnd = random.Random(7)
+    parts = []
+    size = 0
+    n = 0
+    while size < size_mb * 1024 * 1024:
+        n += 1
+        listing = obj_id if n % 3 else str(rnd.randrange(10000, 99999))
+        cdn = f"https://easybase.b-cdn.net/prod/media/realty/{listing}/{n}_{rnd.randrange(1 << 30):x}.webp"
+        chunk = (
+            f'<div class="card"><img src="{cdn}" loading="lazy"><img src="https://static.example.com/ui/icon{n % 50}.png">'
+            f'<a href="/flats/{listing}/">Квартира {listing}</a><p>{"Lorem ipsum dolor sit amet " * 20}</p></div>\n'
+            f'<script>window.__S{n}={{"photo":"{cdn.replace("/", chr(92) + "u002F")}","avatar":"https:\\u002F\\u002Fcdn.example.com\\u002Favatar\\u002F{n}.jpg"}}</script>\n'
+        )
+        if n % 40 == 0:
+            chunk += f'<video src="https://video.example.com/clip{n}.mp4"></video>\n'
+        parts.append(chunk)
+        size += len(chunk)
+    return ''.join(parts)
+
+
+def run_scan(args) -> dict:
+    os.environ.setdefault('BOT_TOKEN', BENCH_TOKEN)
+    os.environ['STATE_DB_PATH'] = ''
+    import bot as bot_module
+
+    obj_id = '12345'
+    html = make_scan_page(args.size_mb, obj_id)
+
+    def timed(func) -> tuple:
+        best = float('inf')
+        result = None
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - started)
+        return best, result
+
+    legacy_time, (legacy_realty, legacy_images) = timed(lambda: legacy_extract(html, obj_id))
+    page_url = f"https://easyhata.site/flats/{obj_id}/"
+    is_target = bot_module.get_site_adapter(page_url).image_filter(page_url)
+    scan_time, scanned = timed(lambda: bot_module.scan_media_urls(html, is_target))
+    size_mb = len(html) / (1024 * 1024)
+    return {
+        'page_mb': round(size_mb, 2),
+        'legacy_ms': round(legacy_time * 1000, 1),
+        'scanner_ms': round(scan_time * 1000, 1),
+        'speedup': round(legacy_time / scan_time, 2) if scan_time else 0.0,
+        'scanner_mb_per_s': round(size_mb / scan_time, 1) if scan_time else 0.0,
+        'realty_match': set(legacy_realty) == set(scanned.targets),
+        'realty': len(scanned.targets),
+        'images': len(scanned.images),
+        'legacy_images': len(legacy_images),
+        'videos': len(scanned.videos),
+    }
+
+
+def print_report(report: dict):
+    per_request = (f"сегментов в видео: {report['segments']}" if report['mode'] == 'hls'
+                   else f"фото на странице: {report['images_per_page']}")
+    print(f"Режим: {report['mode']}, запросов: {report['requests']}, параллельно: {report['concurrency']}, {per_request}")
+    label = 'Полных видео' if report['mode'] == 'hls' else 'Полных альбомов'
+    print(f"{label}: {report['complete_albums']}/{report['requests']}")
+    print(f"Время: {report['wall_seconds']} с, пропускная способность: {report['requests_per_min']} запросов/мин")
+    print(f"Пиковый RSS: {report['peak_rss_mb']} МБ, выгружено в Telegram: {report['telegram_upload_mb']} МБ")
+    print(f"{'этап':<18}{'n':>6}{'p50, мс':>12}{'p95, мс':>12}{'среднее':>12}")
+    for name, s in report['stages'].items():
+        print(f"{name:<18}{s['count']:>6}{s['p50_ms']:>12}{s['p95_ms']:>12}{s['mean_ms']:>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарк бота')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('pipeline', help='прогон handle_html против локальных фикстур и заглушки Bot API')
+    p.add_argument('--mode', choices=('url', 'html', 'hls'), default='url')
+    p.add_argument('--requests', type=int, default=30)
+    p.add_argument('--concurrency', type=int, default=3)
+    p.add_argument('--warmup', type=int, default=1)
+    p.add_argument('--images', type=int, default=8, help='фото на странице')
+    p.add_argument('--image-width', type=int, default=1280)
+    p.add_argument('--image-height', type=int, default=960)
+    p.add_argument('--segments', type=int, default=12, help='сегментов в видео HLS')
+    p.add_argument('--segment-kb', type=int, default=512, help='размер сегмента HLS, КБ')
+    p.add_argument('--api-latency', type=float, default=0, help='задержка ответа заглушки Bot API, мс')
+    p.add_argument('--json', help='сохранить отчёт в JSON')
+    p.add_argument('--verbose', action='store_true', help='логи бота')
+
+    p = sub.add_parser('scan', help='однопроходный сканер URL против прежних проходов regex')
+    p.add_argument('--size-mb', type=float, default=4)
+    p.add_argument('--repeat', type=int, default=5, help='повторов, берётся лучший')
+    p.add_argument('--json', help='сохранить отчёт в JSON')
+
+    args = parser.parse_args()
+    if args.command == 'pipeline':
+        logging.basicConfig(level=logging.INFO)
+        logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+        report = asyncio.run(run_pipeline(args))
+        print_report(report)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        # Для CI: ненулевой код, если какие-то альбомы (видео) дошли не полностью
+        sys.exit(0 if report['complete_albums'] == report['requests'] else 1)
+    elif args.command == 'scan':
+        logging.disable(logging.CRITICAL)
+        report = run_scan(args)
+        print(f"Страница: {report['page_mb']} МБ")
+        print(f"Прежние проходы: {report['legacy_ms']} мс, сканер: {report['scanner_ms']} мс "
+              f"(x{report['speedup']}, {report['scanner_mb_per_s']} МБ/с)")
+        print(f"realty: {report['realty']} (совпадает с прежним: {'да' if report['realty_match'] else 'нет'}), "
+              f"изображений: {report['images']} (прежде {report['legacy_images']}), видео: {report['videos']}")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+        sys.exit(0 if report['realty_match'] else 1)
+
+
+if __name__ == '__main__':
+    main()
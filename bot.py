@@ -1,21 +1,43 @@
+import time
+# Начало загрузки модуля: отсюда считается время запуска (если возраст процесса недоступен)
+MODULE_LOADED_AT = time.monotonic()
 import asyncio
 import aiohttp
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaDocument, Message, InputFile, CallbackQuery, BufferedInputFile
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaDocument, Message, InputFile, CallbackQuery, BufferedInputFile, FSInputFile
 from aiogram.enums import ContentType
-from bs4 import BeautifulSoup
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import re
-try:
-    from PIL import Image  # для конвертации WEBP → JPEG (Telegram не принимает webp как фото)
-    PIL_AVAILABLE = True
-except Exception:
-    PIL_AVAILABLE = False
+from html.parser import HTMLParser
+import importlib
+import importlib.util
+# PIL нужен для конвертации WEBP → JPEG (Telegram не принимает webp как фото); импортируется лениво
+PIL_AVAILABLE = importlib.util.find_spec('PIL') is not None
+# lxml — быстрый C-парсер HTML (без него — html.parser из стандартной библиотеки); импортируется лениво
+LXML_AVAILABLE = importlib.util.find_spec('lxml') is not None
 import logging
+import tempfile
 from io import BytesIO
-from playwright.async_api import async_playwright
-import time
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, urlsplit, urlunsplit, parse_qsl, urlencode
+from contextlib import asynccontextmanager, contextmanager
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from collections import OrderedDict
+import json
+import sqlite3
+import hashlib
+import math
+import signal
+import shutil
+# Playwright, PIL и lxml не импортируются при загрузке модуля: их загружает фоновый прогрев (warm_up)
+IMPORTS_DONE_AT = time.monotonic()
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,49 +48,495 @@ import os
 API_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_ID = 198711432
 
+# Адрес Bot API: локальный telegram-bot-api или заглушка бенчмарка; по умолчанию — api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 # Инициализация бота
-bot = Bot(token=API_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=API_TOKEN)
 dp = Dispatcher()
 
-# Эмодзи для анимации загрузки
-LOADING_EMOJIS = ['⏳', '🕒', '🕓']
+# Минимальный интервал между правками сообщения о прогрессе (лимиты Telegram на редактирование)
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '1.5'))
 
 # Максимальный размер файла (50 МБ для Telegram)
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50 МБ в байтах
 
+# Каталог для временных файлов видео (спул): файлы пишутся потоково и удаляются после отправки
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'bot_spool'))
+
+# HLS (.m3u8): сколько сегментов качать одновременно и ffmpeg для перепаковки в MP4 (без него — поток как есть)
+HLS_CONCURRENCY = int(os.getenv('HLS_CONCURRENCY', '6'))
+FFMPEG_PATH = os.getenv('FFMPEG_PATH') or shutil.which('ffmpeg') or ''
+
 # Поддерживаемые форматы изображений
 IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
 VIDEO_EXTENSIONS = ('.mp4', '.webm', '.mov', '.avi', '.mkv')
 
-# Счетчик запросов и хранилище активности
+# Общий браузер Chromium: сколько контекстов одновременно, после скольких страниц
+# перезапускать браузер и при каком RSS (МБ, бот + Chromium) перезапускать досрочно
+BROWSER_MAX_CONTEXTS = int(os.getenv('BROWSER_MAX_CONTEXTS', '3'))
+BROWSER_RECYCLE_PAGES = int(os.getenv('BROWSER_RECYCLE_PAGES', '50'))
+BROWSER_MAX_RSS_MB = int(os.getenv('BROWSER_MAX_RSS_MB', '1500'))
+# Сколько контекстов (с пустой прогретой страницей) держать готовыми заранее; 0 — не держать.
+# Готовые контексты входят в BROWSER_MAX_CONTEXTS и создаются только в свободные слоты пула
+BROWSER_PREWARM_CONTEXTS = int(os.getenv('BROWSER_PREWARM_CONTEXTS', '1'))
+# Общая HTTP-сессия: лимиты соединений (всего и на хост), TTL DNS-кэша и keep-alive (сек)
+HTTP_LIMIT = int(os.getenv('HTTP_LIMIT', '100'))
+HTTP_LIMIT_PER_HOST = int(os.getenv('HTTP_LIMIT_PER_HOST', '16'))
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', '300'))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', '60'))
+
+# Параллельное скачивание фото: общий лимит на процесс и лимит на один хост
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '8'))
+DOWNLOAD_PER_HOST = int(os.getenv('DOWNLOAD_PER_HOST', '4'))
+# Сколько семафоров хостов держать; сверх лимита удаляются давно не использованные и свободные
+HOST_SEMAPHORES_MAX = 1000
+# Конвейер альбома: сколько фото готовится впрок, пока отправляется текущий альбом (ограничивает память)
+ALBUM_PREFETCH = int(os.getenv('ALBUM_PREFETCH', '20'))
+# Пауза между альбомами одного ответа (ограничения Telegram на частоту отправки)
+ALBUM_BATCH_DELAY = 0.5
+
+# Пакетная проверка URL-кандидатов: параллельность, общий дедлайн (сек) и TTL кэша результатов (сек)
+PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', '16'))
+PROBE_DEADLINE = float(os.getenv('PROBE_DEADLINE', '10'))
+PROBE_CACHE_TTL = int(os.getenv('PROBE_CACHE_TTL', '3600'))
+PROBE_CACHE_MAX = 20000
+
+# Сколько помнить (сек) найденный JPEG/PNG-вариант для .webp и отсутствие варианта
+VARIANT_CACHE_TTL = int(os.getenv('VARIANT_CACHE_TTL', '21600'))
+VARIANT_MISS_TTL = int(os.getenv('VARIANT_MISS_TTL', '1800'))
+
+# Пул конвертации в JPEG: 'thread' или 'process', число воркеров и размер очереди пула
+CONVERT_EXECUTOR = os.getenv('CONVERT_EXECUTOR', 'thread')
+CONVERT_WORKERS = int(os.getenv('CONVERT_WORKERS', str(min(4, os.cpu_count() or 1))))
+CONVERT_QUEUE_SIZE = int(os.getenv('CONVERT_QUEUE_SIZE', '32'))
+
+# Файл SQLite для состояния, которое должно пережить перезапуск (пусто — только память).
+# На Railway путь стоит указать на примонтированный volume
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')
+
+# Кэш результатов анализа страниц: время жизни (сек) и максимум записей
+PAGE_CACHE_TTL = int(os.getenv('PAGE_CACHE_TTL', str(6 * 3600)))
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '500'))
+
+# Кэш file_id Telegram: сколько записей держать в памяти поверх SQLite и сколько дней хранить записи в SQLite
+FILE_ID_CACHE_SIZE = int(os.getenv('FILE_ID_CACHE_SIZE', '20000'))
+FILE_ID_CACHE_TTL_DAYS = float(os.getenv('FILE_ID_CACHE_TTL_DAYS', '30'))
+
+# Перехват запросов при анализе страницы: какие типы ресурсов не загружать
+# (font, media, image, stylesheet...) и домены аналитики, запросы к которым обрываются.
+# URL заблокированных изображений и видео всё равно попадают в кандидаты
+BROWSER_BLOCK_RESOURCES = {x.strip() for x in os.getenv('BROWSER_BLOCK_RESOURCES', 'font,media').split(',') if x.strip()}
+BROWSER_BLOCK_DOMAINS = tuple(x.strip().lower() for x in os.getenv('BROWSER_BLOCK_DOMAINS', ','.join([
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'googlesyndication.com',
+    'adservice.google.com', 'mc.yandex.ru', 'mc.yandex.com', 'connect.facebook.net', 'hotjar.com',
+    'clarity.ms', 'analytics.tiktok.com', 'top-fwz1.mail.ru', 'mc.webvisor.org'
+])).split(',') if x.strip())
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.aac', '.ogg', '.oga', '.wav', '.flac')
+
+# Очередь заданий: число воркеров, размер очереди и лимит одновременных заданий на пользователя
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '3'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '50'))
+USER_MAX_INFLIGHT = int(os.getenv('USER_MAX_INFLIGHT', '2'))
+
+# Локальный HTTP-эндпоинт метрик в формате Prometheus (/metrics); METRICS_PORT=0 отключает сервер
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9101'))
+# Границы бакетов гистограмм длительности этапов, в секундах
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# Режим получения обновлений: polling (по умолчанию) или webhook. В режиме webhook бот слушает
+# WEBHOOK_HOST:PORT (PORT задаёт хостинг) и регистрирует у Telegram адрес WEBHOOK_URL + WEBHOOK_PATH;
+# на том же сервере отвечают /health и /metrics. WEBHOOK_SECRET проверяется в заголовке каждого запроса
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+PORT = int(os.getenv('PORT', '8080'))
+
+# Парсер HTML для извлечения картинок: auto (lxml, если установлен), lxml или html.parser
+HTML_PARSER = os.getenv('HTML_PARSER', 'auto')
+
+BROWSER_LAUNCH_ARGS = [
+    '--disable-blink-features=AutomationControlled',
+    '--no-sandbox',
+    '--disable-setuid-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-accelerated-2d-canvas',
+    '--no-first-run',
+    '--disable-gpu'
+]
+
+# Счетчик запросов
 request_count = 0
-user_activity = {}  # {user_id: [timestamp, ...]}
+
+# Реестр метрик в текстовом формате Prometheus: счётчики и гауги с метками, гистограммы
+# длительности этапов и показатели, которые вычисляются в момент запроса (глубина очереди и т.п.)
+class Metrics:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self._meta = {}  # {имя: (тип, описание)}
+        self._values = {}  # {(имя, метки): значение}
+        self._histograms = {}  # {(имя, метки): [счётчики бакетов..., сумма, количество]}
+        self._callbacks = []  # [(имя, функция без аргументов)]
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._values[key] = self._values.get(key, 0) + value
+
+    # Изменение гауги на delta (байты в полёте и т.п.)
+    def add(self, name: str, delta: float, **labels):
+        self.inc(name, delta, **labels)
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    def register_callback(self, name: str, kind: str, help_text: str, func):
+        self.describe(name, kind, help_text)
+        self._callbacks.append((name, func))
+
+    # Замер этапа конвейера: длительность в bot_stage_duration_seconds, исключения — в bot_stage_errors_total
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc('bot_stage_errors_total', stage=name, type=type(e).__name__)
+            raise
+        finally:
+            self.observe('bot_stage_duration_seconds', time.perf_counter() - started, stage=name)
+
+    @staticmethod
+    def _number(value: float) -> str:
+        value = float(value)
+        return str(int(value)) if value.is_integer() else repr(value)
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        def escape(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in items) + '}'
+
+    def render(self) -> str:
+        samples = {}  # {имя: [строки]}
+        for (name, labels), value in self._values.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {self._number(value)}")
+        for (name, labels), hist in self._histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(self.buckets, hist):
+                lines.append(f"{name}_bucket{self._labels(labels, (('le', f'{bound:g}'),))} {count}")
+            lines.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {hist[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {self._number(hist[-2])}")
+            lines.append(f"{name}_count{self._labels(labels)} {hist[-1]}")
+        for name, func in self._callbacks:
+            try:
+                samples.setdefault(name, []).append(f"{name} {self._number(func())}")
+            except Exception as e:
+                logging.error(f"Ошибка вычисления метрики {name}: {e}")
+        out = []
+        for name in sorted(samples):
+            kind, help_text = self._meta.get(name, ('untyped', ''))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(sorted(samples[name]) if kind != 'histogram' else samples[name])
+        return '\n'.join(out) + '\n'
+
+metrics = Metrics(METRICS_BUCKETS)
+metrics.describe('bot_stage_duration_seconds', 'histogram',
+                 'Длительность этапов: browser_launch, page_render, probe, download, convert, telegram_upload')
+metrics.describe('bot_stage_errors_total', 'counter', 'Ошибки этапов по типу исключения')
+metrics.describe('bot_download_errors_total', 'counter', 'Ошибки скачивания по причине')
+metrics.describe('bot_download_bytes_total', 'counter', 'Скачано байт')
+metrics.describe('bot_download_bytes_in_flight', 'gauge', 'Байт в незавершённых скачиваниях')
+metrics.describe('bot_startup_seconds', 'gauge', 'Время запуска по этапам (phase="total" — до приёма обновлений)')
+
+# Возраст процесса в секундах (Linux: /proc), иначе — время с начала загрузки модуля
+def process_uptime() -> float:
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return time.monotonic() - MODULE_LOADED_AT
+
+# Время запуска по этапам: от старта процесса до первого getUpdates (или готовности вебхука).
+# Отчёт пишется в лог и в гауги bot_startup_seconds{phase} один раз
+class StartupTimer:
+    def __init__(self):
+        self.marks = [('interpreter', MODULE_LOADED_AT), ('imports', IMPORTS_DONE_AT)]
+        self.reported = False
+
+    def mark(self, phase: str):
+        self.marks.append((phase, time.monotonic()))
+
+    def report(self, phase: str):
+        if self.reported:
+            return
+        self.reported = True
+        self.mark(phase)
+        # Монотонные отметки переводим в секунды с момента старта процесса
+        offset = process_uptime() - time.monotonic()
+        parts = []
+        previous = 0.0
+        for name, at in self.marks:
+            elapsed = max(0.0, at + offset - previous)
+            metrics.add('bot_startup_seconds', elapsed, phase=name)
+            parts.append(f"{name} {elapsed:.2f}")
+            previous += elapsed
+        metrics.add('bot_startup_seconds', previous, phase='total')
+        logging.info(f"Время запуска до {phase}: {previous:.2f} с ({', '.join(parts)})")
+
+startup_timer = StartupTimer()
+
+# Первый getUpdates означает, что бот снова принимает обновления, — фиксируем время запуска
+class StartupReportMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates) and not startup_timer.reported:
+            startup_timer.report('getUpdates')
+        return await make_request(bot, method)
+
+bot.session.middleware(StartupReportMiddleware())
+
+# HTTP-обработчик /metrics
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+# HTTP-обработчик /health: 503, если очередь заданий заполнена (балансировщик снимет нагрузку)
+async def health_handler(request: web.Request) -> web.Response:
+    overloaded = job_queue.depth() >= JOB_QUEUE_SIZE
+    return web.json_response({
+        'status': 'overloaded' if overloaded else 'ok',
+        'mode': BOT_MODE,
+        'queue': job_queue.depth(),
+        'workers_busy': job_queue.busy,
+    }, status=503 if overloaded else 200)
+
+# Служебное приложение: /health и /metrics (в режиме webhook сюда же добавляется обработчик обновлений)
+def build_service_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    return app
+
+metrics_runner: web.AppRunner | None = None
+
+# Отдельный сервер метрик нужен только в режиме polling: в режиме webhook маршруты уже на общем сервере
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT or BOT_MODE == 'webhook':
+        return
+    metrics_runner = web.AppRunner(build_service_app(), access_log=None)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# Точность скетчей HyperLogLog для счётчиков активных пользователей: 2^p регистров,
+# относительная ошибка ≈ 1.04 / sqrt(2^p) (p=12 — около 1.6%, 4 КБ на скетч)
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '12'))
+ACTIVITY_WRITE_INTERVAL = 300
+ACTIVITY_RETENTION_DAYS = 35
+ACTIVITY_HOUR_BUCKETS = 25
+ACTIVITY_DAY_BUCKETS = 31
+
+# Скетч HyperLogLog: оценка числа уникальных значений в фиксированной памяти, скетчи объединяются
+class HyperLogLog:
+    def __init__(self, precision: int, registers: bytes | None = None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(registers) if registers else bytearray(self.size)
+
+    def add(self, value) -> bool:
+        h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def merge(self, other: 'HyperLogLog'):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Поправка для малых значений (линейный подсчёт)
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+# Хранилище активности пользователей в SQLite: строка на пользователя (первый/последний визит)
+# и строка на пару (день, пользователь). Обновление O(1) и не чаще раза в ACTIVITY_WRITE_INTERVAL,
+# в памяти — только пользователи текущего дня. Без STATE_DB_PATH база живёт в памяти процесса.
+# Для админки поддерживаются почасовые и посуточные скетчи HyperLogLog: число активных за любое
+# окно до 30 дней считается слиянием не более 31 скетча, без обхода пользователей
+class ActivityStore:
+    def __init__(self, precision: int):
+        self.precision = precision
+        self.total_users = 0
+        self._db = None
+        self._day = None
+        self._last_write = {}  # {user_id: время последней записи} только за текущий день
+        self._sketches = {}  # {('h' | 'd', номер часа/дня): HyperLogLog}
+        self._dirty = set()
+
+    def load(self):
+        self._db = get_state_db() or sqlite3.connect(':memory:')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, first_seen REAL, last_seen REAL);
+            CREATE INDEX IF NOT EXISTS users_last_seen ON users (last_seen);
+            CREATE TABLE IF NOT EXISTS user_days (day INTEGER, user_id INTEGER, PRIMARY KEY (day, user_id)) WITHOUT ROWID;
+        ''')
+        self.total_users = self._db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        self._db.execute('CREATE TABLE IF NOT EXISTS activity_sketches (bucket TEXT PRIMARY KEY, precision INTEGER, registers BLOB)')
+        self._db.commit()
+        self._load_sketches()
+
+    def _load_sketches(self):
+        now = time.time()
+        hour, day = int(now // 3600), int(now // 86400)
+        self._sketches.clear()
+        for bucket, precision, registers in self._db.execute('SELECT bucket, precision, registers FROM activity_sketches'):
+            kind, index = bucket.split(':')
+            index = int(index)
+            fresh = index > hour - ACTIVITY_HOUR_BUCKETS if kind == 'h' else index > day - ACTIVITY_DAY_BUCKETS
+            if precision == self.precision and fresh:
+                self._sketches[(kind, index)] = HyperLogLog(precision, registers)
+        # Дни без скетча (первый запуск или смена точности) восстанавливаем из user_days
+        for d in range(day - ACTIVITY_DAY_BUCKETS + 1, day + 1):
+            if ('d', d) in self._sketches:
+                continue
+            rows = self._db.execute('SELECT user_id FROM user_days WHERE day = ?', (d,)).fetchall()
+            if rows:
+                sketch = self._sketch('d', d)
+                for (uid,) in rows:
+                    sketch.add(uid)
+        self.flush()
+
+    def _sketch(self, kind: str, index: int) -> HyperLogLog:
+        sketch = self._sketches.get((kind, index))
+        if sketch is None:
+            sketch = self._sketches[(kind, index)] = HyperLogLog(self.precision)
+        return sketch
+
+    def _prune_sketches(self, hour: int, day: int):
+        for key in list(self._sketches):
+            kind, index = key
+            if (kind == 'h' and index <= hour - ACTIVITY_HOUR_BUCKETS) or (kind == 'd' and index <= day - ACTIVITY_DAY_BUCKETS):
+                del self._sketches[key]
+                self._dirty.discard(key)
+                self._db.execute('DELETE FROM activity_sketches WHERE bucket = ?', (f"{kind}:{index}",))
+
+    # Запись изменённых скетчей в базу (периодически и при остановке)
+    def flush(self):
+        if self._db is None or not self._dirty:
+            return
+        try:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO activity_sketches (bucket, precision, registers) VALUES (?, ?, ?)',
+                [(f"{kind}:{index}", self.precision, bytes(self._sketches[(kind, index)].registers))
+                 for kind, index in self._dirty if (kind, index) in self._sketches]
+            )
+            self._db.commit()
+            self._dirty.clear()
+        except Exception as e:
+            logging.error(f"Ошибка сохранения счётчиков активности: {e}")
+
+    async def run_flush(self, interval: float = 60):
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    def update(self, user_id: int):
+        if self._db is None:
+            self.load()
+        now = time.time()
+        hour, day = int(now // 3600), int(now // 86400)
+        if day != self._day:
+            self._day = day
+            self._last_write.clear()
+            self._db.execute('DELETE FROM user_days WHERE day < ?', (day - ACTIVITY_RETENTION_DAYS,))
+            self._prune_sketches(hour, day)
+        for kind, index in (('h', hour), ('d', day)):
+            if self._sketch(kind, index).add(user_id):
+                self._dirty.add((kind, index))
+        if now - self._last_write.get(user_id, 0) < ACTIVITY_WRITE_INTERVAL:
+            return
+        self._last_write[user_id] = now
+        try:
+            cur = self._db.execute('INSERT OR IGNORE INTO users (user_id, first_seen, last_seen) VALUES (?, ?, ?)',
+                                   (user_id, now, now))
+            if cur.rowcount == 1:
+                self.total_users += 1
+            else:
+                self._db.execute('UPDATE users SET last_seen = ? WHERE user_id = ?', (now, user_id))
+            self._db.execute('INSERT OR IGNORE INTO user_days (day, user_id) VALUES (?, ?)', (day, user_id))
+            self._db.commit()
+        except Exception as e:
+            logging.error(f"Ошибка записи активности пользователя {user_id}: {e}")
+
+    # Оценка числа активных пользователей за последние seconds секунд (до 30 дней).
+    # Окна до суток считаются по часовым скетчам, длиннее — по суточным. Самый старый бакет, частично
+    # попавший в окно, учитывается целиком: окно может захватить лишнее (меньше бакета), но не недосчитать
+    def active_users(self, seconds: int) -> int:
+        if self._db is None:
+            self.load()
+        now = time.time()
+        if seconds <= 86400:
+            kind, width, current = 'h', 3600, int(now // 3600)
+        else:
+            kind, width, current = 'd', 86400, int(now // 86400)
+        first = int((now - seconds) // width)
+        merged = HyperLogLog(self.precision)
+        for index in range(first, current + 1):
+            sketch = self._sketches.get((kind, index))
+            if sketch is not None:
+                merged.merge(sketch)
+        return min(merged.count(), self.total_users)
+
+# Окна статистики для админ-панели: подпись → длительность в секундах
+ACTIVITY_WINDOWS = [('За час', 3600), ('За сутки', 86400), ('За неделю', 7 * 86400), ('За 30 дней', 30 * 86400)]
+
+activity_store = ActivityStore(HLL_PRECISION)
 
 # Обновление активности пользователя
 def update_user_activity(user_id: int):
-    current_time = time.time()
-    if user_id not in user_activity:
-        user_activity[user_id] = []
-    user_activity[user_id].append(current_time)
-    # Очистка старых меток (старше 7 дней)
-    user_activity[user_id] = [t for t in user_activity[user_id] if t > current_time - 604800]
-
-# Подсчёт пользователей
+    activity_store.update(user_id)
+
+# Подсчёт пользователей: [(подпись окна, активных)], всего пользователей
 def get_user_stats():
-    now = time.time()
-    daily_users = set()
-    weekly_users = set()
-    total_users = set()
-    
-    for user_id, timestamps in user_activity.items():
-        total_users.add(user_id)
-        for t in timestamps:
-            if t > now - 86400:  # 24 часа
-                daily_users.add(user_id)
-            if t > now - 604800:  # 7 дней
-                weekly_users.add(user_id)
-    
-    return len(daily_users), len(weekly_users), len(total_users)
+    windows = [(label, activity_store.active_users(seconds)) for label, seconds in ACTIVITY_WINDOWS]
+    return windows, activity_store.total_users
 
 # Меню админ-панели
 def get_admin_menu():
@@ -79,63 +547,745 @@ def get_admin_menu():
     ])
     return keyboard
 
-# Попытка скачать изображение в альтернативном формате (например, вместо .webp — .jpg/.jpeg/.png)
-async def fetch_alt_image_format(session: aiohttp.ClientSession, url: str) -> BytesIO | None:
+# Общая для процесса HTTP-сессия: TLS-соединения к CDN переиспользуются между запросами
+http_session: aiohttp.ClientSession | None = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            enable_cleanup_closed=True
+        )
+        # Сессия общая для всех пользователей: cookie не сохраняем, чтобы состояние сайтов не переходило между запросами
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=300, connect=30),
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# Подключение к локальной SQLite-базе состояния (None, если хранение на диске отключено)
+state_db: sqlite3.Connection | None = None
+
+def get_state_db() -> sqlite3.Connection | None:
+    global state_db
+    if state_db is None and STATE_DB_PATH:
+        try:
+            state_db = sqlite3.connect(STATE_DB_PATH)
+            state_db.execute('PRAGMA journal_mode=WAL')
+            state_db.execute('PRAGMA synchronous=NORMAL')
+        except Exception as e:
+            logging.error(f"Не удалось открыть базу состояния {STATE_DB_PATH}: {e}")
+            state_db = None
+    return state_db
+
+def close_state_db():
+    global state_db
+    if state_db is not None:
+        try:
+            state_db.close()
+        except Exception:
+            pass
+        state_db = None
+
+# Суммарный RSS (МБ) процесса бота и всех его потомков (драйвер Playwright, Chromium)
+def get_process_tree_rss_mb() -> float:
     try:
-        lu = (url or '').lower()
-        if not lu.endswith('.webp'):
-            return None
-        for ext in ('.jpg', '.jpeg', '.png'):
-            alt = url[:-5] + ext  # заменяем суффикс .webp
+        children = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
             try:
-                async with session.get(alt, timeout=15) as resp:
-                    ctype = (resp.headers.get('content-type') or '').lower()
-                    if resp.status == 200 and (ctype.startswith('image/jpeg') or ctype.startswith('image/png')):
-                        data = await resp.read()
-                        if data:
-                            return BytesIO(data)
-            except Exception:
+                with open(f'/proc/{name}/stat') as f:
+                    stat = f.read()
+            except OSError:
                 continue
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(name))
+        pages = 0
+        stack = [os.getpid()]
+        while stack:
+            pid = stack.pop()
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    pages += int(f.read().split()[1])
+            except OSError:
+                pass
+            stack.extend(children.get(pid, []))
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
     except Exception:
-        return None
-    return None
+        return 0.0
+
+# Общий для всего процесса браузер: выдаёт BrowserContext из ограниченного пула,
+# перезапускает Chromium после BROWSER_RECYCLE_PAGES страниц, при превышении RSS или после падения.
+# Для основных параметров (configure) держит prewarm готовых контекстов и дозаполняет их в фоне.
+# Каждый готовый контекст занимает слот пула: открытых контекстов всегда не больше max_contexts
+class BrowserManager:
+    def __init__(self, max_contexts: int, recycle_pages: int, max_rss_mb: int, prewarm: int = 0):
+        self.max_contexts = max_contexts
+        self.recycle_pages = recycle_pages
+        self.max_rss_mb = max_rss_mb
+        self.prewarm = prewarm
+        self.launch_count = 0
+        self.warm_hits = 0
+        self._playwright = None
+        self._browser = None
+        self._pages_served = 0
+        self._active = {}  # {browser: число открытых контекстов, включая готовые}
+        self._ready = []  # [(browser, context)] — заранее подготовленные контексты
+        self._warm_options = None
+        self._warm_setup = None
+        self._refill_task = None
+        self._waiting = 0  # запросов ждут свободный слот пула
+        self._semaphore = asyncio.Semaphore(max_contexts)
+        self._lock = asyncio.Lock()
+
+    # Параметры контекста и его подготовка (заголовки, init-скрипты, пустая страница) для заранее создаваемых
+    # контекстов; контексты с теми же параметрами, созданные по запросу, готовятся так же
+    def configure(self, options: dict, setup):
+        self._warm_options = options
+        self._warm_setup = setup
+
+    def ready_count(self) -> int:
+        return len(self._ready)
+
+    async def start(self):
+        async with self._lock:
+            await self._ensure_browser()
+        self._schedule_refill()
+        if self._refill_task is not None:
+            await self._refill_task
+
+    async def stop(self):
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+        async with self._lock:
+            await self._drop_ready()
+            for browser in list(self._active):
+                await self._close_browser(browser)
+            self._browser = None
+            if self._playwright is not None:
+                try:
+                    await self._playwright.stop()
+                except Exception as e:
+                    logging.error(f"Ошибка остановки Playwright: {e}")
+                self._playwright = None
 
-# Отправка списка URL с фото (фильтрация, скачивание, конвертация, батчи)
-async def process_media_urls(message: Message, urls: list[str], loading_msg: Message, source_hint: str = ""):
+    async def _launch(self):
+        if self._playwright is None:
+            from playwright.async_api import async_playwright
+            self._playwright = await async_playwright().start()
+        try:
+            with metrics.stage('browser_launch'):
+                browser = await self._playwright.chromium.launch(headless=True, args=BROWSER_LAUNCH_ARGS)
+        except Exception:
+            # Драйвер мог умереть вместе с браузером — поднимем его заново при следующей попытке
+            try:
+                await self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+            raise
+        browser.on('disconnected', lambda _: logging.warning("Браузер Chromium отключился"))
+        self._active[browser] = 0
+        self._pages_served = 0
+        self.launch_count += 1
+        logging.info(f"Запущен браузер Chromium (запуск №{self.launch_count})")
+        return browser
+
+    async def _ensure_browser(self):
+        if self._browser is not None and self._browser.is_connected():
+            return self._browser
+        if self._browser is not None:
+            logging.warning("Браузер упал, перезапускаем")
+            # Готовые контексты умерли вместе с браузером
+            await self._drop_ready(self._browser)
+            self._active.pop(self._browser, None)
+        self._browser = await self._launch()
+        return self._browser
+
+    async def _close_browser(self, browser):
+        self._active.pop(browser, None)
+        try:
+            await browser.close()
+        except Exception as e:
+            logging.error(f"Ошибка закрытия браузера: {e}")
+
+    # Закрытие неиспользованных готовых контекстов (всех или одного браузера) с возвратом их слотов; вызывается под _lock
+    async def _drop_ready(self, browser=None):
+        keep = []
+        for item in self._ready:
+            if browser is not None and item[0] is not browser:
+                keep.append(item)
+                continue
+            try:
+                await item[1].close()
+            except Exception:
+                pass
+            if item[0] in self._active:
+                self._active[item[0]] -= 1
+            self._semaphore.release()
+        self._ready = keep
+
+    # Текущий браузер больше не выдаётся; закрываем его, когда освободится последний контекст
+    async def _retire_current(self, reason: str):
+        browser = self._browser
+        if browser is None:
+            return
+        logging.info(f"Перезапуск браузера: {reason}")
+        self._browser = None
+        await self._drop_ready(browser)
+        if self._active.get(browser, 0) <= 0:
+            await self._close_browser(browser)
+
+    async def _release(self, browser):
+        rss_mb = await asyncio.to_thread(get_process_tree_rss_mb) if self.max_rss_mb else 0.0
+        async with self._lock:
+            if browser in self._active:
+                self._active[browser] -= 1
+            if browser is not self._browser or not browser.is_connected():
+                if self._active.get(browser, 0) <= 0:
+                    await self._close_browser(browser)
+            elif self.max_rss_mb and rss_mb > self.max_rss_mb:
+                await self._retire_current(f"RSS {rss_mb:.0f} МБ > {self.max_rss_mb} МБ")
+
+    async def _new_context(self, browser, options: dict):
+        context = await browser.new_context(**options)
+        if self._warm_setup is not None and options == self._warm_options:
+            try:
+                await self._warm_setup(context)
+            except Exception:
+                await context.close()
+                raise
+        return context
+
+    # Браузер ради прогрева не запускается: после stop() и перезапуска по лимиту — только при следующем запросе
+    def _schedule_refill(self):
+        if self.prewarm <= 0 or self._warm_options is None or self._browser is None:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    # Дозаполнение готовых контекстов до prewarm (фоновая задача, одна на менеджер).
+    # Слот берётся только свободный и только если никто не ждёт: запросы важнее прогрева
+    async def _refill(self):
+        while len(self._ready) < self.prewarm:
+            if self._waiting or self._semaphore.locked():
+                return
+            await self._semaphore.acquire()
+            try:
+                async with self._lock:
+                    browser = await self._ensure_browser()
+                    self._active[browser] += 1
+            except Exception as e:
+                self._semaphore.release()
+                logging.error(f"Не удалось запустить браузер для готовых контекстов: {e}")
+                return
+            try:
+                context = await self._new_context(browser, self._warm_options)
+            except Exception as e:
+                logging.error(f"Не удалось подготовить контекст браузера: {e}")
+                await self._release(browser)
+                self._semaphore.release()
+                return
+            async with self._lock:
+                current = browser is self._browser and browser.is_connected()
+                if current:
+                    self._ready.append((browser, context))
+                    # Пока готовили контекст, появились ожидающие — отдаём слот им
+                    if self._waiting:
+                        await self._drop_ready()
+            if not current:
+                # Браузер сменился, пока готовили контекст
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+                await self._release(browser)
+                self._semaphore.release()
+
+    # Слот пула для нового контекста. Если все слоты заняты и часть из них держат готовые контексты
+    # (этому запросу они не достались), готовые закрываются и их слоты освобождаются
+    async def _acquire_slot(self):
+        self._waiting += 1
+        try:
+            if self._semaphore.locked() and self._ready:
+                async with self._lock:
+                    await self._drop_ready()
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+    @asynccontextmanager
+    async def context(self, **options):
+        context = None
+        async with self._lock:
+            browser = await self._ensure_browser()
+            if self._ready and options == self._warm_options:
+                # Готовый контекст переходит запросу вместе со своим слотом пула
+                _, context = self._ready.pop(0)
+                self.warm_hits += 1
+        if context is None:
+            await self._acquire_slot()
+            try:
+                async with self._lock:
+                    browser = await self._ensure_browser()
+                    self._active[browser] += 1
+            except BaseException:
+                self._semaphore.release()
+                raise
+        try:
+            async with self._lock:
+                self._pages_served += 1
+                if self.recycle_pages and self._pages_served >= self.recycle_pages:
+                    await self._retire_current(f"обслужено {self._pages_served} страниц")
+            self._schedule_refill()
+            if context is None:
+                context = await self._new_context(browser, options)
+            yield context
+        finally:
+            if context is not None:
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+            await self._release(browser)
+            self._semaphore.release()
+            self._schedule_refill()
+
+browser_manager = BrowserManager(BROWSER_MAX_CONTEXTS, BROWSER_RECYCLE_PAGES, BROWSER_MAX_RSS_MB, BROWSER_PREWARM_CONTEXTS)
+
+# Выбор формата до скачивания: для .webp ищем JPEG/PNG-вариант рядом (.jpg/.jpeg/.png) параллельными HEAD.
+# Результат запоминается для пары (хост, шаблон пути): у CDN все фото одного вида лежат одинаково,
+# поэтому следующие фото альбома сразу качаются в нужном формате, без проверок.
+# Ответ с сетевой ошибкой не запоминается; «варианта нет» хранится VARIANT_MISS_TTL, найденный — VARIANT_CACHE_TTL
+ALT_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+class ImageVariantResolver:
+    def __init__(self, max_size: int = 2000):
+        self.max_size = max_size
+        self._known = OrderedDict()  # {(хост, шаблон пути): (расширение варианта | '' — варианта нет, время)}
+        self._pending = {}  # {(хост, шаблон пути): Future} — проверка уже идёт
+
+    @staticmethod
+    def pattern_key(url: str) -> tuple:
+        parts = urlsplit(url)
+        directory = parts.path.rsplit('/', 1)[0]
+        return (parts.netloc.lower(), re.sub(r'\d+', '#', directory))
+
+    # None — сетевая ошибка (ответа нет, наличие варианта неизвестно)
+    @staticmethod
+    async def _has_variant(session: aiohttp.ClientSession, url: str) -> bool | None:
+        try:
+            async with session.head(url, allow_redirects=True, timeout=10) as resp:
+                ctype = (resp.headers.get('content-type') or '').lower()
+                return resp.status == 200 and ctype.startswith(('image/jpeg', 'image/png'))
+        except Exception:
+            return None
+
+    # Расширение найденного варианта, '' — вариантов нет, None — проверить не удалось
+    async def _probe(self, session: aiohttp.ClientSession, url: str) -> str | None:
+        results = await asyncio.gather(*(self._has_variant(session, url[:-5] + ext) for ext in ALT_IMAGE_EXTENSIONS))
+        found = next((ext for ext, ok in zip(ALT_IMAGE_EXTENSIONS, results) if ok), '')
+        if not found and None in results:
+            return None
+        return found
+
+    def _lookup(self, key: tuple) -> str | None:
+        entry = self._known.get(key)
+        if entry is None:
+            return None
+        ext, stored_at = entry
+        if time.time() - stored_at >= (VARIANT_CACHE_TTL if ext else VARIANT_MISS_TTL):
+            del self._known[key]
+            return None
+        self._known.move_to_end(key)
+        return ext
+
+    # URL, который стоит скачать: JPEG/PNG-вариант, если он есть, иначе исходный
+    async def resolve(self, session: aiohttp.ClientSession, url: str) -> str:
+        if not (url or '').lower().endswith('.webp'):
+            return url
+        key = self.pattern_key(url)
+        ext = self._lookup(key)
+        if ext is None:
+            pending = self._pending.get(key)
+            if pending is not None:
+                ext = await asyncio.shield(pending)
+            else:
+                future = self._pending[key] = asyncio.get_running_loop().create_future()
+                try:
+                    ext = await self._probe(session, url)
+                finally:
+                    self._pending.pop(key, None)
+                    # Если проверку отменили или она не удалась, ожидающие качают исходный файл
+                    future.set_result(ext or '')
+                if ext is not None:
+                    self._known[key] = (ext, time.time())
+                    while len(self._known) > self.max_size:
+                        self._known.popitem(last=False)
+        return url[:-5] + ext if ext else url
+
+    # Вариант не скачался — для этого шаблона проверим заново в следующий раз
+    def forget(self, url: str):
+        self._known.pop(self.pattern_key(url), None)
+
+image_variants = ImageVariantResolver()
+
+# Конвертация изображения в JPEG (Telegram не принимает webp как фото).
+# Выполняется в пуле потоков/процессов, поэтому функция модульная и принимает/возвращает байты
+def convert_image_to_jpeg(data: bytes) -> bytes:
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    # Если анимированное изображение, берём первый кадр
     try:
-        # Спец-фильтрация для easyhata
-        photo_urls = []
+        if getattr(img, 'is_animated', False):
+            img.seek(0)
+    except Exception:
+        pass
+    if img.mode in ('RGBA', 'P'):
+        img = img.convert('RGB')
+    buf = BytesIO()
+    img.save(buf, format='JPEG', quality=90)
+    return buf.getvalue()
+
+# Пул конвертации изображений вне event loop: в очередь принимается не больше queue_size задач,
+# в пул уходит не больше workers — остальные ждут в очереди (waiting), а не во внутренней очереди пула,
+# поэтому время конвертации не включает ожидание свободного воркера
+class ImageConverter:
+    def __init__(self, kind: str, workers: int, queue_size: int):
+        self.kind = kind
+        self.workers = workers
+        self.waiting = 0
+        self.running = 0
+        self.converted = 0
+        self.failed = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self._executor = None
+        self._slots = asyncio.Semaphore(max(queue_size, workers))
+        self._workers = asyncio.Semaphore(workers)
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='convert')
+        return self._executor
+
+    async def convert(self, data: bytes) -> bytes:
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+            try:
+                await self._workers.acquire()
+            except BaseException:
+                self._slots.release()
+                raise
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self._get_executor(), convert_image_to_jpeg, data)
+        except Exception as e:
+            self.failed += 1
+            metrics.inc('bot_stage_errors_total', stage='convert', type=type(e).__name__)
+            raise
+        finally:
+            self.running -= 1
+            self._workers.release()
+            self._slots.release()
+        elapsed = time.perf_counter() - started
+        metrics.observe('bot_stage_duration_seconds', elapsed, stage='convert')
+        self.converted += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        logging.info(f"Конвертация в JPEG: {elapsed * 1000:.0f} мс ({len(data) / 1024:.0f} КБ → {len(result) / 1024:.0f} КБ)")
+        return result
+
+    def stats_text(self) -> str:
+        avg_ms = self.total_time / self.converted * 1000 if self.converted else 0.0
+        return (f"Конвертация ({self.kind}, воркеров: {self.workers}): в очереди {self.waiting}, "
+                f"в работе {self.running}, готово {self.converted}, ошибок {self.failed}, "
+                f"среднее {avg_ms:.0f} мс, макс. {self.max_time * 1000:.0f} мс")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+image_converter = ImageConverter(CONVERT_EXECUTOR, CONVERT_WORKERS, CONVERT_QUEUE_SIZE)
+
+# Лимиты параллельного скачивания: общий семафор и семафоры по хостам (LRU, только свободные вытесняются)
+download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+# Семафор хоста со счётчиком тех, кто его держит или ждёт: по счётчику видно, можно ли удалить лимит из реестра
+class HostLimit:
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.users = 0
+
+    async def __aenter__(self):
+        self.users += 1
+        try:
+            await self.semaphore.acquire()
+        except BaseException:
+            self.users -= 1
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.semaphore.release()
+        self.users -= 1
+
+host_semaphores: OrderedDict[str, HostLimit] = OrderedDict()
+
+def get_host_semaphore(url: str) -> HostLimit:
+    host = (urlparse(url).netloc or '').lower()
+    limit = host_semaphores.get(host)
+    if limit is not None:
+        host_semaphores.move_to_end(host)
+        return limit
+    limit = host_semaphores[host] = HostLimit(DOWNLOAD_PER_HOST)
+    if len(host_semaphores) > HOST_SEMAPHORES_MAX:
+        # Лимит, который сейчас кто-то держит или ждёт, удалять нельзя — он перестал бы действовать
+        for idle_host in [h for h, other in host_semaphores.items() if other.users == 0 and h != host]:
+            del host_semaphores[idle_host]
+            if len(host_semaphores) <= HOST_SEMAPHORES_MAX:
+                break
+    return limit
+
+# Индикатор прогресса: сообщение отправляется и правится фоновой задачей не чаще PROGRESS_EDIT_INTERVAL,
+# конвейер только меняет этап/счётчик и не ждёт Telegram. Совместим с сообщением о загрузке
+# (edit_text, delete) — delete останавливает задачу и убирает сообщение
+class ProgressReporter:
+    def __init__(self, message: Message, text: str = "Загрузка контента... ⏳", interval: float = PROGRESS_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._stage = text
+        self._done = 0
+        self._total = 0
+        self._shown = None
+        self._sent = None
+        self._task = None
+        self._changed = asyncio.Event()
+
+    def start(self) -> 'ProgressReporter':
+        self._sent = asyncio.create_task(self._send())
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def _send(self) -> Message:
+        return await self.message.reply(self.render())
+
+    def render(self) -> str:
+        if self._total:
+            return f"{self._stage} {self._done}/{self._total}"
+        return self._stage
+
+    def stage(self, text: str, total: int = 0):
+        self._stage, self._done, self._total = text, 0, total
+        self._changed.set()
+
+    def progress(self, done: int, total: int | None = None):
+        self._done = done
+        if total is not None:
+            self._total = total
+        self._changed.set()
+
+    def advance(self, step: int = 1):
+        self.progress(self._done + step)
+
+    async def _run(self):
+        try:
+            await self._sent
+            self._shown = self.render()
+            last_edit = time.monotonic()
+            while True:
+                await self._changed.wait()
+                # Копим изменения до истечения интервала и показываем только последнее состояние
+                await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - last_edit)))
+                self._changed.clear()
+                text = self.render()
+                if text == self._shown:
+                    continue
+                try:
+                    await self._sent.result().edit_text(text)
+                    self._shown = text
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+                    self._changed.set()
+                except Exception as e:
+                    logging.error(f"Ошибка при обновлении прогресса: {str(e)}")
+                last_edit = time.monotonic()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Ошибка индикатора прогресса: {str(e)}")
+
+    async def delete(self):
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
         try:
-            parsed = urlparse(source_hint or "")
-            host = (parsed.netloc or '').lower()
-            obj_id = None
-            m = re.search(r"/flats/(\d+)/", parsed.path or '')
-            if m:
-                obj_id = m.group(1)
-            def is_target(u: str) -> bool:
-                lu = (u or '').lower()
-                if any(x in lu for x in ['.svg', 'favicon.ico', '/avatar/']):
-                    return False
-                if (('easybase.b-cdn.net' in lu and '/realty/' in lu) or ('api.easybase.com.ua' in lu and '/media/realty/' in lu)):
-                    if obj_id and f"/{obj_id}/" in lu:
-                        return True
-                    return True
-                return True  # не ограничиваем для других доменов
-            if 'easyhata.site' in host:
-                urls = [u for u in urls if is_target(u)]
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Сообщение могло ещё отправляться — дожидаемся, чтобы не оставить его в чате
+        try:
+            sent = await self._sent
+            await sent.delete()
         except Exception:
             pass
 
+# Скачивание одного фото в пределах лимитов: сразу в лучшем формате (JPEG/PNG-вариант, если он есть)
+async def fetch_photo(session: aiohttp.ClientSession, url: str) -> tuple:
+    async with download_semaphore, get_host_semaphore(url):
+        target = await image_variants.resolve(session, url)
+        with metrics.stage('download'):
+            photo_data, error = await download_media(target, session)
+        if not photo_data and target != url:
+            # Вариант по запомненному шаблону не нашёлся — качаем исходный файл
+            image_variants.forget(url)
+            with metrics.stage('download'):
+                photo_data, error = await download_media(url, session)
+        if not photo_data:
+            return None, error
+        if photo_data.getbuffer().nbytes <= 0:
+            return None, "Фото имеет нулевой размер"
+        return photo_data, None
+
+# Подготовка одного фото альбома: из кэша file_id, иначе скачивание и конвертация в JPEG.
+# Возвращает (InputMediaPhoto | None, источник (url, sha256 | None) | None); ошибки логируются
+async def prepare_photo(session: aiohttp.ClientSession, i: int, url: str) -> tuple:
+    cached = file_id_cache.get(file_id_cache.url_key(url))
+    if cached:
+        return InputMediaPhoto(media=cached[1]), (url, None)
+    try:
+        photo_data, error = await fetch_photo(session, url)
+    except Exception as e:
+        photo_data, error = None, str(e)
+    if not photo_data:
+        logging.error(f"Ошибка при обработке фото {i}: {error}")
+        return None, None
+    try:
+        raw = photo_data.getvalue()
+        del photo_data
+        digest = hashlib.sha256(raw).hexdigest()
+        # То же содержимое уже отправлялось под другим URL
+        by_hash = file_id_cache.get(file_id_cache.hash_key(digest))
+        if by_hash:
+            return InputMediaPhoto(media=by_hash[1]), (url, None)
+        # По умолчанию конвертируем в JPEG (независимо от исходного формата)
+        if not PIL_AVAILABLE:
+            # Если PIL не доступен, пропускаем фото
+            logging.error(f"PIL не доступен, пропускаем фото {i}")
+            return None, None
+        jpeg = await image_converter.convert(raw)
+        logging.info(f"Успешно подготовлено фото {i} (конвертировано в JPEG)")
+        return InputMediaPhoto(media=BufferedInputFile(jpeg, filename=f"photo_{i}.jpg")), (url, digest)
+    except Exception as ce:
+        # Пропускаем фото, если не удалось конвертировать
+        logging.error(f"Конвертация в JPEG не удалась для фото {i} ({url}): {ce}")
+        return None, None
+
+# Фото альбома по порядку: подготовка идёт параллельно, но не дальше ALBUM_PREFETCH фото вперёд
+# от того, что уже забрал получатель, — медленное фото задерживает только свой альбом.
+# on_ready вызывается при завершении подготовки каждого фото (в любом порядке)
+async def iter_photo_media(photo_urls: list[str], on_ready=None):
+    session = get_http_session()
+    tasks = {}
+    next_index = 0
+    try:
+        for i in range(len(photo_urls)):
+            while next_index < len(photo_urls) and next_index < i + max(1, ALBUM_PREFETCH):
+                task = asyncio.create_task(prepare_photo(session, next_index + 1, photo_urls[next_index]))
+                if on_ready is not None:
+                    task.add_done_callback(lambda _: on_ready())
+                tasks[next_index] = task
+                next_index += 1
+            yield await tasks.pop(i)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+# Потоковая доставка фото: каждые 10 готовых (по порядку) сразу уходят альбомом, их буферы освобождаются.
+# Индикатор прогресса показывает готовые фото k/N и убирается перед последней отправкой;
+# single_kwargs (подпись, клавиатура) — для ответа из единственного фото. Возвращает (подготовлено, отправлено, ошибок)
+async def deliver_photos(message: Message, photo_urls: list[str], progress: ProgressReporter | None = None,
+                         single_kwargs: dict | None = None) -> tuple:
+    batch, sources = [], []
+    prepared = sent = errors = 0
+    if progress is not None:
+        progress.stage("📥 Скачиваю фото", total=len(photo_urls))
+
+    async def flush(final: bool):
+        nonlocal sent
+        if sent:
+            await asyncio.sleep(ALBUM_BATCH_DELAY)
+        kwargs = (single_kwargs or {}) if final and not sent and len(batch) == 1 else {}
+        try:
+            await send_photo_batch(message, batch, sources, **kwargs)
+            sent += len(batch)
+        except Exception as e:
+            logging.error(f"Ошибка отправки альбома ({len(batch)} фото): {e}")
+        batch.clear()
+        sources.clear()
+
+    async for item, source in iter_photo_media(photo_urls, progress.advance if progress is not None else None):
+        if item is None:
+            errors += 1
+            continue
+        prepared += 1
+        batch.append(item)
+        sources.append(source)
+        if len(batch) == 10:
+            await flush(final=False)
+    if progress is not None:
+        await progress.delete()
+    if batch:
+        await flush(final=True)
+    return prepared, sent, errors
+
+# Отправка партии фото (альбомом или одиночным фото) с запоминанием полученных file_id.
+# photo_kwargs (подпись, клавиатура) применяются только к одиночному фото
+async def send_photo_batch(message: Message, media: list, sources: list, **photo_kwargs):
+    try:
+        with metrics.stage('telegram_upload'):
+            if len(media) == 1:
+                sent = [await message.reply_photo(photo=media[0].media, **photo_kwargs)]
+            else:
+                sent = await message.reply_media_group(media)
+    except Exception:
+        file_id_cache.forget_photos(sources)
+        raise
+    file_id_cache.remember_photos(sources, sent)
+
+# Отправка списка URL с фото (фильтрация, скачивание, конвертация, батчи)
+async def process_media_urls(message: Message, urls: list[str], loading_msg: ProgressReporter, source_hint: str = ""):
+    try:
+        # Для известных сайтов оставляем только фото объекта
+        adapter = get_site_adapter(source_hint)
+        if adapter is not None:
+            urls = adapter.filter_images(urls, source_hint)
+
         # Проверка изображений (мягкая)
-        async with aiohttp.ClientSession() as session:
-            for u in urls:
-                lu = u.lower()
-                if ((('easybase.b-cdn.net' in lu and '/realty/' in lu) or ('api.easybase.com.ua' in lu and '/media/realty/' in lu))
-                    and not any(x in lu for x in ['.svg', 'favicon.ico', '/avatar/'])):
-                    photo_urls.append(u)
-                    continue
-                if get_media_type(u) == 'photo' or await is_image_url(session, u):
-                    photo_urls.append(u)
+        loading_msg.stage("🔍 Проверяю изображения...")
+        photo_urls = await select_photo_urls(get_http_session(), urls)
 
         if not photo_urls:
             if loading_msg:
@@ -146,121 +1296,603 @@ async def process_media_urls(message: Message, urls: list[str], loading_msg: Mes
             await message.reply("Не удалось найти фотографии. 🚫", reply_markup=get_main_menu())
             return
 
-        media: list[InputMediaPhoto] = []
-        async with aiohttp.ClientSession() as session:
-            for i, url in enumerate(photo_urls, 1):
-                photo_data, error = await download_media(url, session)
-                if not photo_data:
-                    continue
-                if photo_data.getbuffer().nbytes <= 0:
-                    continue
-                # По умолчанию пытаемся конвертировать в JPEG (независимо от исходного формата)
-                # Сначала пробуем достать альтернативный JPEG/PNG напрямую с CDN
-                try:
-                    alt_buf = await fetch_alt_image_format(session, url)
-                    if alt_buf is not None:
-                        photo_data = alt_buf
-                except Exception:
-                    pass
-                if PIL_AVAILABLE:
-                    try:
-                        photo_data.seek(0)
-                        img = Image.open(photo_data)
-                        # Если анимированное изображение, берём первый кадр
-                        try:
-                            if getattr(img, 'is_animated', False):
-                                img.seek(0)
-                        except Exception:
-                            pass
-                        if img.mode in ('RGBA', 'P'):
-                            img = img.convert('RGB')
-                        buf = BytesIO()
-                        img.save(buf, format='JPEG', quality=90)
-                        buf.seek(0)
-                        media.append(InputMediaPhoto(media=BufferedInputFile(buf.getvalue(), filename=f"photo_{i}.jpg")))
-                        continue
-                    except Exception as ce:
-                        logging.error(f"Не удалось сконвертировать в JPEG {url}: {ce}")
-                        # Пропускаем фото, если не удалось конвертировать
-                else:
-                    # Если PIL не доступен, пропускаем фото
-                    logging.error(f"PIL не доступен, пропускаем фото {i}")
+        await deliver_photos(message, photo_urls, loading_msg, {'reply_markup': get_main_menu()})
+    except Exception as e:
+        logging.error(f"Ошибка process_media_urls: {e}")
+
+# Результат анализа страницы: найденное видео и кандидаты-изображения (основное фото первым)
+@dataclass
+class PageAnalysis:
+    video_url: str = ""
+    image_urls: list = field(default_factory=list)
+    partial: bool = False  # навигация не завершилась — собрано то, что успело загрузиться
+
+# Однопроходный сканер ссылок на медиа в HTML/скриптах: прямые URL, а также URL с экранированными
+# слешами (\u002F из состояния Nuxt, \/ из JSON) находятся одним регулярным выражением и сразу декодируются
+MEDIA_URL_RE = re.compile(
+    r"https?:(?://|\\/\\/|\\u002F\\u002F)[^\s'\"<>]+\.(jpe?g|png|webp|gif|bmp|mp4|webm|mov|avi|mkv|m3u8)",
+    re.IGNORECASE
+)
+EXCLUDED_URL_MARKERS = ('.svg', 'favicon.ico', '/avatar/')
+
+# Результат сканирования: URL по классам в порядке первого появления, без дублей.
+# images — все изображения (включая targets), targets — изображения, прошедшие фильтр is_target (фото объекта)
+@dataclass
+class ScannedUrls:
+    targets: list = field(default_factory=list)
+    images: list = field(default_factory=list)
+    videos: list = field(default_factory=list)
+
+def scan_media_urls(text: str, is_target=None) -> ScannedUrls:
+    result = ScannedUrls()
+    seen = set()
+    for m in MEDIA_URL_RE.finditer(text):
+        found = m.group(0)
+        if '\\' in found:
+            found = found.replace('\\u002F', '/').replace('\\u002f', '/').replace('\\/', '/')
+        if found in seen:
+            continue
+        seen.add(found)
+        if m.group(1).lower() in ('mp4', 'webm', 'mov', 'avi', 'mkv', 'm3u8'):
+            result.videos.append(found)
+            continue
+        result.images.append(found)
+        if is_target is not None and is_target(found):
+            result.targets.append(found)
+    return result
+
+# Адаптер сайта: где лежат фото объекта и когда можно обойтись без Playwright. Стратегии идут
+# от дешёвой к дорогой: JSON API → данные, встроенные в HTML → ранний сбор после загрузки страницы
+# (JS-выражение и CSS-селекторы галереи) → полный рендер. Новый сайт — новая запись в реестре
+@dataclass
+class SiteAdapter:
+    name: str
+    hosts: tuple  # домены страниц (поддомены тоже)
+    image_hosts: tuple = ()  # пары (хост CDN, фрагмент пути), по которым узнаются фото объектов
+    object_id_pattern: str = ''  # регулярка с группой id объекта в пути страницы
+    api_url: str = ''  # шаблон JSON API с {scheme}, {host} и {id}
+    embedded_payload: bool = False  # фото есть в HTML/скриптах страницы без выполнения JS
+    render_payload_js: str = ''  # JS-функция, возвращающая массив URL сразу после загрузки страницы
+    render_selectors: tuple = ()  # CSS-селекторы элементов галереи (src, data-src, href, вложенный img)
+    fast_min_images: int = 6  # столько фото без браузера достаточно для ответа
+    render_min_images: int = 12  # столько фото сразу после загрузки — не ждём сеть и прокрутку
+    find_video: bool = True  # False — видео на сайте не ищем, страницу не держим до networkidle
+
+    def object_id(self, page_url: str) -> str | None:
+        if not self.object_id_pattern:
+            return None
+        m = re.search(self.object_id_pattern, urlparse(page_url).path or '')
+        return m.group(1) if m else None
+
+    def is_site_image(self, u: str) -> bool:
+        lu = (u or '').lower()
+        return (any(h in lu and part in lu for h, part in self.image_hosts)
+                and not any(x in lu for x in EXCLUDED_URL_MARKERS))
+
+    # Фильтр «фото этого объекта»: CDN сайта и id объекта в пути, если его удалось извлечь из URL страницы
+    def image_filter(self, page_url: str):
+        obj_id = self.object_id(page_url)
+
+        def is_target(u: str) -> bool:
+            return self.is_site_image(u) and (not obj_id or f"/{obj_id}/" in u.lower())
+        return is_target
+
+    # Оставляем фото объекта; если таких нет — фото сайта; если и их нет — список как есть
+    def filter_images(self, urls: list, page_url: str) -> list:
+        is_target = self.image_filter(page_url)
+        return [u for u in urls if is_target(u)] or [u for u in urls if self.is_site_image(u)] or list(urls)
+
+# Реестр адаптеров по домену страницы
+SITE_ADAPTERS: dict[str, SiteAdapter] = {}
+
+def register_site_adapter(adapter: SiteAdapter):
+    for host in adapter.hosts:
+        SITE_ADAPTERS[host.lower()] = adapter
+
+def get_site_adapter(url: str) -> SiteAdapter | None:
+    host = (urlparse(url or '').hostname or '').lower()
+    parts = host.split('.')
+    for i in range(len(parts) - 1):
+        adapter = SITE_ADAPTERS.get('.'.join(parts[i:]))
+        if adapter is not None:
+            return adapter
+    return None
+
+# Фото с CDN любого известного сайта принимаются без проверки
+def is_known_site_image(u: str) -> bool:
+    return any(adapter.is_site_image(u) for adapter in SITE_ADAPTERS.values())
+
+# Хосты CDN известных сайтов: ссылки на них собираются из атрибутов DOM даже без расширения
+def known_image_hosts() -> list[str]:
+    return list(dict.fromkeys(h for adapter in SITE_ADAPTERS.values() for h, _ in adapter.image_hosts))
+
+# Сборщик URL изображений из DOM (img/srcset, ссылки, фоны, атрибуты со ссылками на CDN известных сайтов).
+# Внедряется в контексты браузера init-скриптом, поэтому заранее прогретая страница получает его уже разобранным
+DOM_IMAGE_COLLECTOR_JS = r'''(cdnHosts) => {
+    const urls = new Set();
+    const add = (u) => {
+        if (!u) return;
+        u = String(u).trim();
+        if (u.startsWith('//')) u = 'https:' + u;
+        urls.add(u);
+    };
+    // Все изображения и их srcset
+    document.querySelectorAll('img').forEach(img => {
+        add(img.getAttribute('src'));
+        add(img.getAttribute('data-src'));
+        add(img.getAttribute('data-original'));
+        add(img.getAttribute('data-lazy'));
+        add(img.getAttribute('data-image'));
+        add(img.getAttribute('data-src-large'));
+        const sets = [img.getAttribute('srcset'), img.getAttribute('data-srcset')].filter(Boolean);
+        sets.forEach(ss => {
+            const first = String(ss).split(',')[0].trim().split(' ')[0];
+            add(first);
+        });
+    });
+    // Ссылки, указывающие на изображения
+    document.querySelectorAll('a').forEach(a => {
+        const href = a.getAttribute('href') || '';
+        const ds = a.getAttribute('data-src') || '';
+        if (/(\.jpg|\.jpeg|\.png|\.webp|\.gif|\.bmp)(\?|$)/i.test(href)) {
+            add(href);
+        }
+        if (/(\.jpg|\.jpeg|\.png|\.webp|\.gif|\.bmp)(\?|$)/i.test(ds)) {
+            add(ds);
+        }
+    });
+    // Фоновые изображения
+    document.querySelectorAll('[style*="background"]').forEach(el => {
+        try {
+            const bg = getComputedStyle(el).backgroundImage;
+            if (bg && bg.includes('url(')) {
+                const matches = bg.match(/url\(("|')?(.*?)\1\)/g) || [];
+                matches.forEach(m => {
+                    const u = m.replace(/^url\(("|')?/, '').replace(/\1?\)$/, '');
+                    add(u);
+                });
+            }
+        } catch {}
+    });
+    // Проход по всем атрибутам всех элементов: ищем CDN и расширения изображений
+    const reImg = /(https?:\/\/[^\s'"<>]+\.(?:jpg|jpeg|png|webp|gif|bmp))/ig;
+    const reUrl = /(https?:\/\/[^\s'"<>]+)/ig;
+    document.querySelectorAll('*').forEach(el => {
+        for (const attr of el.getAttributeNames ? el.getAttributeNames() : []) {
+            const val = el.getAttribute(attr) || '';
+            let m;
+            while ((m = reImg.exec(val)) !== null) add(m[1]);
+            // Ссылки на CDN известных сайтов — даже без расширения
+            if (cdnHosts.some(h => val.includes(h))) {
+                while ((m = reUrl.exec(val)) !== null) {
+                    if (cdnHosts.some(h => m[1].includes(h))) add(m[1]);
+                }
+            }
+        }
+    });
+    return Array.from(urls);
+}'''
+COLLECTOR_INIT_SCRIPT = f"window.__collectImageUrls = {DOM_IMAGE_COLLECTOR_JS};"
+# Вызов сборщика; если страница затёрла функцию — выполняется та же функция напрямую
+COLLECT_IMAGES_CALL_JS = f"(cdnHosts) => (window.__collectImageUrls || ({DOM_IMAGE_COLLECTOR_JS}))(cdnHosts)"
+
+# Сбор URL по CSS-селекторам галереи на загруженной странице
+RENDER_SELECTORS_JS = '''(selectors) => {
+    const urls = new Set();
+    const add = u => { if (u) urls.add(String(u)); };
+    for (const sel of selectors) {
+        document.querySelectorAll(sel).forEach(el => {
+            add(el.getAttribute('data-src'));
+            add(el.getAttribute('src'));
+            add(el.getAttribute('href'));
+            const img = el.querySelector('img');
+            if (img) { add(img.getAttribute('data-src')); add(img.getAttribute('src')); }
+        });
+    }
+    return Array.from(urls);
+}'''
+
+# Фото объекта без браузера: JSON API сайта, затем данные, встроенные в HTML страницы
+async def fetch_adapter_images(adapter: SiteAdapter, url: str) -> list:
+    is_target = adapter.image_filter(url)
+    session = get_http_session()
+    images = []
+    obj_id = adapter.object_id(url)
+    if adapter.api_url and (obj_id or '{id}' not in adapter.api_url):
+        parts = urlsplit(url)
+        api_url = adapter.api_url.format(scheme=parts.scheme, host=parts.netloc, id=obj_id)
+        try:
+            async with session.get(api_url, timeout=15, headers={'Accept': 'application/json'}) as r:
+                if r.status == 200:
+                    # JSON сканируем как текст: URL с экранированными слешами декодирует сканер
+                    images = scan_media_urls(await r.text(errors='ignore'), is_target).targets
+        except Exception as e:
+            logging.warning(f"API {adapter.name} недоступно: {e}")
+        if len(images) >= adapter.fast_min_images:
+            return images
+    if adapter.embedded_payload:
+        try:
+            async with session.get(url, timeout=20) as r:
+                html = await r.text(errors='ignore')
+            found = scan_media_urls(html, is_target).targets
+            if len(found) > len(images):
+                images = found
+        except Exception as e:
+            logging.warning(f"Быстрый разбор {adapter.name} не удался: {e}")
+    return images
+
+# Сбор фото сразу после загрузки страницы: JS-выражение и CSS-селекторы адаптера
+async def collect_render_images(adapter: SiteAdapter, page, url: str) -> list:
+    raw = []
+    if adapter.render_payload_js:
+        try:
+            raw += await page.evaluate(adapter.render_payload_js) or []
+        except Exception:
+            pass
+    if adapter.render_selectors:
+        try:
+            raw += await page.evaluate(RENDER_SELECTORS_JS, list(adapter.render_selectors)) or []
+        except Exception:
+            pass
+    is_target = adapter.image_filter(url)
+    images = []
+    for u in raw:
+        if not isinstance(u, str) or not u.strip():
+            continue
+        u = u.strip()
+        if u.startswith('//'):
+            u = 'https:' + u
+        if is_target(u) and get_media_type(u) == 'photo':
+            images.append(u)
+    return list(dict.fromkeys(images))
+
+# easyhata.site: фото на CDN easybase лежат в /realty/<id объекта>/, список есть в состоянии Nuxt
+# прямо в HTML; видео на сайте нет
+register_site_adapter(SiteAdapter(
+    name='easyhata',
+    hosts=('easyhata.site',),
+    image_hosts=(('easybase.b-cdn.net', '/realty/'), ('api.easybase.com.ua', '/media/realty/')),
+    object_id_pattern=r"/flats/(\d+)/",
+    embedded_payload=True,
+    render_payload_js='''() => {
+        try {
+            const nuxt = window.__NUXT__;
+            const obj = nuxt && nuxt.data && nuxt.data[0] && nuxt.data[0].shareObject;
+            return obj && Array.isArray(obj.images) ? obj.images.map(x => x && x.img_obj).filter(Boolean) : [];
+        } catch (e) { return []; }
+    }''',
+    render_selectors=('.image-carousel__slider-main-wrap .swiper-slide a.image-carousel__main-img',),
+    find_video=False,
+))
+
+# Параметры отслеживания, не влияющие на содержимое страницы
+TRACKING_PARAMS = ('utm_', 'fbclid', 'gclid', 'yclid', 'msclkid', '_openstat')
+
+# Канонический ключ страницы: без схемы, www, фрагмента, трекинговых параметров и завершающего слеша
+def normalize_page_url(url: str) -> str:
+    parts = urlsplit((url or '').strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = f"{host}:{parts.port}"
+    path = parts.path.rstrip('/') or '/'
+    query = sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if not k.lower().startswith(TRACKING_PARAMS)
+    )
+    return urlunsplit(('', host, path, urlencode(query), '')).lstrip('/')
+
+# Кэш результатов анализа страниц: TTL, вытеснение по LRU и копия в SQLite,
+# чтобы популярные объявления не рендерились заново после перезапуска
+class PageCache:
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {ключ: (время сохранения, PageAnalysis)}
+
+    def load(self):
+        db = get_state_db()
+        if db is None:
+            return
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS page_cache (key TEXT PRIMARY KEY, stored_at REAL, data TEXT)')
+            db.execute('DELETE FROM page_cache WHERE stored_at <= ?', (time.time() - self.ttl,))
+            rows = db.execute(
+                'SELECT key, stored_at, data FROM page_cache ORDER BY stored_at DESC LIMIT ?', (self.max_entries,)
+            ).fetchall()
+            db.commit()
+            for key, stored_at, data in reversed(rows):
+                self._entries[key] = (stored_at, PageAnalysis(**json.loads(data)))
+            logging.info(f"Кэш страниц: загружено {len(rows)} записей")
+        except Exception as e:
+            logging.error(f"Ошибка загрузки кэша страниц: {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url: str) -> PageAnalysis | None:
+        key = normalize_page_url(url)
+        entry = self._entries.get(key)
+        if entry is None or time.time() - entry[0] >= self.ttl:
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        analysis = entry[1]
+        return PageAnalysis(video_url=analysis.video_url, image_urls=list(analysis.image_urls))
+
+    def put(self, url: str, analysis: PageAnalysis):
+        key = normalize_page_url(url)
+        now = time.time()
+        self._entries[key] = (now, analysis)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+        db = get_state_db()
+        if db is not None:
+            try:
+                db.execute('INSERT OR REPLACE INTO page_cache (key, stored_at, data) VALUES (?, ?, ?)',
+                           (key, now, json.dumps(asdict(analysis))))
+                db.commit()
+            except Exception as e:
+                logging.error(f"Ошибка записи кэша страниц: {e}")
+
+    # Запись оказалась негодной (фото не скачались) — следующий запрос отрендерит страницу заново
+    def pop(self, url: str):
+        self._drop(normalize_page_url(url))
 
-        if loading_msg:
+    def _drop(self, key: str):
+        self._entries.pop(key, None)
+        db = get_state_db()
+        if db is not None:
             try:
-                await loading_msg.delete()
+                db.execute('DELETE FROM page_cache WHERE key = ?', (key,))
+                db.commit()
             except Exception:
                 pass
 
-        if len(media) == 1:
-            await message.reply_photo(media[0].media, reply_markup=get_main_menu())
+page_cache = PageCache(PAGE_CACHE_TTL, PAGE_CACHE_SIZE)
+
+# Кэш file_id, которые Telegram вернул после отправки: источник (URL или SHA-256 содержимого) →
+# (тип, file_id). Повторная отправка по file_id не требует ни скачивания, ни конвертации.
+# file_id действительны только для своего бота, поэтому ключи включают id бота.
+# Записи в SQLite старше ttl удаляются при загрузке и затем каждые PRUNE_EVERY записей
+class FileIdCache:
+    PRUNE_EVERY = 1000
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self._puts = 0
+        self._entries = OrderedDict()  # {ключ: (тип, file_id)}, горячая часть поверх SQLite
+
+    def load(self):
+        db = get_state_db()
+        if db is None:
             return
-
-        if 2 <= len(media) <= 10:
-            await message.reply_media_group(media)
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, kind TEXT, file_id TEXT, stored_at REAL)')
+            db.commit()
+        except Exception as e:
+            logging.error(f"Ошибка инициализации кэша file_id: {e}")
             return
-
-        # Батчи
-        for start in range(0, len(media), 10):
-            batch = media[start:start+10]
+        removed = self.prune()
+        if removed:
+            logging.info(f"Кэш file_id: удалено устаревших записей: {removed}")
+
+    # Удаление записей старше ttl из SQLite; возвращает число удалённых
+    def prune(self) -> int:
+        db = get_state_db()
+        if db is None or self.ttl <= 0:
+            return 0
+        try:
+            removed = db.execute('DELETE FROM file_ids WHERE stored_at <= ?', (time.time() - self.ttl,)).rowcount
+            db.commit()
+            return removed
+        except Exception as e:
+            logging.error(f"Ошибка очистки кэша file_id: {e}")
+            return 0
+
+    @staticmethod
+    def url_key(url: str) -> str:
+        return f"{bot.id}:url:{url}"
+
+    @staticmethod
+    def hash_key(digest: str) -> str:
+        return f"{bot.id}:sha256:{digest}"
+
+    def get(self, key: str) -> tuple | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            db = get_state_db()
+            if db is not None:
+                try:
+                    row = db.execute('SELECT kind, file_id FROM file_ids WHERE key = ? AND stored_at > ?',
+                                     (key, time.time() - self.ttl if self.ttl > 0 else 0)).fetchone()
+                except Exception:
+                    row = None
+                if row:
+                    entry = (row[0], row[1])
+                    self._remember(key, entry)
+        else:
+            self._entries.move_to_end(key)
+        if entry is not None:
+            self.hits += 1
+        return entry
+
+    def put(self, key: str, kind: str, file_id: str):
+        self._remember(key, (kind, file_id))
+        db = get_state_db()
+        if db is not None:
             try:
-                await message.reply_media_group(batch)
-                await asyncio.sleep(0.4)
+                db.execute('INSERT OR REPLACE INTO file_ids (key, kind, file_id, stored_at) VALUES (?, ?, ?, ?)',
+                           (key, kind, file_id, time.time()))
+                db.commit()
             except Exception as e:
-                logging.error(f"Ошибка отправки батча {(start//10)+1}: {e}")
-    except Exception as e:
-        logging.error(f"Ошибка process_media_urls: {e}")
+                logging.error(f"Ошибка записи кэша file_id: {e}")
+            self._puts += 1
+            if self._puts % self.PRUNE_EVERY == 0:
+                self.prune()
+
+    def forget(self, key: str):
+        self._entries.pop(key, None)
+        db = get_state_db()
+        if db is not None:
+            try:
+                db.execute('DELETE FROM file_ids WHERE key = ?', (key,))
+                db.commit()
+            except Exception:
+                pass
 
-# Извлечение потенциальных ссылок на медиа из HTML
-async def extract_potential_urls(url: str) -> list:
+    def _remember(self, key: str, entry: tuple):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Сохранить file_id отправленных фото; sources — [(url, sha256 | None)] в порядке отправки
+    def remember_photos(self, sources: list, messages: list):
+        for (url, digest), sent in zip(sources, messages):
+            photo = getattr(sent, 'photo', None)
+            if not photo:
+                continue
+            file_id = photo[-1].file_id
+            self.put(self.url_key(url), 'photo', file_id)
+            if digest:
+                self.put(self.hash_key(digest), 'photo', file_id)
+
+    # Забыть file_id из партии, отправка которой не удалась (например, file_id устарел)
+    def forget_photos(self, sources: list):
+        for url, digest in sources:
+            self.forget(self.url_key(url))
+            if digest:
+                self.forget(self.hash_key(digest))
+
+file_id_cache = FileIdCache(FILE_ID_CACHE_SIZE, FILE_ID_CACHE_TTL_DAYS * 86400)
+
+# Заголовки браузерного контекста для анализа страниц
+PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Referer': 'https://www.google.com/',
+    'DNT': '1'
+}
+
+# Параметры контекста браузера для анализа страниц
+PAGE_CONTEXT_OPTIONS = {
+    'user_agent': PAGE_HEADERS['User-Agent'],
+    'viewport': {'width': 1920, 'height': 1080},
+    'locale': 'en-US',
+    'timezone_id': 'America/New_York',
+    'permissions': ['geolocation'],
+}
+
+# Подготовка контекста для анализа страниц: заголовки, сборщик изображений init-скриптом
+# и пустая страница — запросу остаётся только навигация
+async def prepare_page_context(context):
+    await context.set_extra_http_headers({
+        'Accept-Language': PAGE_HEADERS['Accept-Language'],
+        'Referer': PAGE_HEADERS['Referer'],
+        'DNT': PAGE_HEADERS['DNT']
+    })
+    await context.add_init_script(COLLECTOR_INIT_SCRIPT)
+    await context.new_page()
+
+browser_manager.configure(PAGE_CONTEXT_OPTIONS, prepare_page_context)
+
+# Анализ страницы с кэшем: повторная ссылка на ту же страницу не открывает браузер.
+# progress (необязательно) получает текущий этап анализа
+async def analyze_page(url: str, progress: ProgressReporter | None = None) -> PageAnalysis:
     global request_count
     request_count += 1
+    cached = page_cache.get(url)
+    if cached is not None:
+        logging.info(f"Кэш страниц: попадание для {url}")
+        return cached
+    with metrics.stage('page_render'):
+        analysis = await scan_page(url, progress)
+    # Не кэшируем частичный рендер (таймаут навигации) и видео: ссылки на видео часто подписаны и быстро истекают
+    if analysis.image_urls and not analysis.video_url and not analysis.partial:
+        page_cache.put(url, analysis)
+    return analysis
+
+# Политика перехвата запросов страницы: (оборвать ли запрос, кандидат — 'image' | 'video' | '').
+# Домены аналитики обрываются целиком; у заблокированных типов ресурсов URL изображений и видео
+# запоминаются как кандидаты, хотя сами тела не загружаются
+def route_policy(req_url: str, resource_type: str, probe_video: bool) -> tuple:
+    host = (urlparse(req_url).hostname or '').lower()
+    if any(host == d or host.endswith('.' + d) for d in BROWSER_BLOCK_DOMAINS):
+        return True, ''
+    if resource_type not in BROWSER_BLOCK_RESOURCES:
+        return False, ''
+    lu = req_url.lower().split('?')[0]
+    if resource_type == 'image' and not lu.endswith(('.svg', '.ico')):
+        return True, 'image'
+    if resource_type == 'media' and probe_video and not lu.endswith(AUDIO_EXTENSIONS):
+        return True, 'video'
+    return True, ''
+
+# Единый анализ страницы: за один рендер в Playwright ищем и видео, и изображения
+async def scan_page(url: str, progress: ProgressReporter | None = None) -> PageAnalysis:
     try:
-        # 1) Быстрый HTTP-парсинг без Playwright: вытянуть все realty-URL из HTML/скриптов
-        try:
-            async with aiohttp.ClientSession() as s:
-                async with s.get(url, timeout=20) as r:
-                    html_fast = await r.text(errors='ignore')
-            # Расшифровка \u002F
-            html_fast_unesc = html_fast.replace('\\u002F', '/')
-            # Извлекаем id объекта из URL
-            _m = re.search(r"/flats/(\d+)/", url)
-            obj_id = _m.group(1) if _m else None
-            candidates = []
-            # Шаблоны CDN
-            patterns = [
-                r"https?://(?:api\.easybase\.com\.ua|easybase\.b-cdn\.net)[^\s'\"<>]*/realty/(\d+)[^\s'\"<>]*\.(?:webp|jpg|jpeg|png|bmp)",
-                r"https?://easybase\.b-cdn\.net/prod/media/realty/(\d+)[^\s'\"<>]*\.(?:webp|jpg|jpeg|png|bmp)"
-            ]
-            for pat in patterns:
-                for m in re.findall(pat, html_fast_unesc, flags=re.IGNORECASE):
-                    pass  # нам нужен только id в группе, основную ссылку возьмём вторым проходом
-            # Второй проход: просто собрать все ссылки на изображения
-            for m in re.findall(r"https?://[^\s'\"<>]+\.(?:webp|jpg|jpeg|png|bmp)", html_fast_unesc, flags=re.IGNORECASE):
-                lm = m.lower()
-                if any(x in lm for x in ['.svg', 'favicon.ico', '/avatar/']):
-                    continue
-                if ('/realty/' in lm) and (('easybase.b-cdn.net' in lm) or ('api.easybase.com.ua' in lm)):
-                    if (not obj_id) or (f"/{obj_id}/" in lm):
-                        candidates.append(m)
-            candidates = list(dict.fromkeys(candidates))
-            if len(candidates) >= 6:  # достаточно для раннего возврата
-                return candidates
-        except Exception:
-            pass
+        logging.info(f"Начинаем анализ страницы: {url}")
+        adapter = get_site_adapter(url)
+        # На сайтах без видео (по адаптеру) видео не ищем вовсе
+        probe_video = adapter.find_video if adapter is not None else True
+
+        # 1) Быстрый путь адаптера без Playwright: JSON API или данные, встроенные в HTML
+        if adapter is not None and not probe_video:
+            if progress is not None:
+                progress.stage("🔍 Получаю данные объявления...")
+            candidates = await fetch_adapter_images(adapter, url)
+            if len(candidates) >= adapter.fast_min_images:
+                logging.info(f"Адаптер {adapter.name}: {len(candidates)} фото без браузера")
+                return PageAnalysis(image_urls=candidates)
+
+        # Контекст обычно берётся готовым: заголовки, сборщик и пустая страница подготовлены заранее
+        async with browser_manager.context(**PAGE_CONTEXT_OPTIONS) as context:
+            # Коллекции изображений и видео из сетевых ответов
+            network_image_urls = []
+            video_urls = []
 
-        async with async_playwright() as p:
-            browser = await p.chromium.launch(headless=True)
-            page = await browser.new_page()
+            # Политика перехвата: не тянем шрифты, тела медиа, аналитику (и по настройке — изображения),
+            # но URL заблокированных изображений/видео запоминаем как кандидатов
+            async def on_route(route):
+                request = route.request
+                try:
+                    req_url = request.url
+                    abort, candidate = route_policy(req_url, request.resource_type, probe_video)
+                    if candidate == 'image':
+                        network_image_urls.append(req_url)
+                    elif candidate == 'video' and req_url not in video_urls:
+                        video_urls.append(req_url)
+                        logging.info(f"Найдено видео (запрос заблокирован): {req_url}")
+                    if abort:
+                        await route.abort()
+                        return
+                except Exception as e:
+                    logging.error(f"Ошибка в обработчике маршрутов: {str(e)}")
+                try:
+                    await route.continue_()
+                except Exception:
+                    pass
 
-            # Коллекция изображений из сетевых ответов
-            network_image_urls = []
+            if BROWSER_BLOCK_RESOURCES or BROWSER_BLOCK_DOMAINS:
+                await context.route('**/*', on_route)
+            page = context.pages[0] if context.pages else await context.new_page()
 
             async def on_response(response):
                 try:
                     resp_url = response.url
+                    lu = resp_url.lower()
                     ctype = (response.headers.get('content-type') or '').lower()
-                    if ('image/' in ctype) or resp_url.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
+                    if ('image/' in ctype) or lu.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
                         # минимальный размер, чтобы отсечь иконки
                         clen = int(response.headers.get('content-length', '0'))
                         if clen == 0:
@@ -268,68 +1900,53 @@ async def extract_potential_urls(url: str) -> list:
                             clen = 1
                         if clen >= 2048:  # >=2KB – захватываем и небольшие превью
                             network_image_urls.append(resp_url)
+                        return
+                    if not probe_video:
+                        return
+                    # Пропускаем ненужные типы запросов
+                    if any(x in lu for x in ['.css', '.js', '.svg']):
+                        return
+                    # Проверяем на видео-контент
+                    is_hls = '.m3u8' in lu or 'mpegurl' in ctype
+                    is_video = ('video/' in ctype or is_hls or
+                              any(ext in lu for ext in ['.mp4', '.webm', '.mov', 'video/']))
+                    if is_video and resp_url not in video_urls:
+                        # Проверяем размер контента (плейлист HLS маленький — его берём без проверки)
+                        content_length = int(response.headers.get('content-length', '0'))
+                        if content_length > 100000 or is_hls:  # Больше 100 КБ
+                            video_urls.append(resp_url)
+                            logging.info(f"Найдено видео: {resp_url} (тип: {ctype}, размер: {content_length} байт)")
                 except Exception:
                     pass
 
             page.on('response', on_response)
             
             # Установка таймаута и ожидание загрузки (мягче: domcontentloaded)
+            if progress is not None:
+                progress.stage("🌐 Открываю страницу...")
+            partial = False
             try:
-                await page.goto(url, timeout=30000, wait_until="domcontentloaded")
-            except Exception:
-                # Даже если навигация с таймаутом, продолжим попытку собрать то, что есть
-                pass
-
-            # Быстрый путь: пробуем сразу достать изображения из Nuxt и основного слайдера, и если их достаточно — возвращаем сразу
-            try:
-                early_nuxt = await page.evaluate('''() => {
-                    try {
-                        const nuxt = window.__NUXT__;
-                        const arr = nuxt && nuxt.data && nuxt.data[0] && nuxt.data[0].shareObject && Array.isArray(nuxt.data[0].shareObject.images)
-                            ? nuxt.data[0].shareObject.images.map(x => x && x.img_obj).filter(Boolean)
-                            : [];
-                        return arr;
-                    } catch { return []; }
-                }''')
-            except Exception:
-                early_nuxt = []
-
-            try:
-                early_dom = await page.evaluate('''() => {
-                    const urls = new Set();
-                    const add = u => { if (u) urls.add(String(u)); };
-                    document.querySelectorAll('.image-carousel__slider-main-wrap .swiper-slide a.image-carousel__main-img').forEach(a => {
-                        add(a.getAttribute('data-src'));
-                        const img = a.querySelector('img');
-                        if (img) add(img.getAttribute('src'));
-                    });
-                    return Array.from(urls);
-                }''')
-            except Exception:
-                early_dom = []
+                await page.goto(url, timeout=30000, wait_until="domcontentloaded", referer=PAGE_HEADERS['Referer'])
+            except Exception as e:
+                # Даже если навигация с таймаутом, продолжим попытку собрать то, что есть (результат не кэшируется)
+                logging.warning(f"Навигация не завершилась для {url}: {e}")
+                partial = True
+
+            # Быстрый путь адаптера: фото из данных страницы и галереи сразу после загрузки, если их достаточно
+            if adapter is not None:
+                early_urls = await collect_render_images(adapter, page, url)
+                if len(early_urls) >= adapter.render_min_images and not probe_video:
+                    return PageAnalysis(image_urls=early_urls, partial=partial)
+            # Для поиска видео даём странице догрузить сетевые запросы
+            if probe_video:
+                try:
+                    await page.wait_for_load_state('networkidle', timeout=30000)
+                except Exception:
+                    pass
 
-            try:
-                # Фильтруем на лету только realty-URL на CDN
-                def _is_target(u: str) -> bool:
-                    lu = u.lower()
-                    return ('easybase.b-cdn.net' in lu) and ('/realty/' in lu) and lu.endswith(('.jpg','.jpeg','.png','.webp','.bmp','.gif'))
-                early_urls = []
-                seen_e = set()
-                for u in list(early_nuxt) + list(early_dom):
-                    if not u:
-                        continue
-                    uu = u.strip()
-                    if uu.startswith('//'):
-                        uu = 'https:' + uu
-                    if uu not in seen_e and _is_target(uu):
-                        seen_e.add(uu)
-                        early_urls.append(uu)
-                if len(early_urls) >= 12:
-                    await browser.close()
-                    return early_urls
-            except Exception:
-                pass
             # Прокрутка для подгрузки ленивых изображений
+            if progress is not None:
+                progress.stage("📜 Прокручиваю страницу, подгружаю изображения...")
             try:
                 await page.evaluate('''async () => {
                     await new Promise((resolve) => {
@@ -349,83 +1966,29 @@ async def extract_potential_urls(url: str) -> list:
             except Exception:
                 pass
             await page.wait_for_timeout(3000)  # Небольшая задержка после прокрутки
+
+            # Видео: если нашли, изображения уже не нужны
+            primary_photo = ""
+            if probe_video:
+                try:
+                    video_url = await find_video_on_page(page, video_urls)
+                except Exception as e:
+                    logging.error(f"Ошибка поиска видео на странице {url}: {str(e)}")
+                    video_url = ""
+                if video_url:
+                    return PageAnalysis(video_url=video_url, partial=partial)
+                primary_photo = await find_primary_photo(page)
             
             # Получаем HTML после выполнения JavaScript
             # Дополнительно собираем ссылки на изображения напрямую из DOM через JS
             try:
-                dom_urls = await page.evaluate(r'''() => {
-                    const urls = new Set();
-                    const add = (u) => {
-                        if (!u) return;
-                        u = String(u).trim();
-                        if (u.startsWith('//')) u = 'https:' + u;
-                        urls.add(u);
-                    };
-                    // Все изображения и их srcset
-                    document.querySelectorAll('img').forEach(img => {
-                        add(img.getAttribute('src'));
-                        add(img.getAttribute('data-src'));
-                        add(img.getAttribute('data-original'));
-                        add(img.getAttribute('data-lazy'));
-                        add(img.getAttribute('data-image'));
-                        add(img.getAttribute('data-src-large'));
-                        const sets = [img.getAttribute('srcset'), img.getAttribute('data-srcset')].filter(Boolean);
-                        sets.forEach(ss => {
-                            const first = String(ss).split(',')[0].trim().split(' ')[0];
-                            add(first);
-                        });
-                    });
-                    // Ссылки, указывающие на изображения
-                    document.querySelectorAll('a').forEach(a => {
-                        const href = a.getAttribute('href') || '';
-                        const ds = a.getAttribute('data-src') || '';
-                        if (/(\.jpg|\.jpeg|\.png|\.webp|\.gif|\.bmp)(\?|$)/i.test(href)) {
-                            add(href);
-                        }
-                        if (/(\.jpg|\.jpeg|\.png|\.webp|\.gif|\.bmp)(\?|$)/i.test(ds)) {
-                            add(ds);
-                        }
-                    });
-                    // Фоновые изображения
-                    document.querySelectorAll('[style*="background"]').forEach(el => {
-                        try {
-                            const bg = getComputedStyle(el).backgroundImage;
-                            if (bg && bg.includes('url(')) {
-                                const matches = bg.match(/url\(("|')?(.*?)\1\)/g) || [];
-                                matches.forEach(m => {
-                                    const u = m.replace(/^url\(("|')?/, '').replace(/\1?\)$/, '');
-                                    add(u);
-                                });
-                            }
-                        } catch {}
-                    });
-                    // Проход по всем атрибутам всех элементов: ищем CDN и расширения изображений
-                    const reImg = /(https?:\/\/[^\s'"<>]+\.(?:jpg|jpeg|png|webp|gif|bmp))/ig;
-                    const reCdn = /(https?:\/\/[^\s'"<>]*easybase\.b-cdn\.net[^\s'"<>]*)/ig;
-                    document.querySelectorAll('*').forEach(el => {
-                        for (const attr of el.getAttributeNames ? el.getAttributeNames() : []) {
-                            const val = el.getAttribute(attr) || '';
-                            let m;
-                            while ((m = reImg.exec(val)) !== null) add(m[1]);
-                            while ((m = reCdn.exec(val)) !== null) add(m[1]);
-                        }
-                    });
-                    return Array.from(urls);
-                }''')
+                dom_urls = await page.evaluate(COLLECT_IMAGES_CALL_JS, known_image_hosts())
             except Exception:
                 dom_urls = []
 
             html_content = await page.content()
-            
-            # Дополнительно достаём URL, записанные с экранированными слешами (\u002F) в скриптах Nuxt
-            escaped_urls = []
-            try:
-                esc_pattern = r"https:\\u002F\\u002F[^\s'\"<>]+\\.(?:jpg|jpeg|png|webp|gif|bmp)"
-                for m in re.findall(esc_pattern, html_content, flags=re.IGNORECASE):
-                    decoded = m.replace("\\u002F", "/")
-                    escaped_urls.append(decoded)
-            except Exception:
-                pass
+            # Все ссылки на изображения в HTML, включая экранированные (\u002F) в скриптах Nuxt — одним проходом
+            scanned = scan_media_urls(html_content)
             
             # Пытаемся открыть модальное окно галереи и пройтись по всем фото
             try:
@@ -584,25 +2147,12 @@ async def extract_potential_urls(url: str) -> list:
             except Exception:
                 json_urls = []
 
-            # Явное извлечение из Nuxt: window.__NUXT__.data[0].shareObject.images[].img_obj
-            try:
-                nuxt_images = await page.evaluate('''() => {
-                    try {
-                        const nuxt = window.__NUXT__;
-                        const arr = nuxt && nuxt.data && nuxt.data[0] && nuxt.data[0].shareObject && Array.isArray(nuxt.data[0].shareObject.images)
-                            ? nuxt.data[0].shareObject.images.map(x => x && x.img_obj).filter(Boolean)
-                            : [];
-                        return arr;
-                    } catch (e) { return []; }
-                }''')
-            except Exception:
-                nuxt_images = []
+            # Данные страницы по описанию адаптера (например, состояние Nuxt) после прокрутки и галереи
+            nuxt_images = await collect_render_images(adapter, page, url) if adapter is not None else []
 
-            # Закрываем браузер
-            await browser.close()
+            # Закрываем контекст до разбора HTML
+            await context.close()
             
-            # Парсим HTML
-            soup = BeautifulSoup(html_content, 'html.parser')
             urls = []
 
             def add_url(u: str):
@@ -617,38 +2167,12 @@ async def extract_potential_urls(url: str) -> list:
                 if u.startswith(('http://', 'https://')):
                     urls.append(u)
 
-            # <img src> и data-src
-            for img in soup.find_all('img'):
-                add_url(img.get('src'))
-                add_url(img.get('data-src'))
-                # srcset / data-srcset: берём первое значение
-                for attr in ('srcset', 'data-srcset'):
-                    srcset = img.get(attr)
-                    if srcset:
-                        first = srcset.split(',')[0].strip().split(' ')[0]
-                        add_url(first)
-
-            # <picture><source srcset>
-            for source in soup.find_all('source'):
-                srcset = source.get('srcset')
-                if srcset:
-                    first = srcset.split(',')[0].strip().split(' ')[0]
-                    add_url(first)
-
-            # <noscript><img>
-            for noscr in soup.find_all('noscript'):
-                inner = BeautifulSoup(noscr.get_text() or '', 'html.parser')
-                for img in inner.find_all('img'):
-                    add_url(img.get('src'))
-                    add_url(img.get('data-src'))
-
-            # OpenGraph meta og:image
-            for meta in soup.find_all('meta', property=lambda v: v in ('og:image', 'og:image:secure_url') if v else False):
-                add_url(meta.get('content'))
-
-            # link rel=image_src
-            for link in soup.find_all('link', rel=lambda r: r and ('image_src' in r or 'icon' in r)):
-                add_url(link.get('href'))
+            # <img>, <source srcset>, <noscript>, og:image и link rel — за один обход HTML
+            try:
+                for _, u in collect_html_image_urls(html_content):
+                    add_url(u)
+            except Exception as e:
+                logging.error(f"Ошибка парсинга HTML: {str(e)}")
 
             # Добавляем URL, собранные из DOM
             try:
@@ -670,41 +2194,128 @@ async def extract_potential_urls(url: str) -> list:
                     add_url(u)
             except Exception:
                 pass
-            # Добавляем расэкранированные URL из скриптов
-            try:
-                for u in escaped_urls:
-                    add_url(u)
-            except Exception:
-                pass
-
-            # Дополнительно: собираем все прямые ссылки на изображения из HTML через regex
-            try:
-                img_url_pattern = r"https?://[^\s'\"<>]+\.(?:jpg|jpeg|png|webp|gif|bmp)"
-                for m in re.findall(img_url_pattern, html_content, flags=re.IGNORECASE):
-                    add_url(m)
-            except Exception:
-                pass
+            # Добавляем ссылки на изображения, найденные сканером в HTML
+            for u in scanned.images:
+                add_url(u)
 
             # Объединяем с картинками из сети
             for nu in network_image_urls:
                 add_url(nu)
 
-            # Удаление дубликатов и возврат
+            # Удаление дубликатов и возврат (основное фото — первым)
+            if primary_photo:
+                urls.insert(0, primary_photo)
             urls = list(dict.fromkeys(urls))
-            return urls
+            # Ссылка на видео из текста HTML (скрипты, JSON) — последний вариант: только если ни сеть,
+            # ни теги <video> видео не дали, а фото на странице нет
+            if probe_video and not urls and scanned.videos:
+                logging.info(f"Видео найдено только в HTML: {scanned.videos[0]}")
+                return PageAnalysis(video_url=scanned.videos[0], partial=partial)
+            return PageAnalysis(image_urls=urls, partial=partial)
     except Exception as e:
-        logging.error(f"Ошибка извлечения ссылок: {str(e)}")
+        logging.error(f"Ошибка анализа страницы {url}: {str(e)}", exc_info=True)
+        return PageAnalysis()
+
+# Извлечение ссылок на картинки из HTML за один обход: парсер (lxml или html.parser) передаёт события
+# открывающих тегов сборщику. Возвращает [(тег, ссылка)] в порядке документа, ссылки — как в атрибутах
+NOSCRIPT_IMG_RE = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+NOSCRIPT_SRC_RE = re.compile(r"\s(?:data-)?src\s*=\s*['\"]?([^'\"\s>]+)", re.IGNORECASE)
+OG_IMAGE_PROPERTIES = ('og:image', 'og:image:secure_url')
+
+def first_srcset_url(srcset: str) -> str:
+    return srcset.split(',')[0].strip().split(' ')[0]
+
+class ImageUrlCollector:
+    def __init__(self):
+        self.found = []
+        self._noscript = 0
+        self._noscript_text = []
+
+    def _add(self, tag: str, value):
+        if value:
+            self.found.append((tag, value))
+
+    def start(self, tag: str, attrs: dict):
+        tag = tag.lower()
+        if tag == 'img':
+            self._add(tag, attrs.get('src'))
+            self._add(tag, attrs.get('data-src'))
+            # srcset / data-srcset: берём первое значение
+            for attr in ('srcset', 'data-srcset'):
+                if attrs.get(attr):
+                    self._add(tag, first_srcset_url(attrs[attr]))
+        elif tag == 'source':
+            if attrs.get('srcset'):
+                self._add(tag, first_srcset_url(attrs['srcset']))
+        elif tag == 'meta':
+            if attrs.get('property') in OG_IMAGE_PROPERTIES:
+                self._add(tag, attrs.get('content'))
+        elif tag == 'link':
+            rel = (attrs.get('rel') or '').lower()
+            if 'image_src' in rel or 'icon' in rel:
+                self._add(tag, attrs.get('href'))
+        elif tag == 'noscript':
+            self._noscript += 1
+
+    # Содержимое <noscript>, которое парсер отдал текстом (может прийти частями):
+    # <img> достаём регуляркой при закрытии тега, без повторного парсинга
+    def end(self, tag: str):
+        if tag.lower() == 'noscript' and self._noscript:
+            self._noscript -= 1
+            text = ''.join(self._noscript_text)
+            self._noscript_text = []
+            for tag_text in NOSCRIPT_IMG_RE.findall(text):
+                for src in NOSCRIPT_SRC_RE.findall(tag_text):
+                    self._add('img', src)
+
+    def data(self, text: str):
+        if self._noscript:
+            self._noscript_text.append(text)
+
+    def close(self):
+        return self.found
+
+# Адаптер html.parser из стандартной библиотеки к интерфейсу сборщика (как target у lxml)
+class StdlibHTMLEvents(HTMLParser):
+    def __init__(self, target: ImageUrlCollector):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+if HTML_PARSER == 'lxml' and not LXML_AVAILABLE:
+    logging.warning("HTML_PARSER=lxml, но lxml не установлен — используется html.parser")
+HTML_PARSER_BACKEND = 'lxml' if LXML_AVAILABLE and HTML_PARSER != 'html.parser' else 'html.parser'
+
+def collect_html_image_urls(html: str) -> list[tuple]:
+    collector = ImageUrlCollector()
+    if not html:
         return []
-
-# Парсинг изображений напрямую из HTML (без Playwright)
+    if HTML_PARSER_BACKEND == 'lxml':
+        from lxml import etree as lxml_etree
+        parser = lxml_etree.HTMLParser(target=collector, recover=True, no_network=True)
+        parser.feed(html)
+        return parser.close()
+    parser = StdlibHTMLEvents(collector)
+    parser.feed(html)
+    parser.close()
+    return collector.close()
+
+# Парсинг изображений напрямую из HTML (без Playwright): картинки, <source srcset> и og:image
 def parse_image_urls_from_html(html: str, base_url: str | None = None) -> list:
     try:
-        soup = BeautifulSoup(html, 'html.parser')
         urls = []
-        for img in soup.find_all('img'):
-            src = img.get('src') or img.get('data-src')
-            if not src:
+        for tag, src in collect_html_image_urls(html):
+            if tag == 'link':
                 continue
+            src = src.strip()
             if base_url:
                 full = urljoin(base_url, src)
             else:
@@ -716,269 +2327,177 @@ def parse_image_urls_from_html(html: str, base_url: str | None = None) -> list:
                 else:
                     continue
             urls.append(full)
-        # Уникализируем и фильтруем
-        urls = list(set(urls))
-        return [u for u in urls if u.startswith(('http://', 'https://'))]
+        # Уникализируем (в порядке документа) и фильтруем
+        return [u for u in dict.fromkeys(urls) if u.startswith(('http://', 'https://'))]
     except Exception as e:
         logging.error(f"Ошибка парсинга HTML: {str(e)}")
         return []
 
-# Попытка найти медиа через Playwright
-async def fetch_media_url(url: str) -> tuple:
-    try:
-        logging.info(f"Начинаем поиск медиа на странице: {url}")
-        # Специальное правило: на easyhata.site видео не ищем вовсе
+# Поиск видео на отрендеренной странице: теги video/source, iframe, JSON-LD, вложенные фреймы
+async def find_video_on_page(page, video_urls: list) -> str:
+    # Ищем видео-элементы на странице
+    video_elements = await page.query_selector_all('video')
+    for video in video_elements:
         try:
-            _host = urlparse(url).netloc.lower()
-            if 'easyhata.site' in _host:
-                return "", ""
-        except Exception:
-            pass
-        
-        # Универсальные заголовки для всех запросов
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Referer': 'https://www.google.com/',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-            'Cache-Control': 'max-age=0'
-        }
-        
-        # Инициализируем Playwright
-        async with async_playwright() as p:
-            # Запускаем браузер с настройками
-            browser = await p.chromium.launch(
-                headless=True,
-                args=[
-                    '--disable-blink-features=AutomationControlled',
-                    '--no-sandbox',
-                    '--disable-setuid-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-accelerated-2d-canvas',
-                    '--no-first-run',
-                    '--no-zygote',
-                    '--single-process',
-                    '--disable-gpu'
-                ]
-            )
-            
-            # Создаем контекст с настройками
-            context = await browser.new_context(
-                user_agent=headers['User-Agent'],
-                viewport={'width': 1920, 'height': 1080},
-                locale='en-US',
-                timezone_id='America/New_York',
-                permissions=['geolocation']
-            )
-            
-            # Устанавливаем дополнительные заголовки
-            await context.set_extra_http_headers({
-                'Accept-Language': headers['Accept-Language'],
-                'Referer': headers['Referer'],
-                'DNT': headers['DNT']
-            })
-            
-            # Создаем новую страницу
-            page = await context.new_page()
-            
-            # Включаем перехват сетевых запросов
-            video_urls = []
-            
-            async def handle_response(response):
-                try:
-                    url = response.url.lower()
-                    content_type = (response.headers.get('content-type') or '').lower()
-                    
-                    # Пропускаем ненужные типы запросов
-                    if any(x in url for x in ['.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg']):
-                        return
-                        
-                    # Проверяем на видео-контент
-                    is_video = ('video/' in content_type or 
-                              any(ext in url for ext in ['.mp4', '.webm', '.mov', '.m3u8', 'video/']))
-                    
-                    if is_video and url not in video_urls:
-                        # Проверяем размер контента
-                        content_length = int(response.headers.get('content-length', '0'))
-                        if content_length > 100000:  # Больше 100 КБ
-                            video_urls.append(url)
-                            logging.info(f"Найдено видео: {url} (тип: {content_type}, размер: {content_length} байт)")
-                            
-                except Exception as e:
-                    logging.error(f"Ошибка при обработке ответа: {str(e)}")
-            
-            # Подписываемся на события ответов
-            page.on("response", handle_response)
-            
-            try:
-                # Загружаем страницу с настройками для обхода защиты
-                await page.goto(
-                    url,
-                    timeout=60000,
-                    wait_until="domcontentloaded",
-                    referer=headers['Referer']
-                )
-                
-                # Ждем загрузки страницы
-                await page.wait_for_load_state('networkidle', timeout=30000)
-                
-                # Прокручиваем страницу вниз для загрузки ленивого контента
-                await page.evaluate('''async () => {
-                    await new Promise((resolve) => {
-                        let totalHeight = 0;
-                        const distance = 100;
-                        const timer = setInterval(() => {
-                            const scrollHeight = document.body.scrollHeight;
-                            window.scrollBy(0, distance);
-                            totalHeight += distance;
-                            if (totalHeight >= scrollHeight || totalHeight > 2000) {
-                                clearInterval(timer);
-                                resolve();
-                            }
-                        }, 100);
-                    });
-                }''')
-                
-                # Дополнительное ожидание после прокрутки
-                await page.wait_for_timeout(3000)
-                
-                # Ищем видео-элементы на странице
-                video_elements = await page.query_selector_all('video')
-                for video in video_elements:
-                    try:
-                        # Пробуем получить src
-                        src = await video.get_attribute('src')
-                        if src and src.startswith(('http://', 'https://')) and src not in video_urls:
-                            video_urls.append(src)
-                            logging.info(f"Найдено видео в теге video: {src}")
-                        
-                        # Проверяем source внутри video
-                        sources = await video.query_selector_all('source')
-                        for source in sources:
-                            src = await source.get_attribute('src')
-                            if src and src.startswith(('http://', 'https://')) and src not in video_urls:
-                                video_urls.append(src)
-                                logging.info(f"Найдено видео в теге source: {src}")
-                                
-                    except Exception as e:
-                        logging.error(f"Ошибка при обработке видео-элемента: {str(e)}")
-                
-                # Если видео не нашли, ищем iframe с видео
-                if not video_urls:
-                    iframes = await page.query_selector_all('iframe')
-                    for iframe in iframes:
-                        try:
-                            src = await iframe.get_attribute('src')
-                            if src and any(x in src.lower() for x in ['youtube', 'vimeo', 'dailymotion', 'player']):
-                                video_urls.append(src)
-                                logging.info(f"Найдено видео в iframe: {src}")
-                        except:
-                            continue
-                
-                # Если видео нашли, возвращаем первое
-                if video_urls:
-                    cand = video_urls[0]
-                    if not cand.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
-                        return cand, 'video'
-                
-                # Если видео не нашли, ищем в JSON-LD разметке
-                try:
-                    json_ld = await page.evaluate('''() => {
-                        const scripts = document.querySelectorAll('script[type="application/ld+json"]');
-                        for (const script of scripts) {
-                            try {
-                                return JSON.parse(script.textContent);
-                            } catch (e) {}
-                        }
-                        return null;
-                    }''')
-                    
-                    if json_ld and isinstance(json_ld, dict):
-                        # Проверяем различные возможные пути к видео в JSON-LD
-                        for key in ['contentUrl', 'embedUrl', 'url', 'video']:
-                            if key in json_ld and isinstance(json_ld[key], str) and json_ld[key].startswith(('http://', 'https://')):
-                                return json_ld[key], 'video'
-                except Exception as e:
-                    logging.error(f"Ошибка при парсинге JSON-LD: {str(e)}")
-                
-                # Ищем видео в iframe
-                frames = page.frames
-                for frame in frames:
-                    try:
-                        video_elements = await frame.query_selector_all('video')
-                        for video in video_elements:
-                            src = await video.get_attribute('src')
-                            if src and src.startswith(('http://', 'https://')) and src not in video_urls:
-                                video_urls.append(src)
-                    except:
-                        continue
-                
-                # Если нашли видео, возвращаем первое (исклюаем ссылки на изображения)
-                if video_urls:
-                    cand2 = video_urls[0]
-                    if not cand2.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
-                        return cand2, 'video'
-                
-                # Если видео не нашли, ищем теги video и source
-                video_elements = await page.query_selector_all('video')
-                for video in video_elements:
-                    # Проверяем атрибут src
-                    src = await video.get_attribute('src')
-                    if src and src.startswith(('http://', 'https://')):
-                        if not src.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
-                            return src, 'video'
-                    
-                    # Проверяем source внутри video
-                    source_elements = await video.query_selector_all('source')
-                    for source in source_elements:
-                        src = await source.get_attribute('src')
-                        if src and src.startswith(('http://', 'https://')):
-                            if not src.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
-                                return src, 'video'
-                
-                # Проверяем iframe с YouTube, Vimeo и другими встраиваемыми плеерами
-                iframes = await page.query_selector_all('iframe')
-                for iframe in iframes:
-                    src = await iframe.get_attribute('src')
-                    if src and any(domain in src for domain in ['youtube.com', 'youtu.be', 'vimeo.com', 'dailymotion.com']):
-                        return src, 'video'
-                
-                # Если видео не нашли, возвращаем первое изображение
-                img_elements = await page.query_selector_all('img')
-                for img in img_elements:
-                    src = await img.get_attribute('src') or await img.get_attribute('data-src')
-                    if src and src.startswith(('http://', 'https://')):
-                        # Пропускаем маленькие изображения (иконки, аватары и т.д.)
-                        width = await img.get_attribute('width')
-                        height = await img.get_attribute('height')
-                        if width and height and int(width) > 100 and int(height) > 100:
-                            return src, 'photo'
-                
-                return "", ""
-                
-            except Exception as e:
-                logging.error(f"Ошибка при загрузке страницы {url}: {str(e)}")
-                return "", str(e)
-                
-            finally:
-                # Закрываем браузер
-                if 'context' in locals():
-                    await context.close()
-                if 'browser' in locals():
-                    await browser.close()
-                    
-    except Exception as e:
-        logging.error(f"Ошибка Playwright для {url}: {str(e)}", exc_info=True)
-        if 'browser' in locals():
+            # Пробуем получить src
+            src = await video.get_attribute('src')
+            if src and src.startswith(('http://', 'https://')) and src not in video_urls:
+                video_urls.append(src)
+                logging.info(f"Найдено видео в теге video: {src}")
+
+            # Проверяем source внутри video
+            sources = await video.query_selector_all('source')
+            for source in sources:
+                src = await source.get_attribute('src')
+                if src and src.startswith(('http://', 'https://')) and src not in video_urls:
+                    video_urls.append(src)
+                    logging.info(f"Найдено видео в теге source: {src}")
+
+        except Exception as e:
+            logging.error(f"Ошибка при обработке видео-элемента: {str(e)}")
+
+    # Если видео не нашли, ищем iframe с видео
+    if not video_urls:
+        iframes = await page.query_selector_all('iframe')
+        for iframe in iframes:
             try:
-                await browser.close()
+                src = await iframe.get_attribute('src')
+                if src and any(x in src.lower() for x in ['youtube', 'vimeo', 'dailymotion', 'player']):
+                    video_urls.append(src)
+                    logging.info(f"Найдено видео в iframe: {src}")
             except:
-                pass
-        return "", ""
-async def download_media(url: str, session: aiohttp.ClientSession, headers: dict = None) -> tuple:
+                continue
+
+    # Если видео нашли, возвращаем первое
+    if video_urls:
+        cand = video_urls[0]
+        if not cand.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
+            return cand
+
+    # Если видео не нашли, ищем в JSON-LD разметке
+    try:
+        json_ld = await page.evaluate('''() => {
+            const scripts = document.querySelectorAll('script[type="application/ld+json"]');
+            for (const script of scripts) {
+                try {
+                    return JSON.parse(script.textContent);
+                } catch (e) {}
+            }
+            return null;
+        }''')
+
+        if json_ld and isinstance(json_ld, dict):
+            # Проверяем различные возможные пути к видео в JSON-LD
+            for key in ['contentUrl', 'embedUrl', 'url', 'video']:
+                if key in json_ld and isinstance(json_ld[key], str) and json_ld[key].startswith(('http://', 'https://')):
+                    return json_ld[key]
+    except Exception as e:
+        logging.error(f"Ошибка при парсинге JSON-LD: {str(e)}")
+
+    # Ищем видео в iframe
+    frames = page.frames
+    for frame in frames:
+        try:
+            video_elements = await frame.query_selector_all('video')
+            for video in video_elements:
+                src = await video.get_attribute('src')
+                if src and src.startswith(('http://', 'https://')) and src not in video_urls:
+                    video_urls.append(src)
+        except:
+            continue
+
+    # Если нашли видео, возвращаем первое (исклюаем ссылки на изображения)
+    if video_urls:
+        cand2 = video_urls[0]
+        if not cand2.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
+            return cand2
+
+    # Если видео не нашли, ищем теги video и source
+    video_elements = await page.query_selector_all('video')
+    for video in video_elements:
+        # Проверяем атрибут src
+        src = await video.get_attribute('src')
+        if src and src.startswith(('http://', 'https://')):
+            if not src.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
+                return src
+
+        # Проверяем source внутри video
+        source_elements = await video.query_selector_all('source')
+        for source in source_elements:
+            src = await source.get_attribute('src')
+            if src and src.startswith(('http://', 'https://')):
+                if not src.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')):
+                    return src
+
+    # Проверяем iframe с YouTube, Vimeo и другими встраиваемыми плеерами
+    iframes = await page.query_selector_all('iframe')
+    for iframe in iframes:
+        src = await iframe.get_attribute('src')
+        if src and any(domain in src for domain in ['youtube.com', 'youtu.be', 'vimeo.com', 'dailymotion.com']):
+            return src
+
+    return ""
+
+# Первое крупное изображение страницы (кандидат в основное фото)
+async def find_primary_photo(page) -> str:
+    try:
+        img_elements = await page.query_selector_all('img')
+        for img in img_elements:
+            src = await img.get_attribute('src') or await img.get_attribute('data-src')
+            if src and src.startswith(('http://', 'https://')):
+                # Пропускаем маленькие изображения (иконки, аватары и т.д.)
+                width = await img.get_attribute('width')
+                height = await img.get_attribute('height')
+                if width and height and int(width) > 100 and int(height) > 100:
+                    return src
+    except Exception as e:
+        logging.error(f"Ошибка поиска основного фото: {str(e)}")
+    return ""
+
+# Сообщение об ошибке для ответа со статусом, отличным от успешного, или со слишком большим Content-Length
+async def response_error(response: aiohttp.ClientResponse, url: str, ok_statuses: tuple = (200,)) -> str | None:
+    if response.status not in ok_statuses:
+        error_text = await response.text(errors='ignore')
+        logging.error(f"Ошибка HTTP {response.status} для URL: {url}\n{error_text[:500]}")
+        
+        # Проверяем, требует ли сайт авторизации
+        if response.status == 401 or 'login' in error_text.lower():
+            metrics.inc('bot_download_errors_total', reason='unauthorized')
+            return "Для загрузки этого контента требуется авторизация на сайте 🚫"
+        elif response.status == 403:
+            metrics.inc('bot_download_errors_total', reason='forbidden')
+            return "Доступ к этому контенту запрещен (ошибка 403) 🔒"
+        elif response.status == 404:
+            metrics.inc('bot_download_errors_total', reason='not_found')
+            return "Контент не найден (ошибка 404) 🔍"
+        else:
+            metrics.inc('bot_download_errors_total', reason='http_error')
+            return f"Ошибка {response.status} при загрузке контента 🚫"
+
+    # Проверка размера файла
+    content_length = response.content_length or 0
+    if content_length > MAX_FILE_SIZE:
+        size_mb = content_length / (1024 * 1024)
+        logging.error(f"Файл слишком большой: {size_mb:.2f} МБ")
+        metrics.inc('bot_download_errors_total', reason='too_large')
+        return f"Файл слишком большой ({size_mb:.2f} МБ). Telegram ограничивает размер до 50 МБ 🚫"
+    return None
+
+# Сообщение об ошибке для исключения при скачивании
+def download_error_message(url: str, e: Exception) -> str:
+    if isinstance(e, asyncio.TimeoutError):
+        logging.error(f"Таймаут при скачивании: {url}")
+        metrics.inc('bot_download_errors_total', reason='timeout')
+        return "Превышено время ожидания при скачивании 🚫"
+    if isinstance(e, aiohttp.ClientError):
+        logging.error(f"Ошибка сети при скачивании {url}: {str(e)}")
+        metrics.inc('bot_download_errors_total', reason='network')
+        return f"Ошибка сети: {str(e)} 🚫"
+    metrics.inc('bot_download_errors_total', reason='other')
+    logging.error(f"Ошибка скачивания {url}: {str(e)}", exc_info=True)
+    return f"Ошибка при загрузке контента: {str(e)} 🚫"
+
+async def download_media(url: str, session: aiohttp.ClientSession, headers: dict = None, timeout: float = 30) -> tuple:
     try:
         logging.info(f"Начинаем скачивание: {url}")
 
@@ -1006,48 +2525,327 @@ async def download_media(url: str, session: aiohttp.ClientSession, headers: dict
             except Exception:
                 pass
 
-        async with session.get(url, headers=headers, timeout=30) as response:
-            if response.status != 200:
-                error_text = await response.text()
-                logging.error(f"Ошибка HTTP {response.status} для URL: {url}\n{error_text[:500]}")
-                
-                # Проверяем, требует ли сайт авторизации
-                if response.status == 401 or 'login' in error_text.lower():
-                    return None, "Для загрузки этого контента требуется авторизация на сайте 🚫"
-                elif response.status == 403:
-                    return None, "Доступ к этому контенту запрещен (ошибка 403) 🔒"
-                elif response.status == 404:
-                    return None, "Контент не найден (ошибка 404) 🔍"
-                else:
-                    return None, f"Ошибка {response.status} при загрузке контента 🚫"
-        
-            # Проверка размера файла
-            content_length = response.content_length or 0
-            if content_length > MAX_FILE_SIZE:
-                size_mb = content_length / (1024 * 1024)
-                logging.error(f"Файл слишком большой: {size_mb:.2f} МБ")
-                return None, f"Файл слишком большой ({size_mb:.2f} МБ). Telegram ограничивает размер до 50 МБ 🚫"
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            error = await response_error(response, url)
+            if error:
+                return None, error
         
-            # Скачивание с отображением прогресса
-            content = bytearray()
-            async for chunk in response.content.iter_chunked(8192):
-                content.extend(chunk)
-                if len(content) > MAX_FILE_SIZE:
-                    logging.error(f"Файл превысил максимальный размер при загрузке: {len(content) / (1024*1024):.2f} МБ")
-                    return None, "Файл слишком большой для загрузки 🚫"
+            # Скачивание сразу в BytesIO, без промежуточного bytearray
+            content = BytesIO()
+            try:
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    content.write(chunk)
+                    metrics.add('bot_download_bytes_in_flight', len(chunk))
+                    metrics.inc('bot_download_bytes_total', len(chunk))
+                    if content.tell() > MAX_FILE_SIZE:
+                        logging.error(f"Файл превысил максимальный размер при загрузке: {content.tell() / (1024*1024):.2f} МБ")
+                        metrics.inc('bot_download_errors_total', reason='too_large')
+                        return None, "Файл слишком большой для загрузки 🚫"
+            finally:
+                metrics.add('bot_download_bytes_in_flight', -content.tell())
         
-            logging.info(f"Успешно скачан файл размером: {len(content) / 1024:.2f} КБ")
-            return BytesIO(content), None
+            logging.info(f"Успешно скачан файл размером: {content.tell() / 1024:.2f} КБ")
+            content.seek(0)
+            return content, None
             
-    except asyncio.TimeoutError:
-        logging.error(f"Таймаут при скачивании: {url}")
-        return None, "Превышено время ожидания при скачивании 🚫"
-    except aiohttp.ClientError as e:
-        logging.error(f"Ошибка сети при скачивании {url}: {str(e)}")
-        return None, f"Ошибка сети: {str(e)} 🚫"
     except Exception as e:
-        logging.error(f"Ошибка скачивания {url}: {str(e)}", exc_info=True)
-        return None, f"Ошибка при загрузке контента: {str(e)} 🚫"
+        return None, download_error_message(url, e)
+
+# Подготовка каталога спула: создаём и удаляем файлы, оставшиеся после аварийного завершения
+def prepare_spool_dir():
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    for name in os.listdir(SPOOL_DIR):
+        try:
+            os.remove(os.path.join(SPOOL_DIR, name))
+        except OSError:
+            pass
+
+# Потоковое скачивание в уникальный файл спула (для видео): чанки пишутся сразу на диск,
+# лимит MAX_FILE_SIZE соблюдается. Возвращает (путь | None, ошибка | None); удаление файла — на вызывающем
+async def download_to_file(url: str, session: aiohttp.ClientSession, headers: dict = None, timeout: float = 300, suffix: str = '',
+                           on_progress=None) -> tuple:
+    path = None
+    try:
+        logging.info(f"Начинаем потоковое скачивание: {url}")
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            # С заголовком Range сервер отвечает 206 — это тоже успешный ответ
+            error = await response_error(response, url, ok_statuses=(200, 206))
+            if error:
+                return None, error
+
+            os.makedirs(SPOOL_DIR, exist_ok=True)
+            fd, path = tempfile.mkstemp(dir=SPOOL_DIR, prefix='video_', suffix=suffix)
+            written = 0
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(256 * 1024):
+                        written += len(chunk)
+                        metrics.add('bot_download_bytes_in_flight', len(chunk))
+                        metrics.inc('bot_download_bytes_total', len(chunk))
+                        if written > MAX_FILE_SIZE:
+                            break
+                        f.write(chunk)
+                        if on_progress is not None:
+                            on_progress(written, response.content_length)
+            finally:
+                metrics.add('bot_download_bytes_in_flight', -written)
+
+        if written > MAX_FILE_SIZE:
+            logging.error(f"Файл превысил максимальный размер при загрузке: {written / (1024*1024):.2f} МБ")
+            metrics.inc('bot_download_errors_total', reason='too_large')
+            remove_spool_file(path)
+            return None, "Файл слишком большой для загрузки 🚫"
+        logging.info(f"Успешно скачан файл размером: {written / 1024:.2f} КБ → {path}")
+        return path, None
+    except Exception as e:
+        remove_spool_file(path)
+        return None, download_error_message(url, e)
+
+def remove_spool_file(path: str | None):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Ошибка при удалении временного файла: {str(e)}")
+
+# Разобранный плейлист HLS: master — варианты потока, media — сегменты по порядку
+@dataclass
+class HlsPlaylist:
+    variants: list = field(default_factory=list)  # [(битрейт, url)]
+    segments: list = field(default_factory=list)  # [(url, (длина, смещение) | None)]
+    init_segment: tuple | None = None  # EXT-X-MAP (fMP4): (url, (длина, смещение) | None)
+    duration: float = 0.0
+    encrypted: bool = False
+
+HLS_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+def is_hls_url(url: str) -> bool:
+    return url.lower().split('#')[0].split('?')[0].endswith('.m3u8')
+
+# Плейлист мог прийти по ссылке без .m3u8 — узнаём его по сигнатуре в начале файла
+def is_hls_file(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(16).lstrip(b'\xef\xbb\xbf').startswith(b'#EXTM3U')
+    except Exception:
+        return False
+
+def parse_hls_attributes(line: str) -> dict:
+    return {k: v.strip('"') for k, v in HLS_ATTR_RE.findall(line.partition(':')[2])}
+
+# EXT-X-BYTERANGE "длина[@смещение]"; без смещения диапазон продолжает предыдущий в том же файле
+def parse_hls_byterange(value: str, next_offset: int) -> tuple:
+    length, _, offset = value.partition('@')
+    return int(length), int(offset) if offset else next_offset
+
+def parse_hls_playlist(text: str, base_url: str) -> HlsPlaylist:
+    playlist = HlsPlaylist()
+    bandwidth = None
+    duration = 0.0
+    byterange = None
+    next_offsets = {}  # {url: конец предыдущего диапазона}
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        if line.startswith('#EXT-X-STREAM-INF'):
+            attrs = parse_hls_attributes(line)
+            # Средний битрейт точнее пикового для оценки размера
+            value = attrs.get('AVERAGE-BANDWIDTH') or attrs.get('BANDWIDTH') or '0'
+            bandwidth = int(value) if value.isdigit() else 0
+        elif line.startswith('#EXTINF'):
+            try:
+                duration = float(line.partition(':')[2].split(',')[0])
+            except ValueError:
+                duration = 0.0
+        elif line.startswith('#EXT-X-BYTERANGE'):
+            byterange = line.partition(':')[2]
+        elif line.startswith('#EXT-X-MAP'):
+            attrs = parse_hls_attributes(line)
+            if attrs.get('URI'):
+                init_range = parse_hls_byterange(attrs['BYTERANGE'], 0) if attrs.get('BYTERANGE') else None
+                playlist.init_segment = (urljoin(base_url, attrs['URI']), init_range)
+        elif line.startswith('#EXT-X-KEY'):
+            if parse_hls_attributes(line).get('METHOD', 'NONE') != 'NONE':
+                playlist.encrypted = True
+        elif line.startswith('#'):
+            continue
+        elif bandwidth is not None:
+            playlist.variants.append((bandwidth, urljoin(base_url, line)))
+            bandwidth = None
+        else:
+            url = urljoin(base_url, line)
+            segment_range = None
+            if byterange is not None:
+                segment_range = parse_hls_byterange(byterange, next_offsets.get(url, 0))
+                next_offsets[url] = segment_range[1] + segment_range[0]
+                byterange = None
+            playlist.segments.append((url, segment_range))
+            playlist.duration += duration
+            duration = 0.0
+    return playlist
+
+# Выбор варианта: самый качественный, чья оценка размера (битрейт × длительность) укладывается в MAX_FILE_SIZE;
+# если не укладывается ни один — самый лёгкий (лимит всё равно проверяется при скачивании)
+def pick_hls_variant(variants: list, duration: float) -> str:
+    ordered = sorted(variants, reverse=True)
+    for bandwidth, url in ordered:
+        if bandwidth * duration / 8 <= MAX_FILE_SIZE:
+            return url
+    return ordered[-1][1]
+
+async def load_hls_playlist(session: aiohttp.ClientSession, url: str, headers: dict) -> tuple:
+    async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=30)) as response:
+        error = await response_error(response, url)
+        if error:
+            return None, error
+        text = await response.text(errors='ignore')
+        base_url = str(response.url)
+    if not text.lstrip('\ufeff').startswith('#EXTM3U'):
+        return None, "Ссылка не указывает на плейлист HLS 🚫"
+    return parse_hls_playlist(text, base_url), None
+
+# Media-плейлист для скачивания: master-плейлист разворачивается в вариант, подходящий по размеру.
+# Длительность у всех вариантов одна — берём её из плейлиста самого лёгкого
+async def resolve_hls_media(session: aiohttp.ClientSession, url: str, headers: dict) -> tuple:
+    playlist, error = await load_hls_playlist(session, url, headers)
+    if error or not playlist.variants:
+        return playlist, error
+    variants = sorted(playlist.variants)
+    lightest, error = await load_hls_playlist(session, variants[0][1], headers)
+    if error:
+        return None, error
+    choice = pick_hls_variant(variants, lightest.duration)
+    logging.info(f"HLS: выбран вариант {choice} из {len(variants)} (длительность {lightest.duration:.0f} с)")
+    if choice == variants[0][1]:
+        return lightest, None
+    return await load_hls_playlist(session, choice, headers)
+
+# Один сегмент HLS в память (с повтором при сетевой ошибке), не больше limit байт.
+# Сегмент с EXT-X-BYTERANGE принимается только ответом 206: сервер, проигнорировавший Range,
+# прислал бы весь файл. Возвращает (байты | None, ошибка | None)
+async def fetch_hls_segment(session: aiohttp.ClientSession, url: str, byterange: tuple | None, headers: dict,
+                            limit: int) -> tuple:
+    ok_statuses = (200, 206)
+    if byterange is not None:
+        length, offset = byterange
+        headers = {**headers, 'Range': f"bytes={offset}-{offset + length - 1}"}
+        ok_statuses = (206,)
+    for attempt in range(2):
+        size = 0
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                error = await response_error(response, url, ok_statuses=ok_statuses)
+                if error:
+                    return None, error
+                chunks = []
+                async for chunk in response.content.iter_chunked(256 * 1024):
+                    size += len(chunk)
+                    metrics.add('bot_download_bytes_in_flight', len(chunk))
+                    metrics.inc('bot_download_bytes_total', len(chunk))
+                    if size > limit:
+                        logging.error(f"HLS: сегмент {url} превысил оставшийся лимит размера ({limit} байт)")
+                        metrics.inc('bot_download_errors_total', reason='too_large')
+                        return None, "Видео слишком большое для загрузки 🚫"
+                    chunks.append(chunk)
+            return b''.join(chunks), None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt:
+                return None, download_error_message(url, e)
+            logging.warning(f"HLS: повтор сегмента {url}: {e}")
+        finally:
+            metrics.add('bot_download_bytes_in_flight', -size)
+
+# Перепаковка в MP4 без перекодирования, moov в начале файла — видео воспроизводится до полной загрузки.
+# Возвращает путь к MP4 или None, если ffmpeg не справился
+async def remux_to_mp4(path: str) -> str | None:
+    target = path.rsplit('.', 1)[0] + '.remux.mp4'
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, '-y', '-loglevel', 'error', '-i', path, '-c', 'copy', '-movflags', '+faststart', target,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), timeout=120)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise
+        if proc.returncode != 0:
+            logging.error(f"ffmpeg не смог перепаковать HLS: {stderr.decode(errors='ignore')[:500]}")
+            remove_spool_file(target)
+            return None
+        return target
+    except Exception as e:
+        logging.error(f"Ошибка перепаковки HLS в MP4: {str(e)}")
+        remove_spool_file(target)
+        return None
+
+# Скачивание HLS в файл спула: сегменты качаются параллельно (не дальше HLS_CONCURRENCY вперёд)
+# и пишутся строго по порядку. fMP4 (EXT-X-MAP) склеивается в MP4, MPEG-TS — в .ts;
+# с ffmpeg результат перепаковывается в MP4. Возвращает (путь | None, расширение, ошибка | None)
+async def download_hls(url: str, session: aiohttp.ClientSession, headers: dict = None, on_progress=None) -> tuple:
+    # Диапазон из заголовков видео к плейлисту и сегментам не относится
+    headers = {k: v for k, v in (headers or {}).items() if k.lower() != 'range'}
+    path = None
+    tasks = {}
+    try:
+        logging.info(f"Начинаем скачивание HLS: {url}")
+        playlist, error = await resolve_hls_media(session, url, headers)
+        if error:
+            return None, '', error
+        if playlist.encrypted:
+            return None, '', "Зашифрованные HLS-потоки не поддерживаются 🔒"
+        if not playlist.segments:
+            return None, '', "В плейлисте HLS нет сегментов 🚫"
+
+        parts = ([playlist.init_segment] if playlist.init_segment else []) + playlist.segments
+        ext = 'mp4' if playlist.init_segment else 'ts'
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=SPOOL_DIR, prefix='hls_', suffix=f".{ext}")
+        written = 0
+        next_index = 0
+        with os.fdopen(fd, 'wb') as f:
+            for i in range(len(parts)):
+                while next_index < len(parts) and next_index < i + max(1, HLS_CONCURRENCY):
+                    part_url, part_range = parts[next_index]
+                    # Каждый сегмент ограничен оставшимся бюджетом размера на момент запуска
+                    tasks[next_index] = asyncio.create_task(
+                        fetch_hls_segment(session, part_url, part_range, headers, MAX_FILE_SIZE - written)
+                    )
+                    next_index += 1
+                data, error = await tasks.pop(i)
+                if error:
+                    break
+                written += len(data)
+                if written > MAX_FILE_SIZE:
+                    logging.error(f"HLS превысил максимальный размер при загрузке: {written / (1024*1024):.2f} МБ")
+                    metrics.inc('bot_download_errors_total', reason='too_large')
+                    error = "Видео слишком большое для загрузки 🚫"
+                    break
+                f.write(data)
+                if on_progress is not None:
+                    on_progress(written, None)
+        if error:
+            remove_spool_file(path)
+            return None, '', error
+        logging.info(f"HLS скачан: {len(parts)} сегментов, {written / 1024:.2f} КБ → {path}")
+
+        if FFMPEG_PATH:
+            remuxed = await remux_to_mp4(path)
+            if remuxed:
+                remove_spool_file(path)
+                path, ext = remuxed, 'mp4'
+        return path, ext, None
+    except Exception as e:
+        remove_spool_file(path)
+        return None, '', download_error_message(url, e)
+    finally:
+        for task in tasks.values():
+            task.cancel()
 
 # Определение типа медиа по URL
 def get_media_type(url: str):
@@ -1065,7 +2863,7 @@ def get_media_type(url: str):
     # Проверяем расширения файлов
     if any(url_lower.endswith(ext) for ext in IMAGE_EXTENSIONS):
         return 'photo'
-    elif any(url_lower.endswith(ext) for ext in VIDEO_EXTENSIONS):
+    elif any(url_lower.endswith(ext) for ext in VIDEO_EXTENSIONS) or is_hls_url(url_lower):
         return 'video'
         
     # Проверяем MIME-типы в URL
@@ -1074,49 +2872,107 @@ def get_media_type(url: str):
         
     return 'unknown'
 
-# Быстрая проверка: является ли URL изображением по заголовку Content-Type
-async def is_image_url(session: aiohttp.ClientSession, url: str) -> bool:
+# Кэш проверок URL: {url: (время проверки, это изображение)}
+probe_cache: dict[str, tuple[float, bool]] = {}
+
+# Сигнатуры форматов изображений по первым байтам файла
+IMAGE_MAGIC = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a', b'BM')
+
+def sniff_image_bytes(head: bytes) -> bool:
+    if head.startswith(IMAGE_MAGIC):
+        return True
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    # AVIF/HEIC: ISO BMFF с брендом изображения
+    return head[4:8] == b'ftyp' and head[8:12] in (b'avif', b'avis', b'heic', b'heix', b'mif1')
+
+# Проверка одного URL без кэша: HEAD, а если он не помог — ranged GET первых байт.
+# None — сетевая ошибка (результат не кэшируется)
+async def probe_image_url(session: aiohttp.ClientSession, url: str) -> bool | None:
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+        'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.9'
+    }
+    # Пробуем HEAD для экономии трафика
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.9'
-        }
-        # Пробуем HEAD для экономии трафика
-        try:
-            async with session.head(url, headers=headers, allow_redirects=True, timeout=15) as resp:
-                ctype = (resp.headers.get('Content-Type') or '').lower()
-                return ctype.startswith('image/')
-        except aiohttp.ClientResponseError as e:
-            if e.status not in (400, 405):
-                raise
-        except Exception:
-            # Фоллбэк на GET, если HEAD не поддерживается
-            pass
-
-        async with session.get(url, headers=headers, allow_redirects=True, timeout=15) as resp:
+        async with session.head(url, headers=headers, allow_redirects=True, timeout=15) as resp:
             ctype = (resp.headers.get('Content-Type') or '').lower()
-            return ctype.startswith('image/')
+            if resp.status < 400 and ctype and not ctype.startswith(('application/octet-stream', 'binary/')):
+                return ctype.startswith('image/')
     except Exception:
-        return False
+        # Фоллбэк на GET, если HEAD не поддерживается
+        pass
 
-# Анимация загрузки
-async def show_loading_animation(message: Message, media_type: str = 'медиа'):
+    # Читаем только первые байты и определяем формат по сигнатуре
     try:
-        loading_msg = await message.reply(f"Загрузка {media_type}... {LOADING_EMOJIS[0]}", parse_mode='Markdown')
-        if len(LOADING_EMOJIS) > 1:
-            for emoji in LOADING_EMOJIS[1:]:
-                try:
-                    await asyncio.sleep(0.5)
-                    await loading_msg.edit_text(f"Загрузка {media_type}... {emoji}", parse_mode='Markdown')
-                except Exception as e:
-                    logging.error(f"Ошибка при обновлении анимации: {str(e)}")
-                    break
-        return loading_msg
-    except Exception as e:
-        logging.error(f"Ошибка при создании анимации загрузки: {str(e)}")
+        async with session.get(url, headers={**headers, 'Range': 'bytes=0-31'}, allow_redirects=True, timeout=15) as resp:
+            if resp.status >= 400:
+                return False
+            ctype = (resp.headers.get('Content-Type') or '').lower()
+            if ctype.startswith('image/'):
+                return True
+            head = await resp.content.read(32)
+            return sniff_image_bytes(head)
+    except Exception:
         return None
 
+# Быстрая проверка: является ли URL изображением (с кэшем на PROBE_CACHE_TTL)
+async def is_image_url(session: aiohttp.ClientSession, url: str) -> bool:
+    now = time.time()
+    cached = probe_cache.get(url)
+    if cached and now - cached[0] < PROBE_CACHE_TTL:
+        return cached[1]
+    with metrics.stage('probe'):
+        result = await probe_image_url(session, url)
+    if result is None:
+        metrics.inc('bot_stage_errors_total', stage='probe', type='network')
+        return False
+    if len(probe_cache) >= PROBE_CACHE_MAX:
+        # Сначала выбрасываем устаревшие записи, затем — самые старые
+        for key in [k for k, (t, _) in probe_cache.items() if now - t >= PROBE_CACHE_TTL]:
+            del probe_cache[key]
+        for key in list(probe_cache)[:len(probe_cache) - PROBE_CACHE_MAX // 2]:
+            del probe_cache[key]
+    probe_cache[url] = (now, result)
+    return result
+
+# Пакетная проверка кандидатов: параллельно и с общим дедлайном.
+# URL, не успевшие проверку к дедлайну, считаются не-изображениями
+async def probe_image_urls(session: aiohttp.ClientSession, urls: list[str], deadline: float = PROBE_DEADLINE) -> list[bool]:
+    if not urls:
+        return []
+    semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+    async def probe(u: str) -> bool:
+        async with semaphore:
+            return await is_image_url(session, u)
+
+    tasks = [asyncio.create_task(probe(u)) for u in urls]
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for t in pending:
+        t.cancel()
+    if pending:
+        logging.warning(f"Проверка изображений: {len(pending)} из {len(urls)} URL не успели к дедлайну {deadline} с")
+    return [t in done and not t.cancelled() and t.exception() is None and t.result() for t in tasks]
+
+# Отбор фото среди кандидатов: фото с CDN известных сайтов и URL с расширением изображения принимаются сразу,
+# остальные проверяются одним пакетом
+async def select_photo_urls(session: aiohttp.ClientSession, urls: list[str]) -> list[str]:
+    accepted = set()
+    to_probe = []
+    for u in dict.fromkeys(urls):
+        if is_known_site_image(u):
+            accepted.add(u)
+        elif get_media_type(u) == 'photo':
+            accepted.add(u)
+        else:
+            to_probe.append(u)
+    for u, ok in zip(to_probe, await probe_image_urls(session, to_probe)):
+        if ok:
+            accepted.add(u)
+    return [u for u in dict.fromkeys(urls) if u in accepted]
+
 # Главное меню
 def get_main_menu():
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -1166,20 +3022,115 @@ async def admin_status(message: Message):
         reply_markup=get_admin_menu()
     )
 
+# Задание в очереди: сообщение пользователя и момент постановки
+@dataclass
+class Job:
+    message: Message
+    enqueued_at: float
+
+# Ограниченная очередь заданий с пулом воркеров: всплеск запросов не запускает
+# неограниченное число браузеров и загрузок. Лимит заданий на пользователя и метрики ожидания для админки
+class JobQueue:
+    def __init__(self, workers: int, max_size: int, per_user: int):
+        self.workers = workers
+        self.per_user = per_user
+        self.busy = 0
+        self.processed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue = asyncio.Queue(max_size)
+        self._inflight = {}  # {user_id: заданий в очереди и в работе}
+        self._tasks = []
+        self._handler = None
+
+    def start(self, handler):
+        self._handler = handler
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    # Поставить сообщение в очередь. Возвращает (статус, позиция): 'queued', 'user_limit' или 'full';
+    # позиция > 0 — все воркеры заняты и задание ждёт своей очереди
+    def submit(self, message: Message) -> tuple:
+        user_id = message.from_user.id
+        if self._inflight.get(user_id, 0) >= self.per_user:
+            self.rejected += 1
+            return 'user_limit', 0
+        try:
+            self._queue.put_nowait(Job(message=message, enqueued_at=time.monotonic()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return 'full', 0
+        self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+        # Свободные воркеры заберут первые задания сразу, остальные ждут
+        position = max(0, self._queue.qsize() - max(0, self.workers - self.busy))
+        return 'queued', position
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            wait = time.monotonic() - job.enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.busy += 1
+            try:
+                await self._handler(job.message)
+            except Exception as e:
+                logging.error(f"Ошибка в воркере {index}: {str(e)}", exc_info=True)
+            finally:
+                self.busy -= 1
+                self.processed += 1
+                user_id = job.message.from_user.id
+                left = self._inflight.get(user_id, 1) - 1
+                if left > 0:
+                    self._inflight[user_id] = left
+                else:
+                    self._inflight.pop(user_id, None)
+                self._queue.task_done()
+
+    def stats_text(self) -> str:
+        started = self.processed + self.busy
+        avg_wait = self.total_wait / started if started else 0.0
+        return (f"Очередь: {self.depth()} ждут, воркеров занято {self.busy}/{self.workers}, "
+                f"обработано {self.processed}, отклонено {self.rejected}, "
+                f"ожидание среднее {avg_wait:.1f} с, макс. {self.max_wait:.1f} с")
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE, USER_MAX_INFLIGHT)
+
+# Приём текстового сообщения: постановка в очередь заданий
+async def enqueue_message(message: Message):
+    user_id = message.from_user.id
+    update_user_activity(user_id)
+    status, position = job_queue.submit(message)
+    if status == 'user_limit':
+        await message.reply(
+            f"Ваши предыдущие запросы ещё обрабатываются (не больше {job_queue.per_user} одновременно). "
+            "Дождитесь результата и отправьте ссылку снова ⏳",
+            reply_markup=get_main_menu()
+        )
+    elif status == 'full':
+        await message.reply("Бот сейчас перегружен. Пожалуйста, попробуйте через пару минут 🙏", reply_markup=get_main_menu())
+    elif position > 0:
+        await message.reply(f"Все обработчики заняты, вы #{position} в очереди ⏳")
+
 # Обработка текстовых сообщений (URL или HTML-код)
 async def handle_html(message: Message):
     try:
         user_id = message.from_user.id
-        update_user_activity(user_id)
         content = message.text.strip()
         
         logging.info(f"Получено сообщение от пользователя {user_id}: {content[:50]}...")
         
-        # Создаем сообщение о загрузке
-        loading_msg = await show_loading_animation(message, "контента")
-        if loading_msg is None:
-            await message.reply("Произошла ошибка при создании сообщения о загрузке. Пожалуйста, попробуйте снова.")
-            return
+        # Индикатор прогресса работает в фоне и не задерживает обработку
+        loading_msg = ProgressReporter(message).start()
         
         # Проверяем, является ли сообщение URL
         is_url = content.startswith(('http://', 'https://'))
@@ -1194,80 +3145,27 @@ async def handle_html(message: Message):
                 return
                 
             # Если это не видео, ищем медиа на странице
-            if loading_msg is not None:
-                try:
-                    await loading_msg.edit_text("🔍 Анализирую страницу на наличие медиа...")
-                except Exception:
-                    pass
+            loading_msg.stage("🔍 Анализирую страницу на наличие медиа...")
             
-            # Пробуем найти медиа на странице
-            media_url, media_kind = await fetch_media_url(content)
-            potential_urls = []
-            if media_url and media_kind == 'video':
-                await process_video_url(message, media_url, loading_msg)
+            # Один рендер страницы: видео, а если его нет — все изображения (основное фото первым)
+            analysis = await analyze_page(content, loading_msg)
+            if analysis.video_url:
+                await process_video_url(message, analysis.video_url, loading_msg)
                 return
-            if media_url and media_kind == 'photo':
-                potential_urls.append(media_url)
-            
-            # Ищем все изображения на странице и объединяем
-            if loading_msg is not None:
-                try:
-                    await loading_msg.edit_text("🔍 Видео не найдено, ищу изображения...")
-                except Exception:
-                    pass
-            more_urls = await extract_potential_urls(content)
-            if more_urls:
-                # Объединяем без дублей, сохраняя порядок: сначала найденное основное фото, затем остальные
-                seen = set(potential_urls)
-                for u in more_urls:
-                    if u not in seen:
-                        potential_urls.append(u)
-                        seen.add(u)
+            potential_urls = analysis.image_urls
         else:
             logging.info("Обработка HTML-кода (локальный парсинг)")
             potential_urls = parse_image_urls_from_html(content)
         
-        # Специальная фильтрация для easyhata: оставляем только CDN realty для конкретного объекта
-        try:
-            from urllib.parse import urlparse
-            import re as _re
-            parsed = urlparse(content)
-            host = (parsed.netloc or '').lower()
-            obj_id = None
-            m = _re.search(r"/flats/(\d+)/", parsed.path or '')
-            if m:
-                obj_id = m.group(1)
-
-            def is_target_url(u: str) -> bool:
-                lu = (u or '').lower()
-                if any(x in lu for x in ['.svg', 'favicon.ico']):
-                    return False
-                if 'avatar' in lu:
-                    return False
-                if (('easybase.b-cdn.net' in lu and '/realty/' in lu) or
-                    ('api.easybase.com.ua' in lu and '/media/realty/' in lu)):
-                    if obj_id and f"/{obj_id}/" in lu:
-                        return True
-                    # если id не удалось определить, всё равно допускаем realty
-                    return True
-                return False
-
-            # если это easyhata и нашли целевые ссылки — сохраняем только их
-            if 'easyhata.site' in host:
-                filtered = [u for u in potential_urls if is_target_url(u)]
-                if len(filtered) >= 1:
-                    potential_urls = filtered
-        except Exception:
-            pass
+        # Для известных сайтов оставляем только фото объекта (адаптер сайта)
+        adapter = get_site_adapter(content) if is_url else None
+        if adapter is not None:
+            potential_urls = adapter.filter_images(potential_urls, content)
 
         logging.info(f"Найдено потенциальных URL: {len(potential_urls)}")
         
         if not potential_urls:
-            if loading_msg is not None:
-                try:
-                    await loading_msg.delete()
-                except Exception:
-                    pass
+            await loading_msg.delete()
             await message.reply(
                 "Не удалось найти фотографии. 🚫\n"
                 "Проверьте правильность ссылки или HTML-кода.",
@@ -1275,21 +3173,15 @@ async def handle_html(message: Message):
             )
             return
         
-        # Фильтруем только изображения
-        photo_urls = []
-        async with aiohttp.ClientSession() as session:
-            for url in potential_urls:
-                # Для целевых CDN realty URL не делаем лишнюю проверку HEAD
-                lu = url.lower()
-                if ((('easybase.b-cdn.net' in lu and '/realty/' in lu) or ('api.easybase.com.ua' in lu and '/media/realty/' in lu))
-                    and not any(x in lu for x in ['.svg', 'favicon.ico', '/avatar/'])):
-                    photo_urls.append(url)
-                    continue
-                if get_media_type(url) == 'photo' or await is_image_url(session, url):
-                    photo_urls.append(url)
+        # Фильтруем только изображения (CDN realty без лишней проверки, остальные — пакетом)
+        loading_msg.stage(f"🔍 Найдено ссылок: {len(potential_urls)}, проверяю изображения...")
+        photo_urls = await select_photo_urls(get_http_session(), potential_urls)
         logging.info(f"Найдено фотографий: {len(photo_urls)}")
         
         if not photo_urls:
+            # Кандидаты из кэша страниц оказались негодными — не отдаём их повторно
+            if is_url:
+                page_cache.pop(content)
             await loading_msg.delete()
             await message.reply(
                 "Не удалось найти фотографии. 🚫\n"
@@ -1298,130 +3190,27 @@ async def handle_html(message: Message):
             )
             return
         
-        # Скачиваем фотографии
-        media = []  # только фото для альбомов (все конвертируем в JPEG)
-        success_count = 0
-        error_count = 0
-        
-        async with aiohttp.ClientSession() as session:
-            for i, url in enumerate(photo_urls, 1):
-                logging.info(f"Обработка фото {i}/{len(photo_urls)}: {url}")
-                photo_data, error = await download_media(url, session)
-                if photo_data:
-                    try:
-                        # Проверяем, что фото действительно валидное
-                        if photo_data.getbuffer().nbytes > 0:
-                            # Сначала пробуем получить альтернативный JPEG/PNG URL
-                            try:
-                                alt_buf = await fetch_alt_image_format(session, url)
-                                if alt_buf is not None:
-                                    photo_data = alt_buf
-                            except Exception:
-                                pass
-                            if PIL_AVAILABLE:
-                                try:
-                                    photo_data.seek(0)
-                                    img = Image.open(photo_data)
-                                    try:
-                                        if getattr(img, 'is_animated', False):
-                                            img.seek(0)
-                                    except Exception:
-                                        pass
-                                    if img.mode in ('RGBA', 'P'):
-                                        img = img.convert('RGB')
-                                    buf = BytesIO()
-                                    img.save(buf, format='JPEG', quality=90)
-                                    buf.seek(0)
-                                    input_file = BufferedInputFile(buf.getvalue(), filename=f"photo_{i}.jpg")
-                                    media.append(InputMediaPhoto(media=input_file))
-                                    success_count += 1
-                                    logging.info(f"Успешно добавлено фото {i} (конвертировано в JPEG)")
-                                except Exception as ce:
-                                    logging.error(f"Конвертация в JPEG не удалась для фото {i}: {ce}")
-                                    error_count += 1  # Пропускаем фото, если не удалось конвертировать
-                            else:
-                                # Если PIL не доступен, пропускаем фото
-                                error_count += 1
-                                logging.error(f"PIL не доступен, пропускаем фото {i}")
-                        else:
-                            error_count += 1
-                            logging.error(f"Фото {i} имеет нулевой размер")
-                    except Exception as e:
-                        error_count += 1
-                        logging.error(f"Ошибка при проверке фото {i}: {str(e)}")
-                else:
-                    error_count += 1
-                    logging.error(f"Ошибка при обработке фото {i}: {error}")
-        
-        logging.info(f"Успешно обработано фото: {success_count}, ошибок: {error_count}")
-        
-        if media:
-            try:
-                await loading_msg.delete()
-            except Exception:
-                pass
-            loading_msg = None
-            try:
-                # Проверяем количество валидных фото
-                if len(media) == 0:
-                    raise Exception("Нет валидных фотографий для отправки")
-                
-                if len(media) == 1:
-                    # Если найдено только одно фото, отправляем его как одиночное
-                    logging.info("Отправка одиночного фото")
-                    await message.reply_photo(
-                        photo=media[0].media,
-                        caption=f"✅ Фото скачано!\nИсточник: {content[:50]}...",
-                        reply_markup=get_main_menu()
-                    )
-                    logging.info("Успешно отправлено одиночное фото")
-                    return
-                elif 2 <= len(media) <= 10:
-                    # Если найдено несколько фото, отправляем как альбом
-                    logging.info(f"Отправка альбома из {len(media)} фото")
-                    await message.reply_media_group(media)
-                    await message.reply(
-                        f"✅ Скачано {len(media)} фотографий!\n"
-                        f"Источник: {content[:50]}...",
-                        reply_markup=get_main_menu()
-                    )
-                    logging.info(f"Успешно отправлен альбом из {len(media)} фото")
-                    return
-                else:
-                    # Если фото больше 10, отправляем все по батчам по 10
-                    total = len(media)
-                    logging.info(f"Отправка альбома батчами по 10 (всего найдено: {total})")
-                    for start in range(0, total, 10):
-                        batch = media[start:start+10]
-                        try:
-                            await message.reply_media_group(batch)
-                            await asyncio.sleep(0.5)
-                        except Exception as e:
-                            logging.error(f"Ошибка отправки батча {start//10+1}: {e}")
-                    await message.reply(
-                        f"✅ Скачано и отправлено {total} фотографий!\n"
-                        f"Источник: {content[:50]}...",
-                        reply_markup=get_main_menu()
-                    )
-                    logging.info("Успешно отправлены все батчи фото")
-                    return
-            except Exception as e:
-                logging.error(f"Ошибка отправки фото: {str(e)}")
-            
-            # Если видео не нашли, ищем изображения
-            if loading_msg is not None:
-                try:
-                    await loading_msg.edit_text(" Видео не найдено, ищу изображения...")
-                except Exception:
-                    pass
-            # ниже устаревшая ветка для HTML-текста, пропустим для URL сценария
-            
+        # Фото скачиваются и конвертируются в JPEG (или берутся по file_id из кэша) и уходят альбомами
+        # по 10 по мере готовности — первый альбом не ждёт самое медленное фото галереи
+        prepared, sent_count, error_count = await deliver_photos(
+            message, photo_urls, loading_msg,
+            single_kwargs=dict(caption=f"✅ Фото скачано!\nИсточник: {content[:50]}...", reply_markup=get_main_menu())
+        )
+        logging.info(f"Подготовлено фото: {prepared}, отправлено: {sent_count}, ошибок: {error_count}")
+        if not prepared and is_url:
+            page_cache.pop(content)
+
+        if prepared:
+            if sent_count > 1:
+                headline = f"✅ Скачано {sent_count} фотографий!" if sent_count <= 10 else f"✅ Скачано и отправлено {sent_count} фотографий!"
+                await message.reply(
+                    f"{headline}\n"
+                    f"Источник: {content[:50]}...",
+                    reply_markup=get_main_menu()
+                )
         else:
-            # Создаем сообщение о загрузке
-            loading_msg = await show_loading_animation(message, "контента")
-            if loading_msg is None:
-                await message.reply("Произошла ошибка при создании сообщения о загрузке. Пожалуйста, попробуйте снова.")
-                return
+            # Индикатор прогресса работает в фоне и не задерживает обработку
+            loading_msg = ProgressReporter(message).start()
             
             # Проверяем, является ли текст HTML-кодом
             is_html = '<' in content and '>' in content
@@ -1434,47 +3223,73 @@ async def handle_html(message: Message):
                 await process_video_url(message, content, loading_msg)
             else:
                 # Используем Playwright для анализа страницы
-                if loading_msg is not None:
-                    try:
-                        await loading_msg.edit_text(" Анализирую страницу на наличие медиа...")
-                    except Exception:
-                        pass
+                loading_msg.stage("🔍 Анализирую страницу на наличие медиа...")
                 
-                # Пробуем найти видео на странице
-                video_url, _ = await fetch_media_url(content)
-                if video_url:
-                    await process_video_url(message, video_url, loading_msg)
+                # Пробуем найти видео и изображения на странице
+                analysis = await analyze_page(content, loading_msg)
+                if analysis.video_url:
+                    await process_video_url(message, analysis.video_url, loading_msg)
                     return
                 
-                # Если видео не нашли, ищем изображения
-                urls = await extract_potential_urls(content)
+                urls = analysis.image_urls
                 if urls:
                     await process_media_urls(message, urls, loading_msg)
                 else:
-                    if loading_msg is not None:
-                        try:
-                            await loading_msg.edit_text("Не удалось найти медиа на странице ")
-                        except Exception:
-                            pass
+                    await loading_msg.delete()
+                    await message.reply("Не удалось найти медиа на странице 🚫", reply_markup=get_main_menu())
                 
     except Exception as e:
         logging.error(f"Ошибка обработки сообщения: {str(e)}")
         if 'loading_msg' in locals() and loading_msg is not None:
-            try:
-                await loading_msg.edit_text(f"Произошла ошибка: {str(e)} ")
-            except Exception:
-                pass
+            await loading_msg.delete()
+        try:
+            await message.reply(f"Произошла ошибка: {str(e)}")
+        except Exception:
+            pass
     finally:
         if 'loading_msg' in locals() and loading_msg is not None:
-            try:
-                await bot.delete_message(chat_id=loading_msg.chat.id, message_id=loading_msg.message_id)
-            except Exception:
-                pass
+            await loading_msg.delete()
 
 # Обработка видео по URL
-async def process_video_url(message: Message, video_url: str, loading_msg: Message):
+async def process_video_url(message: Message, video_url: str, loading_msg: ProgressReporter):
     try:
-        await loading_msg.edit_text("📥 Скачиваю видео...")
+        # Видео уже отправлялось — повторяем по file_id без скачивания
+        cache_key = file_id_cache.url_key(video_url)
+        cached = file_id_cache.get(cache_key)
+        if cached:
+            kind, file_id = cached
+            try:
+                if kind == 'video':
+                    await message.reply_video(
+                        video=file_id,
+                        caption=f"🎥 Видео загружено!\nИсточник: {video_url[:100]}",
+                        reply_markup=get_main_menu(),
+                        supports_streaming=True
+                    )
+                else:
+                    await message.reply_document(
+                        document=file_id,
+                        caption=f"📁 Видео загружено как документ\nИсточник: {video_url[:100]}",
+                        reply_markup=get_main_menu()
+                    )
+                try:
+                    await loading_msg.delete()
+                except Exception:
+                    pass
+                return
+            except Exception as e:
+                logging.error(f"Не удалось отправить видео по file_id, скачиваем заново: {str(e)}")
+                file_id_cache.forget(cache_key)
+
+        loading_msg.stage("📥 Скачиваю видео...")
+
+        # Прогресс в мегабайтах (размер известен, если сервер прислал Content-Length)
+        def on_progress(written: int, total: int | None):
+            done_mb = written / (1024 * 1024)
+            if total:
+                loading_msg.stage(f"📥 Скачиваю видео... {done_mb:.1f} из {total / (1024 * 1024):.1f} МБ")
+            else:
+                loading_msg.stage(f"📥 Скачиваю видео... {done_mb:.1f} МБ")
         
         # Устанавливаем заголовки для обхода защиты
         headers = {
@@ -1487,88 +3302,89 @@ async def process_video_url(message: Message, video_url: str, loading_msg: Messa
             'DNT': '1',
         }
         
-        # Создаем сессию для скачивания с настройками
-        timeout = aiohttp.ClientTimeout(total=300, connect=30)
-        connector = aiohttp.TCPConnector(force_close=True, enable_cleanup_closed=True)
-        
-        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        # Определяем расширение файла
+        file_ext = 'mp4'  # По умолчанию используем mp4
+        if '.' in video_url:
+            ext = video_url.split('.')[-1].lower()
+            if ext in ['mp4', 'webm', 'mov', 'avi', 'mkv', 'flv']:
+                file_ext = ext
+
+        temp_file = None
+        try:
+            # Скачиваем видео с нашими заголовками прямо в файл спула
+            with metrics.stage('download'):
+                if is_hls_url(video_url):
+                    temp_file, file_ext, error = await download_hls(video_url, get_http_session(), headers, on_progress)
+                else:
+                    temp_file, error = await download_to_file(video_url, get_http_session(), headers=headers, timeout=300, suffix=f".{file_ext}",
+                                                             on_progress=on_progress)
+                    # Ссылка без .m3u8 тоже может оказаться плейлистом HLS
+                    if temp_file and is_hls_file(temp_file):
+                        remove_spool_file(temp_file)
+                        temp_file, file_ext, error = await download_hls(video_url, get_http_session(), headers, on_progress)
+            
+            if error:
+                # Если ошибка связана с аутентификацией, сообщаем пользователю
+                if 'требуется авторизация' in error.lower():
+                    await message.reply(
+                        "⚠️ Это видео доступно только для зарегистрированных пользователей Motherless.\n\n"
+                        "Пожалуйста, войдите в аккаунт на сайте и попробуйте снова.",
+                        reply_markup=get_main_menu()
+                    )
+                else:
+                    await message.reply(f"❌ {error}", reply_markup=get_main_menu())
+                
+                try:
+                    await loading_msg.delete()
+                except:
+                    pass
+                return
+            
             try:
-                # Скачиваем видео с нашими заголовками
-                video_data, error = await download_media(video_url, session, headers=headers)
+                # Отправляем видео (загрузка в Telegram идёт с диска)
+                loading_msg.stage("📤 Отправляю видео...")
                 
-                if error:
-                    # Если ошибка связана с аутентификацией, сообщаем пользователю
-                    if 'требуется авторизация' in error.lower():
-                        await message.reply(
-                            "⚠️ Это видео доступно только для зарегистрированных пользователей Motherless.\n\n"
-                            "Пожалуйста, войдите в аккаунт на сайте и попробуйте снова.",
+                try:
+                    # Пробуем отправить как видео
+                    with metrics.stage('telegram_upload'):
+                        sent = await message.reply_video(
+                            video=FSInputFile(temp_file, filename=f"video.{file_ext}"),
+                            caption=f"🎥 Видео загружено!\nИсточник: {video_url[:100]}",
+                            reply_markup=get_main_menu(),
+                            supports_streaming=True
+                        )
+                except Exception as e:
+                    # Если не удалось отправить как видео, пробуем отправить как документ
+                    logging.error(f"Ошибка отправки видео: {str(e)}, пробуем отправить как документ...")
+                    with metrics.stage('telegram_upload'):
+                        sent = await message.reply_document(
+                            document=FSInputFile(temp_file, filename=f"video.{file_ext}"),
+                            caption=f"📁 Видео загружено как документ\nИсточник: {video_url[:100]}",
                             reply_markup=get_main_menu()
                         )
-                    else:
-                        await message.reply(f"❌ {error}", reply_markup=get_main_menu())
-                    
-                    try:
-                        await loading_msg.delete()
-                    except:
-                        pass
-                    return
                 
-                # Определяем расширение файла
-                file_ext = 'mp4'  # По умолчанию используем mp4
-                if '.' in video_url:
-                    ext = video_url.split('.')[-1].lower()
-                    if ext in ['mp4', 'webm', 'mov', 'avi', 'mkv', 'flv']:
-                        file_ext = ext
+                # Запоминаем file_id для повторных запросов того же видео
+                if sent.video:
+                    file_id_cache.put(cache_key, 'video', sent.video.file_id)
+                elif sent.document:
+                    file_id_cache.put(cache_key, 'document', sent.document.file_id)
                 
-                # Создаем временный файл
-                temp_file = f"temp_video_{int(time.time())}.{file_ext}"
-                try:
-                    with open(temp_file, 'wb') as f:
-                        f.write(video_data.getbuffer())
-                    
-                    # Отправляем видео
-                    await loading_msg.edit_text("📤 Отправляю видео...")
-                    
-                    try:
-                        # Пробуем отправить как видео
-                        with open(temp_file, 'rb') as video_file:
-                            await message.reply_video(
-                                video=video_file,
-                                caption=f"🎥 Видео загружено!\nИсточник: {video_url[:100]}",
-                                reply_markup=get_main_menu(),
-                                supports_streaming=True
-                            )
-                    except Exception as e:
-                        # Если не удалось отправить как видео, пробуем отправить как документ
-                        logging.error(f"Ошибка отправки видео: {str(e)}, пробуем отправить как документ...")
-                        with open(temp_file, 'rb') as video_file:
-                            await message.reply_document(
-                                document=video_file,
-                                caption=f"📁 Видео загружено как документ\nИсточник: {video_url[:100]}",
-                                reply_markup=get_main_menu()
-                            )
-                    
-                    await loading_msg.delete()
-                    
-                except Exception as e:
-                    logging.error(f"Ошибка при сохранении/отправке видео: {str(e)}", exc_info=True)
-                    await message.reply("❌ Произошла ошибка при обработке видео. Пожалуйста, попробуйте позже.")
+                await loading_msg.delete()
                 
-                # Удаляем временный файл, если он существует
-                try:
-                    import os
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении временного файла: {str(e)}")
-                    
             except Exception as e:
-                logging.error(f"Ошибка при обработке видео: {str(e)}", exc_info=True)
-                await message.reply(f"❌ Произошла ошибка: {str(e)}")
-                try:
-                    await loading_msg.delete()
-                except:
-                    pass
+                logging.error(f"Ошибка при отправке видео: {str(e)}", exc_info=True)
+                await message.reply("❌ Произошла ошибка при обработке видео. Пожалуйста, попробуйте позже.")
+                
+        except Exception as e:
+            logging.error(f"Ошибка при обработке видео: {str(e)}", exc_info=True)
+            await message.reply(f"❌ Произошла ошибка: {str(e)}")
+            try:
+                await loading_msg.delete()
+            except:
+                pass
+        finally:
+            # Удаляем файл спула
+            remove_spool_file(temp_file)
                     
     except Exception as e:
         logging.error(f"Критическая ошибка в process_video_url: {str(e)}", exc_info=True)
@@ -1612,12 +3428,12 @@ async def process_callback(callback: CallbackQuery):
             await callback.message.edit_text("Доступно только админу. 🔐", reply_markup=get_main_menu())
             await callback.answer()
             return
-        daily, weekly, total = get_user_stats()
+        windows, total = get_user_stats()
+        lines = "".join(f"- {label}: {count}\n" for label, count in windows)
         await callback.message.edit_text(
             f"📊 *Статистика пользователей*\n\n"
             f"Пользователи:\n"
-            f"- За день: {daily}\n"
-            f"- За неделю: {weekly}\n"
+            f"{lines}"
             f"- За всё время: {total}",
             parse_mode='Markdown',
             reply_markup=get_admin_menu()
@@ -1630,7 +3446,11 @@ async def process_callback(callback: CallbackQuery):
         await callback.message.edit_text(
             f"🚀 *Статус бота*\n\n"
             f"Бот работает!\n"
-            f"Обработано запросов: {request_count} 📊",
+            f"Обработано запросов: {request_count} 📊\n"
+            f"Кэш страниц: {len(page_cache)} записей, попаданий {page_cache.hits}, промахов {page_cache.misses}\n"
+            f"Повторные отправки по file\\_id: {file_id_cache.hits}\n"
+            f"{job_queue.stats_text()}\n"
+            f"{image_converter.stats_text()}",
             parse_mode='Markdown',
             reply_markup=get_admin_menu()
         )
@@ -1641,14 +3461,119 @@ async def process_callback(callback: CallbackQuery):
 dp.message.register(send_welcome, Command(commands=['start']))
 dp.message.register(send_support, Command(commands=['support']))
 dp.message.register(admin_status, Command(commands=['admin']))
-dp.message.register(handle_html, F.content_type == ContentType.TEXT)
+dp.message.register(enqueue_message, F.content_type == ContentType.TEXT)
 dp.callback_query.register(process_callback)
 
+# Показатели, которые вычисляются в момент запроса /metrics
+metrics.register_callback('bot_requests_total', 'counter', 'Проанализировано ссылок', lambda: request_count)
+metrics.register_callback('bot_job_queue_depth', 'gauge', 'Заданий в очереди', job_queue.depth)
+metrics.register_callback('bot_job_workers_busy', 'gauge', 'Занятых воркеров', lambda: job_queue.busy)
+metrics.register_callback('bot_jobs_rejected_total', 'counter', 'Отклонённых заданий', lambda: job_queue.rejected)
+metrics.register_callback('bot_convert_queue_depth', 'gauge', 'Изображений в очереди на конвертацию', lambda: image_converter.waiting)
+metrics.register_callback('bot_browser_launches_total', 'counter', 'Запусков Chromium', lambda: browser_manager.launch_count)
+metrics.register_callback('bot_browser_warm_contexts', 'gauge', 'Готовых заранее контекстов браузера', browser_manager.ready_count)
+metrics.register_callback('bot_browser_warm_hits_total', 'counter', 'Запросов, получивших готовый контекст', lambda: browser_manager.warm_hits)
+metrics.register_callback('bot_page_cache_hits_total', 'counter', 'Попаданий в кэш страниц', lambda: page_cache.hits)
+metrics.register_callback('bot_page_cache_misses_total', 'counter', 'Промахов кэша страниц', lambda: page_cache.misses)
+
+# Тяжёлые модули, которые нужны только для обработки ссылок и фото
+WARMUP_MODULES = ('playwright.async_api', 'PIL.Image', 'lxml.etree')
+warmup_task: asyncio.Task | None = None
+
+# Фоновый прогрев после старта: импорт Playwright, PIL и lxml в потоке, затем запуск браузера и готовых контекстов
+async def warm_up():
+    started = time.monotonic()
+    for name in WARMUP_MODULES:
+        try:
+            await asyncio.to_thread(importlib.import_module, name)
+        except Exception as e:
+            logging.error(f"Не удалось загрузить модуль {name}: {e}")
+    try:
+        await browser_manager.start()
+    except Exception as e:
+        # Браузер поднимется лениво при первом запросе
+        logging.error(f"Не удалось запустить браузер при прогреве: {e}")
+    logging.info(f"Прогрев завершён за {time.monotonic() - started:.2f} с")
+
 async def on_startup():
+    get_http_session()
+    prepare_spool_dir()
+    page_cache.load()
+    file_id_cache.load()
+    activity_store.load()
+    asyncio.create_task(activity_store.run_flush())
+    job_queue.start(handle_html)
+    try:
+        await start_metrics_server()
+    except Exception as e:
+        logging.error(f"Не удалось запустить сервер метрик: {e}")
+    # Браузер и тяжёлые модули загружаются в фоне — приём обновлений их не ждёт
+    global warmup_task
+    warmup_task = asyncio.create_task(warm_up())
+    startup_timer.mark('on_startup')
     logging.info('Бот запущен 🚀')
 
+async def on_shutdown():
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await job_queue.stop()
+    await stop_metrics_server()
+    activity_store.flush()
+    await browser_manager.stop()
+    image_converter.shutdown()
+    close_state_db()
+    await close_http_session()
+
+# Секрет вебхука: из WEBHOOK_SECRET, иначе производный от токена — одинаковый на всех экземплярах за балансировщиком
+def get_webhook_secret() -> str:
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{API_TOKEN}".encode()).hexdigest()[:48]
+
+async def register_webhook():
+    await bot.set_webhook(
+        url=WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=get_webhook_secret(),
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=True
+    )
+    logging.info(f"Вебхук зарегистрирован: {WEBHOOK_URL}{WEBHOOK_PATH}")
+
+# Режим webhook: обновления принимает aiohttp-сервер и обрабатывает каждое в фоне, не задерживая ответ Telegram
+async def run_webhook():
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_URL")
+    app = build_service_app()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True,
+                         secret_token=get_webhook_secret()).register(app, path=WEBHOOK_PATH)
+    # Запуск и остановка диспетчера (on_startup/on_shutdown) вместе с приложением
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, PORT).start()
+        logging.info(f"Сервер вебхука слушает {WEBHOOK_HOST}:{PORT}")
+        await register_webhook()
+        startup_timer.report('webhook')
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+
 async def main():
+    startup_timer.mark('init')
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if BOT_MODE == 'webhook':
+        await run_webhook()
+        return
+    # Вебхук, оставшийся от режима webhook, блокирует getUpdates
+    await bot.delete_webhook(drop_pending_updates=True)
     await dp.start_polling(bot, drop_pending_updates=True)
 
 if __name__ == '__main__':
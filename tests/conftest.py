@@ -0,0 +1,9 @@
+# Окружение бота задаётся до импорта модуля: фиктивный токен и состояние только в памяти
+import os
+import sys
+
+os.environ.setdefault('BOT_TOKEN', '123456:TEST')
+os.environ['STATE_DB_PATH'] = ''
+os.environ['METRICS_PORT'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
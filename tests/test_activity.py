@@ -0,0 +1,91 @@
+# HyperLogLog и окна активности ActivityStore
+import bot
+
+HOUR = 3600
+DAY = 86400
+
+
+def test_hyperloglog_estimate_within_error():
+    hll = bot.HyperLogLog(12)
+    for i in range(20000):
+        hll.add(f"user-{i}")
+    # Стандартная ошибка при p=12 около 1.6%
+    assert abs(hll.count() - 20000) / 20000 < 0.05
+
+
+def test_hyperloglog_small_counts_exact_enough():
+    hll = bot.HyperLogLog(12)
+    for i in range(100):
+        hll.add(i)
+    assert 97 <= hll.count() <= 103
+
+
+def test_hyperloglog_add_reports_change_and_ignores_duplicates():
+    hll = bot.HyperLogLog(10)
+    assert hll.add('a') is True
+    assert hll.add('a') is False
+    assert hll.count() == 1
+
+
+def test_hyperloglog_merge_is_union():
+    left, right = bot.HyperLogLog(12), bot.HyperLogLog(12)
+    for i in range(1000):
+        left.add(i)
+    for i in range(500, 1500):
+        right.add(i)
+    left.merge(right)
+    assert abs(left.count() - 1500) / 1500 < 0.05
+
+
+def test_hyperloglog_roundtrip_registers():
+    hll = bot.HyperLogLog(10)
+    for i in range(300):
+        hll.add(i)
+    copy = bot.HyperLogLog(10, bytes(hll.registers))
+    assert copy.count() == hll.count()
+
+
+def make_store(monkeypatch, moments):
+    store = bot.ActivityStore(12)
+    for at, users in moments:
+        monkeypatch.setattr(bot.time, 'time', lambda at=at: at)
+        for user in users:
+            store.update(user)
+    return store
+
+
+def active(monkeypatch, store, now, seconds):
+    monkeypatch.setattr(bot.time, 'time', lambda: now)
+    return store.active_users(seconds)
+
+
+def test_hour_window_counts_users_from_previous_bucket(monkeypatch):
+    boundary = 1_700_000_000 // HOUR * HOUR
+    store = make_store(monkeypatch, [(boundary - 600, range(100))])
+    # Минуту спустя после смены часа пользователи десятиминутной давности всё ещё активны «за час»
+    assert active(monkeypatch, store, boundary + 60, HOUR) == 100
+
+
+def test_day_window_covers_full_24_hours(monkeypatch):
+    boundary = 1_700_000_000 // HOUR * HOUR
+    store = make_store(monkeypatch, [(boundary - 23 * HOUR - 1800, range(50)), (boundary, range(50, 60))])
+    now = boundary + 60
+    assert active(monkeypatch, store, now, DAY) == 60
+    assert active(monkeypatch, store, now, HOUR) == 10
+
+
+def test_week_and_month_windows_use_day_buckets(monkeypatch):
+    midnight = 1_700_000_000 // DAY * DAY
+    store = make_store(monkeypatch, [
+        (midnight - 29 * DAY - HOUR, range(40)),  # ~29 суток назад
+        (midnight - 6 * DAY - HOUR, range(40, 70)),  # ~6 суток назад
+        (midnight + HOUR, range(70, 80)),
+    ])
+    now = midnight + 2 * HOUR
+    assert active(monkeypatch, store, now, 7 * DAY) == 40
+    assert active(monkeypatch, store, now, 30 * DAY) == 80
+
+
+def test_active_users_capped_by_total(monkeypatch):
+    store = make_store(monkeypatch, [(1_700_000_000, [1, 2, 3])])
+    assert active(monkeypatch, store, 1_700_000_000, HOUR) <= store.total_users == 3
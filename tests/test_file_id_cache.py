@@ -0,0 +1,52 @@
+import sqlite3
+
+import bot
+
+
+DAY = 86400
+
+
+def make_cache(monkeypatch, now: list, ttl: float = 30 * DAY):
+    monkeypatch.setattr(bot, 'state_db', sqlite3.connect(':memory:'))
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    cache = bot.FileIdCache(max_entries=10, ttl=ttl)
+    cache.load()
+    return cache
+
+
+def rows(db) -> list:
+    return [r[0] for r in db.execute('SELECT key FROM file_ids ORDER BY key')]
+
+
+def test_load_prunes_rows_older_than_ttl(monkeypatch):
+    now = [1_000_000_000.0]
+    cache = make_cache(monkeypatch, now)
+    cache.put('old', 'photo', 'A')
+    now[0] += 10 * DAY
+    cache.put('fresh', 'photo', 'B')
+    now[0] += 25 * DAY
+
+    restarted = bot.FileIdCache(max_entries=10, ttl=30 * DAY)
+    restarted.load()
+    assert rows(bot.state_db) == ['fresh']
+    assert restarted.get('old') is None
+    assert restarted.get('fresh') == ('photo', 'B')
+
+
+def test_expired_row_is_not_served_before_pruning(monkeypatch):
+    now = [1_000_000_000.0]
+    cache = make_cache(monkeypatch, now)
+    cache.put('key', 'photo', 'A')
+    now[0] += 31 * DAY
+    assert bot.FileIdCache(max_entries=10, ttl=30 * DAY).get('key') is None
+
+
+def test_put_prunes_periodically(monkeypatch):
+    now = [1_000_000_000.0]
+    cache = make_cache(monkeypatch, now, ttl=DAY)
+    monkeypatch.setattr(bot.FileIdCache, 'PRUNE_EVERY', 3)
+    cache.put('a', 'photo', '1')
+    cache.put('b', 'photo', '2')
+    now[0] += 2 * DAY
+    cache.put('c', 'photo', '3')
+    assert rows(bot.state_db) == ['c']
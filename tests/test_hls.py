@@ -0,0 +1,126 @@
+import bot
+
+
+MASTER = '''#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=5000000,AVERAGE-BANDWIDTH=3000000,RESOLUTION=1920x1080
+https://cdn.example.com/hd/index.m3u8?token=abc
+
+#EXT-X-STREAM-INF:BANDWIDTH=2000000
+/mid/index.m3u8
+'''
+
+MEDIA = '''#EXTM3U
+#EXT-X-TARGETDURATION:6
+#EXT-X-MEDIA-SEQUENCE:0
+#EXTINF:6.0,
+seg0.ts
+#EXTINF:6.0,
+seg1.ts
+#EXTINF:3.5,title
+seg2.ts
+#EXT-X-ENDLIST
+'''
+
+BYTERANGE = '''#EXTM3U
+#EXT-X-VERSION:4
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1000@0
+all.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:1500
+all.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:500@9000
+all.ts
+#EXTINF:4.0,
+#EXT-X-BYTERANGE:200
+all.ts
+#EXTINF:4.0,
+other.ts
+#EXT-X-ENDLIST
+'''
+
+FMP4 = '''#EXTM3U
+#EXT-X-VERSION:7
+#EXT-X-MAP:URI="init.mp4",BYTERANGE="720@0"
+#EXTINF:2.0,
+part0.m4s
+#EXTINF:2.0,
+part1.m4s
+#EXT-X-ENDLIST
+'''
+
+BASE = 'https://video.example.com/tour/master.m3u8'
+
+
+def test_master_playlist_variants():
+    playlist = bot.parse_hls_playlist(MASTER, BASE)
+    assert playlist.variants == [
+        (800000, 'https://video.example.com/tour/low/index.m3u8'),
+        (3000000, 'https://cdn.example.com/hd/index.m3u8?token=abc'),
+        (2000000, 'https://video.example.com/mid/index.m3u8'),
+    ]
+    assert playlist.segments == []
+
+
+def test_media_playlist_segments_and_duration():
+    playlist = bot.parse_hls_playlist(MEDIA, BASE)
+    assert playlist.variants == []
+    assert [url for url, _ in playlist.segments] == [
+        'https://video.example.com/tour/seg0.ts',
+        'https://video.example.com/tour/seg1.ts',
+        'https://video.example.com/tour/seg2.ts',
+    ]
+    assert all(byterange is None for _, byterange in playlist.segments)
+    assert playlist.duration == 15.5
+    assert playlist.init_segment is None
+    assert not playlist.encrypted
+
+
+def test_byterange_offsets_continue_per_file():
+    playlist = bot.parse_hls_playlist(BYTERANGE, BASE)
+    all_ts = 'https://video.example.com/tour/all.ts'
+    assert playlist.segments == [
+        (all_ts, (1000, 0)),
+        (all_ts, (1500, 1000)),
+        (all_ts, (500, 9000)),
+        (all_ts, (200, 9500)),
+        ('https://video.example.com/tour/other.ts', None),
+    ]
+    assert playlist.duration == 20.0
+
+
+def test_map_sets_init_segment():
+    playlist = bot.parse_hls_playlist(FMP4, BASE)
+    assert playlist.init_segment == ('https://video.example.com/tour/init.mp4', (720, 0))
+    assert len(playlist.segments) == 2
+
+    no_range = bot.parse_hls_playlist(FMP4.replace(',BYTERANGE="720@0"', ''), BASE)
+    assert no_range.init_segment == ('https://video.example.com/tour/init.mp4', None)
+
+
+def test_key_marks_playlist_encrypted():
+    encrypted = MEDIA.replace('#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"')
+    assert bot.parse_hls_playlist(encrypted, BASE).encrypted
+    clear = MEDIA.replace('#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-KEY:METHOD=NONE')
+    assert not bot.parse_hls_playlist(clear, BASE).encrypted
+
+
+def test_pick_variant_fits_size_limit():
+    variants = [(800000, 'low'), (3000000, 'hd'), (2000000, 'mid')]
+    # 60 с: все варианты укладываются — берём лучший
+    assert bot.pick_hls_variant(variants, 60) == 'hd'
+    # 180 с: hd ≈ 67 МБ, mid ≈ 45 МБ
+    assert bot.pick_hls_variant(variants, 180) == 'mid'
+    # Не укладывается ни один — самый лёгкий
+    assert bot.pick_hls_variant(variants, 3600) == 'low'
+
+
+def test_is_hls_url():
+    assert bot.is_hls_url('https://example.com/a/master.M3U8')
+    assert bot.is_hls_url('https://example.com/a/index.m3u8?token=x#t=5')
+    assert not bot.is_hls_url('https://example.com/a/video.mp4')
+    assert not bot.is_hls_url('https://example.com/m3u8/video.mp4?f=.m3u8x')
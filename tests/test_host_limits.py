@@ -0,0 +1,41 @@
+import asyncio
+
+import bot
+
+
+def test_busy_host_limits_survive_eviction(monkeypatch):
+    monkeypatch.setattr(bot, 'host_semaphores', bot.OrderedDict())
+    monkeypatch.setattr(bot, 'HOST_SEMAPHORES_MAX', 2)
+
+    async def scenario():
+        busy = bot.get_host_semaphore('https://busy.example.com/1.jpg')
+        async with busy:
+            bot.get_host_semaphore('https://a.example.com/1.jpg')
+            bot.get_host_semaphore('https://b.example.com/1.jpg')
+            assert list(bot.host_semaphores) == ['busy.example.com', 'b.example.com']
+            assert bot.get_host_semaphore('https://busy.example.com/2.jpg') is busy
+        assert busy.users == 0
+
+    asyncio.run(scenario())
+
+
+def test_waiters_are_counted():
+    async def scenario():
+        limit = bot.HostLimit(1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limit:
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold()) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert limit.users == 3
+        tasks[1].cancel()
+        await asyncio.sleep(0)
+        assert limit.users == 2
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert limit.users == 0
+
+    asyncio.run(scenario())
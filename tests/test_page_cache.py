@@ -0,0 +1,26 @@
+# Канонический ключ страницы для кэша анализа
+import bot
+
+
+def test_normalize_strips_scheme_www_fragment_and_trailing_slash():
+    assert bot.normalize_page_url('https://www.Example.com/flats/123/#photos') == 'example.com/flats/123'
+    assert bot.normalize_page_url('http://example.com/flats/123') == 'example.com/flats/123'
+
+
+def test_normalize_drops_tracking_params_and_sorts_query():
+    url = 'https://example.com/p?utm_source=tg&b=2&fbclid=x&a=1&gclid=y'
+    assert bot.normalize_page_url(url) == 'example.com/p?a=1&b=2'
+
+
+def test_normalize_keeps_meaningful_query_and_blank_values():
+    assert bot.normalize_page_url('https://example.com/p?id=5&empty=') == 'example.com/p?empty=&id=5'
+
+
+def test_normalize_keeps_non_default_port():
+    assert bot.normalize_page_url('http://example.com:8080/p/') == 'example.com:8080/p'
+    assert bot.normalize_page_url('https://example.com:443/p') == 'example.com/p'
+
+
+def test_normalize_root_path():
+    assert bot.normalize_page_url('https://example.com') == 'example.com/'
+    assert bot.normalize_page_url('https://example.com/') == 'example.com/'
@@ -0,0 +1,34 @@
+import bot
+
+
+def test_blocked_domains_are_aborted(monkeypatch):
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_DOMAINS', ('mc.yandex.ru', 'doubleclick.net'))
+    assert bot.route_policy('https://mc.yandex.ru/watch/1', 'script', True) == (True, '')
+    assert bot.route_policy('https://ad.doubleclick.net/x.gif', 'image', True) == (True, '')
+    # Совпадение по суффиксу домена, а не по подстроке
+    assert bot.route_policy('https://notdoubleclick.net/app.js', 'script', True) == (False, '')
+
+
+def test_blocked_resource_types_are_aborted(monkeypatch):
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_DOMAINS', ())
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_RESOURCES', {'font', 'media', 'image'})
+    assert bot.route_policy('https://example.com/f.woff2', 'font', True) == (True, '')
+    assert bot.route_policy('https://example.com/app.js', 'script', True) == (False, '')
+    assert bot.route_policy('https://example.com/page', 'document', True) == (False, '')
+
+
+def test_blocked_images_and_media_are_still_recorded(monkeypatch):
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_DOMAINS', ())
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_RESOURCES', {'media', 'image'})
+    assert bot.route_policy('https://cdn.example.com/1.jpg?w=800', 'image', True) == (True, 'image')
+    assert bot.route_policy('https://cdn.example.com/tour.mp4', 'media', True) == (True, 'video')
+    # Иконки, аудио и видео на сайтах без видео — обрываются без кандидата
+    assert bot.route_policy('https://cdn.example.com/logo.svg', 'image', True) == (True, '')
+    assert bot.route_policy('https://cdn.example.com/bg.mp3?x=1', 'media', True) == (True, '')
+    assert bot.route_policy('https://cdn.example.com/tour.mp4', 'media', False) == (True, '')
+
+
+def test_images_pass_through_when_not_blocked(monkeypatch):
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_DOMAINS', ())
+    monkeypatch.setattr(bot, 'BROWSER_BLOCK_RESOURCES', {'font', 'media'})
+    assert bot.route_policy('https://cdn.example.com/1.jpg', 'image', True) == (False, '')
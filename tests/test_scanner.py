@@ -0,0 +1,94 @@
+import pytest
+
+import bot
+
+
+SCRIPT_TEXT = (
+    '<script>window.__DATA__ = {"photos": ['
+    '"https:\\u002F\\u002Fcdn.example.com\\u002Fobj\\u002F1.jpg", '
+    '"https:\\/\\/cdn.example.com\\/obj\\/2.webp", '
+    '"https://cdn.example.com/obj/1.jpg"], '
+    '"logo": "https://cdn.example.com/static/logo.png", '
+    '"video": "https://video.example.com/tour/master.m3u8", '
+    '"clip": "https://video.example.com/clip.mp4"}</script>'
+)
+
+
+def test_scan_media_urls_decodes_escaped_urls_and_dedupes():
+    result = bot.scan_media_urls(SCRIPT_TEXT)
+    assert result.images == [
+        'https://cdn.example.com/obj/1.jpg',
+        'https://cdn.example.com/obj/2.webp',
+        'https://cdn.example.com/static/logo.png',
+    ]
+    assert result.targets == []
+
+
+def test_scan_media_urls_splits_videos_including_hls():
+    result = bot.scan_media_urls(SCRIPT_TEXT)
+    assert result.videos == [
+        'https://video.example.com/tour/master.m3u8',
+        'https://video.example.com/clip.mp4',
+    ]
+
+
+def test_scan_media_urls_applies_target_filter():
+    result = bot.scan_media_urls(SCRIPT_TEXT, is_target=lambda u: '/obj/' in u)
+    assert result.targets == [
+        'https://cdn.example.com/obj/1.jpg',
+        'https://cdn.example.com/obj/2.webp',
+    ]
+    assert len(result.images) == 3
+
+
+PAGE_HTML = '''<!DOCTYPE html>
+<html><head>
+<meta property="og:image" content="https://cdn.example.com/og.jpg">
+<meta property="og:title" content="Flat">
+<link rel="icon" href="/favicon.png">
+<link rel="image_src" href="https://cdn.example.com/share.jpg">
+</head><body>
+<img src="/img/a.jpg" data-src="https://cdn.example.com/lazy.jpg">
+<img srcset="https://cdn.example.com/b-1x.jpg 1x, https://cdn.example.com/b-2x.jpg 2x">
+<picture><source srcset="https://cdn.example.com/c.webp 800w, https://cdn.example.com/c-big.webp 1600w"></picture>
+<noscript><img src="https://cdn.example.com/noscript.jpg" alt="x"></noscript>
+<img alt="empty">
+</body></html>'''
+
+EXPECTED_FOUND = [
+    ('meta', 'https://cdn.example.com/og.jpg'),
+    ('link', '/favicon.png'),
+    ('link', 'https://cdn.example.com/share.jpg'),
+    ('img', '/img/a.jpg'),
+    ('img', 'https://cdn.example.com/lazy.jpg'),
+    ('img', 'https://cdn.example.com/b-1x.jpg'),
+    ('source', 'https://cdn.example.com/c.webp'),
+    ('img', 'https://cdn.example.com/noscript.jpg'),
+]
+
+
+def collect_with(monkeypatch, backend: str, html: str) -> list:
+    monkeypatch.setattr(bot, 'HTML_PARSER_BACKEND', backend)
+    return bot.collect_html_image_urls(html)
+
+
+def test_collect_html_image_urls_stdlib(monkeypatch):
+    assert collect_with(monkeypatch, 'html.parser', PAGE_HTML) == EXPECTED_FOUND
+
+
+def test_collect_html_image_urls_lxml_matches_stdlib(monkeypatch):
+    pytest.importorskip('lxml')
+    assert collect_with(monkeypatch, 'lxml', PAGE_HTML) == collect_with(monkeypatch, 'html.parser', PAGE_HTML)
+
+
+def test_collect_html_image_urls_empty(monkeypatch):
+    assert collect_with(monkeypatch, 'html.parser', '') == []
+
+
+def test_parse_image_urls_from_html_resolves_and_skips_links(monkeypatch):
+    monkeypatch.setattr(bot, 'HTML_PARSER_BACKEND', 'html.parser')
+    urls = bot.parse_image_urls_from_html(PAGE_HTML, 'https://example.com/flat/1')
+    assert 'https://example.com/img/a.jpg' in urls
+    assert 'https://example.com/favicon.png' not in urls
+    assert 'https://cdn.example.com/share.jpg' not in urls
+    assert urls[0] == 'https://cdn.example.com/og.jpg'
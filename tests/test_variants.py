@@ -0,0 +1,66 @@
+import asyncio
+
+import bot
+
+
+class FakeResponse:
+    def __init__(self, status: int, ctype: str):
+        self.status = status
+        self.headers = {'content-type': ctype}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class FakeSession:
+    # {расширение: (статус, content-type) | исключение}
+    def __init__(self, answers: dict):
+        self.answers = answers
+        self.calls = 0
+
+    def head(self, url, **kwargs):
+        self.calls += 1
+        answer = self.answers.get('.' + url.rsplit('.', 1)[1], (404, 'text/html'))
+        if isinstance(answer, Exception):
+            raise answer
+        return FakeResponse(*answer)
+
+
+WEBP = 'https://cdn.example.com/photos/123/1.webp'
+NEXT_WEBP = 'https://cdn.example.com/photos/456/2.webp'
+
+
+def resolve(resolver, session, url):
+    return asyncio.run(resolver.resolve(session, url))
+
+
+def test_found_variant_is_remembered_for_the_pattern():
+    resolver = bot.ImageVariantResolver()
+    session = FakeSession({'.jpg': (200, 'image/jpeg')})
+    assert resolve(resolver, session, WEBP) == 'https://cdn.example.com/photos/123/1.jpg'
+    calls = session.calls
+    assert resolve(resolver, session, NEXT_WEBP) == 'https://cdn.example.com/photos/456/2.jpg'
+    assert session.calls == calls
+
+
+def test_network_error_is_not_cached():
+    resolver = bot.ImageVariantResolver()
+    failing = FakeSession({'.jpg': asyncio.TimeoutError(), '.jpeg': asyncio.TimeoutError(), '.png': asyncio.TimeoutError()})
+    assert resolve(resolver, failing, WEBP) == WEBP
+    healthy = FakeSession({'.png': (200, 'image/png')})
+    assert resolve(resolver, healthy, NEXT_WEBP) == 'https://cdn.example.com/photos/456/2.png'
+
+
+def test_missing_variant_expires(monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(bot.time, 'time', lambda: now[0])
+    resolver = bot.ImageVariantResolver()
+    assert resolve(resolver, FakeSession({}), WEBP) == WEBP
+    session = FakeSession({'.jpg': (200, 'image/jpeg')})
+    assert resolve(resolver, session, NEXT_WEBP) == NEXT_WEBP
+    assert session.calls == 0
+    now[0] += bot.VARIANT_MISS_TTL
+    assert resolve(resolver, session, NEXT_WEBP) == 'https://cdn.example.com/photos/456/2.jpg'